@@ -8,7 +8,7 @@ from zope.keyreference.interfaces import NotYet
 from opennode.oms.endpoint.ssh.detached import DetachedProtocol
 from opennode.oms.model.model.proc import IProcess, Proc, DaemonProcess
 from opennode.oms.model.model.search import ReindexAction
-from opennode.oms.util import subscription_factory, async_sleep
+from opennode.oms.util import subscription_factory
 from opennode.oms.zodb import db
 from opennode.oms.model.model.events import IModelDeletedEvent
 from opennode.oms.model.traversal import canonical_path, traverse_path
@@ -28,23 +28,24 @@ class IndexerDaemonProcess(DaemonProcess):
 
     black_hole = BlackHoleQueue()
 
-    @defer.inlineCallbacks
-    def run(self):
-        while True:
-            try:
-                if not self.paused:
-                    if IndexerDaemonProcess.queue == self.black_hole:
-                        IndexerDaemonProcess.queue = deque()
+    def __init__(self):
+        super(IndexerDaemonProcess, self).__init__()
+        # the first run performs a full reindex
+        IndexerDaemonProcess.queue = self.black_hole
 
-                        self.reindex()
-                        yield self.process()
-                    else:
-                        IndexerDaemonProcess.queue = self.black_hole
+    def signal_handler(self, name):
+        super(IndexerDaemonProcess, self).signal_handler(name)
+        # events received while paused are dropped, a full reindex is performed once resumed
+        if self.paused:
+            IndexerDaemonProcess.queue = self.black_hole
 
-            except Exception:
-                log.err(system='indexer')
+    @defer.inlineCallbacks
+    def execute(self):
+        if IndexerDaemonProcess.queue is self.black_hole:
+            IndexerDaemonProcess.queue = deque()
+            yield self.reindex()
 
-            yield async_sleep(1)
+        yield self.process()
 
     @classmethod
     def enqueue(cls, model, event):
@@ -80,17 +81,16 @@ class IndexerDaemonProcess(DaemonProcess):
 
         log.msg("%sindexing %s %s" % (op, path, type(event).__name__), system="indexer")
 
-        objs, unresolved_path = traverse_path(db.get_root()['oms_root'], path)
-        if unresolved_path and not IModelDeletedEvent.providedBy(event):
-            return False
-
-        obj = objs[-1]
-
         try:
             if IModelDeletedEvent.providedBy(event):
-                searcher.unindex_object(obj)
+                # deleted models cannot be traversed anymore, their intid is found by reference
+                searcher.unindex_object(model)
             else:
-                searcher._index_object(obj)
+                objs, unresolved_path = traverse_path(db.get_root()['oms_root'], path)
+                if unresolved_path:
+                    return False
+
+                searcher._index_object(objs[-1])
         except NotYet:
             return False
 
@@ -98,6 +98,6 @@ class IndexerDaemonProcess(DaemonProcess):
         return True
 
     def reindex(self):
-        ReindexAction(None).execute(DetachedProtocol(), object())
+        return ReindexAction(None).execute(DetachedProtocol(), object())
 
 provideSubscriptionAdapter(subscription_factory(IndexerDaemonProcess), adapts=(Proc,))
@@ -24,6 +24,23 @@ class EmptyResponse(Exception):
     pass
 
 
+class ReactorRender(object):
+    """Views can return this in order to complete the rendering in the reactor thread,
+    after the db transaction used to resolve the view has been closed.
+
+    The wrapped callable may return a deferred.
+
+    """
+
+    def __init__(self, fun, *args, **kwargs):
+        self.fun = fun
+        self.args = args
+        self.kwargs = kwargs
+
+    def render(self):
+        return defer.maybeDeferred(self.fun, *self.args, **self.kwargs)
+
+
 class HttpStatus(Exception):
     def __init__(self, body=None, *args, **kwargs):
         super(HttpStatus, self).__init__(*args, **kwargs)
@@ -100,6 +117,11 @@ class MethodNotAllowed(HttpStatus):
         self.headers = {'Allow': ','.join(allow)}
 
 
+class GatewayTimeout(HttpStatus):
+    status_code = 504
+    status_description = "Gateway Timeout"
+
+
 def log_wrapper(self, f, server):
     @functools.wraps(f)
     def log_(request):
@@ -170,6 +192,8 @@ class HttpRestServer(resource.Resource):
         ret = None
         try:
             ret = yield self.handle_request(request)
+            if isinstance(ret, ReactorRender):
+                ret = yield db.remove_persistent_proxy(ret).render()
             # allow views to take full control of output streaming
             if ret is not NOT_DONE_YET and ret is not EmptyResponse:
                 request.setHeader('Content-Type', 'application/json')
@@ -1,20 +1,20 @@
 import json
 import os
 import time
-import traceback
-import Queue
+from collections import OrderedDict
 
-from grokcore.component import context
+from grokcore.component import baseclass, context, name
 from hashlib import sha1
 from twisted.web.server import NOT_DONE_YET
 from twisted.python import log
-from twisted.internet import reactor, threads, defer
+from twisted.internet import reactor, defer
 from zope.component import queryAdapter, handle
 from zope.security.interfaces import Unauthorized
 from zope.security.proxy import removeSecurityProxy
 
+from opennode.oms.config import get_config
 from opennode.oms.endpoint.httprest.base import HttpRestView, IHttpRestView
-from opennode.oms.endpoint.httprest.root import BadRequest, NotFound
+from opennode.oms.endpoint.httprest.root import BadRequest, GatewayTimeout, NotFound, ReactorRender
 from opennode.oms.endpoint.ssh.cmd.security import effective_perms
 from opennode.oms.endpoint.ssh.detached import DetachedProtocol
 from opennode.oms.endpoint.ssh.cmdline import ArgumentParsingError
@@ -23,13 +23,15 @@ from opennode.oms.model.location import ILocation
 from opennode.oms.model.model.base import IContainer
 from opennode.oms.model.model.bin import ICommand
 from opennode.oms.model.model.byname import ByNameContainer
+from opennode.oms.model.model.eventlog import UserEventLog
 from opennode.oms.model.model.events import ModelDeletedEvent
-from opennode.oms.model.model.filtrable import IFiltrable
-from opennode.oms.model.model.search import SearchContainer, SearchResult
-from opennode.oms.model.model.stream import IStream, StreamSubscriber
+from opennode.oms.model.model.filtrable import QueryPlan
+from opennode.oms.model.model.proc import ITask, ICompletedTask
+from opennode.oms.model.model.search import SearchContainer
+from opennode.oms.model.model.stream import IStream, StreamSubscriber, TransientStream
 from opennode.oms.model.model.symlink import Symlink, follow_symlinks
 from opennode.oms.model.schema import model_to_dict
-from opennode.oms.model.traversal import traverse_path
+from opennode.oms.model.traversal import traverse_path, parse_path, canonical_path
 from opennode.oms.security.checker import get_interaction
 from opennode.oms.zodb import db
 
@@ -147,14 +149,15 @@ class ContainerView(DefaultView):
             if offset <= 0:
                 offset = 0
 
-        def secure_filter_match(item, q):
+        def secure_filter_match(item, plan):
             try:
-                return IFiltrable(item).match(q)
+                return plan.match(item)
             except Unauthorized:
                 return
 
         for q in qlist:
-            items = filter(lambda item: secure_filter_match(item, q), items)
+            plan = QueryPlan(q)
+            items = filter(lambda item: secure_filter_match(item, plan), items)
 
         children = filter(None, [secure_render_recursive(item) for item in items
                                  if queryAdapter(item, IHttpRestView) and not self.blacklisted(item)])
@@ -180,18 +183,74 @@ class ContainerView(DefaultView):
 
 
 class SearchView(ContainerView):
+    """Full text search with `q`.
+
+    Only the objects of the requested page (`limit` and the 1-based `offset`) are loaded;
+    `rank` orders results by relevance and `count` returns just the number of matches.
+
+    """
     context(SearchContainer)
 
     def render_GET(self, request):
-        q = request.args.get('q', [''])[0]
+        def arg(name, default=None):
+            return request.args.get(name, [default])[0]
+
+        q = arg('q', '')
 
         if not q:
             return super(SearchView, self).render_GET(request)
 
         search = db.get_root()['oms_root']['search']
-        res = SearchResult(search, q.decode('utf-8'))
+        q = q.decode('utf-8')
+
+        if arg('count'):
+            return dict(count=search.count_goog(q))
+
+        try:
+            limit = int(arg('limit', 0)) or None
+            offset = max(int(arg('offset', 1)) - 1, 0)
+        except ValueError:
+            raise BadRequest('limit and offset must be integers')
+
+        # kept in the order of the results, which with `rank` is by decreasing relevance
+        children = []
+        for item in search.search_goog(q, limit=limit, offset=offset, ranked=bool(arg('rank'))):
+            if not request.interaction.checkPermission('view', item):
+                continue
+            try:
+                children.append(IHttpRestView(item).render_recursive(request, 0))
+            except Unauthorized:
+                continue
+        return children
+
+
+class UserEventLogView(ContainerView):
+    """Pages through a user event log, newest events first.
+
+    Accepts `limit`, `before` (the `next` value of the previous page), `since`, `until`,
+    `level` and `text` query arguments.
+
+    """
+    context(UserEventLog)
 
-        return IHttpRestView(res).render_GET(request)
+    def render_GET(self, request):
+        def arg(name, default=None):
+            return request.args.get(name, [default])[0]
+
+        try:
+            limit = int(arg('limit', 50))
+            before = int(arg('before')) if arg('before') else None
+        except ValueError:
+            raise BadRequest('limit and before must be integers')
+
+        text = arg('text')
+        events = self.context.query(limit=limit, before=before, since=arg('since'), until=arg('until'),
+                                    level=arg('level'), text=text.decode('utf-8') if text else None)
+
+        data = super(ContainerView, self).render_GET(request)
+        data['children'] = [IHttpRestView(event).render_recursive(request, 0) for event in events]
+        data['next'] = int(events[-1].__name__) if events and len(events) == limit else None
+        return data
 
 
 class StreamView(HttpRestView):
@@ -199,13 +258,15 @@ class StreamView(HttpRestView):
 
     cached_subscriptions = dict()
 
+    # Canonical paths known to be backed by a TransientStream, with the time they were
+    # last traversed, oldest first. Their events are read directly from the transient
+    # store, without traversing the db, until the tombstones of their deletion could expire.
+    transient_paths = OrderedDict()
+
     def rw_transaction(self, request):
         return False
 
     def render(self, request):
-        timestamp = int(time.time() * 1000)
-        oms_root = db.get_root()['oms_root']
-
         limit = int(request.args.get('limit', ['100'])[0])
         after = int(request.args.get('after', ['0'])[0])
 
@@ -223,31 +284,77 @@ class StreamView(HttpRestView):
             self.cached_subscriptions[subscription_hash] = data
             request.responseHeaders.addRawHeader('X-OMS-Subscription-Hash', subscription_hash)
 
-        def val(r):
-            objs, unresolved_path = traverse_path(oms_root, r)
-            if unresolved_path:
-                return [(timestamp, dict(event='delete', name=os.path.basename(r), url=r))]
-            return IStream(objs[-1]).events(after, limit=limit)
+        return ReactorRender(self.render_events, data, after, limit)
+
+    @defer.inlineCallbacks
+    def render_events(self, data, after, limit):
+        now = time.time()
+        timestamp = int(now * 1000)
+        fake_metrics = get_config().getboolean('metrics', 'fake_metrics', False)
+
+        while self.transient_paths:
+            path, traversed = next(self.transient_paths.iteritems())
+            if traversed > now - TransientStream.TOMBSTONE_TTL:
+                break
+            del self.transient_paths[path]
+
+        def deleted(r):
+            return [(timestamp, dict(event='delete', name=os.path.basename(r), url=r))]
+
+        events = {}
+        unresolved = []
+        for idx, r in enumerate(data):
+            path = '/' + '/'.join(parse_path(r))
+            if path in self.transient_paths and TransientStream.is_deleted(path):
+                del self.transient_paths[path]
+                events[idx] = deleted(r)
+            elif path in self.transient_paths and (TransientStream.transient_store.get(path)
+                                                   or not fake_metrics):
+                events[idx] = TransientStream.events_for_path(path, after, limit=limit)
+            else:
+                unresolved.append((idx, r, path))
+
+        if unresolved:
+            resolved, transient = yield self.traverse_events(unresolved, after, limit, deleted)
+            events.update(resolved)
+            # paths are recorded in the reactor thread, with the time before traversing them
+            for path in transient:
+                self.transient_paths.pop(path, None)
+                self.transient_paths[path] = now
 
         # ONC wants it in ascending time order
         # while internally we prefer to keep it newest first to
         # speed up filtering.
         # Reversed is not json serializable so we have to reify to list.
-        res = [list(reversed(val(resource))) for resource in data]
-        res = [(i, v) for i, v in enumerate(res) if v]
-        return [timestamp, dict(res)]
+        res = [(idx, list(reversed(v))) for idx, v in events.items() if v]
+        defer.returnValue([timestamp, dict(res)])
+
+    @db.ro_transact(proxy=False)
+    def traverse_events(self, resources, after, limit, deleted):
+        """Fallback for streams which cannot be read directly from the transient store.
+        Also returns the paths found to be backed by a TransientStream.
+
+        """
+        oms_root = db.get_root()['oms_root']
+
+        res = {}
+        transient = []
+        for idx, r, path in resources:
+            objs, unresolved_path = traverse_path(oms_root, r)
+            if unresolved_path:
+                res[idx] = deleted(r)
+                continue
+
+            stream = IStream(objs[-1])
+            if isinstance(stream, TransientStream) and canonical_path(objs[-1]) == path:
+                transient.append(path)
+            res[idx] = stream.events(after, limit=limit)
+        return res, transient
 
 
 class CommandView(DefaultView):
     context(ICommand)
 
-    def write_results(self, request, pid, cmd):
-        log.msg('Called %s got result: pid(%s) term writes=%s' % (
-                cmd, pid, len(cmd.write_buffer)), system='command-view')
-        request.write(json.dumps({'status': 'ok', 'pid': pid,
-                                  'stdout': cmd.write_buffer}))
-        request.finish()
-
     def render_PUT(self, request):
         """ Converts arguments into command-line counterparts and executes the omsh command.
 
@@ -261,7 +368,8 @@ class CommandView(DefaultView):
             /bin/ls /some/path /another/path -l --recursive
 
         Allows blocking (synchronous) and non-blocking operation using the 'asynchronous' parameter (any
-        value will trigger it). Synchronous operation requires two threads to function.
+        value will trigger it). An asynchronous command answers with its pid right away; its status and
+        output can then be polled at /proc/<pid>, also after it completed.
         """
 
         def named_args_filter_and_flatten(nargs):
@@ -281,62 +389,133 @@ class CommandView(DefaultView):
         args = convert_args(request.args)
         args = filter(None, args)
         cmd = self.context.cmd(protocol)
-        # Setting write_buffer to a list makes command save the output to the buffer too
-        cmd.write_buffer = []
-        d0 = defer.Deferred()
 
+        asynchronous = bool(request.args.get('asynchronous'))
+        return ReactorRender(self.run_command, request, cmd, args, asynchronous)
+
+    @defer.inlineCallbacks
+    def run_command(self, request, cmd, args, asynchronous):
+        """Runs the command in the reactor thread, like omsh does; commands do their db work in
+        transactions of their own, so no thread is held while waiting for them.
+
+        """
+        command_line = '%s %s' % (request.path, args)
+        deferred = defer.Deferred()
+        try:
+            pid = yield cmd.register(deferred, args, command_line, keep_output=asynchronous)
+        except ArgumentParsingError, e:
+            raise BadRequest(str(e))
+
+        execution = defer.maybeDeferred(cmd, *args)
+        execution.chainDeferred(deferred)
+        deferred.addBoth(self._command_done, cmd, pid)
+
+        if asynchronous:
+            deferred.addErrback(log.err, system='http-cmd')
+            defer.returnValue({'status': 'ok', 'pid': pid, 'href': '/proc/%s' % pid})
+
+        cancelled = []
+
+        def cancel(reason):
+            cancelled.append(reason)
+            execution.cancel()
+
+        timeout = reactor.callLater(get_config().getint('rest', 'command_timeout', 300), cancel, 'timeout')
+        request.notifyFinish().addErrback(lambda _: cancel('disconnected'))
         try:
-            pid = threads.blockingCallFromThread(reactor, cmd.register, d0, args,
-                                                 '%s %s' % (request.path, args))
+            yield deferred
         except ArgumentParsingError, e:
+            log.err(system='http-cmd')
             raise BadRequest(str(e))
+        except defer.CancelledError:
+            if 'timeout' in cancelled:
+                msg = 'Timeout waiting for command %s (%s) to complete' % (request.path, args)
+                log.msg(msg, system='http-cmd')
+                raise GatewayTimeout(msg)
+            if 'disconnected' in cancelled:
+                # nobody to answer to
+                defer.returnValue(NOT_DONE_YET)
+            raise
+        finally:
+            if timeout.active():
+                timeout.cancel()
+
+        # the output is bounded like for any other task, tell when its beginning was dropped
+        defer.returnValue({'status': 'ok', 'pid': pid, 'stdout': list(cmd.write_buffer),
+                           'truncated': cmd.write_buffer.truncated(0)})
+
+    def _command_done(self, result, cmd, pid):
+        # hands the output buffered by worker threads over to the detached terminal
+        cmd.flush()
+        log.msg('Called %s got result: pid(%s) term writes=%s' % (
+                cmd, pid, len(cmd.write_buffer)), system='command-view')
+        return result
+
 
-        q = Queue.Queue()
-
-        def cancel_execute(_, d):
-            d.cancel()
-
-        def execute(q, cmd, args):
-            d = defer.maybeDeferred(cmd, *args)
-            request.notifyFinish().addBoth(cancel_execute, d)
-            d.addBoth(q.put)
-            d.chainDeferred(d0)
-
-        # cmd() may be synchronous (that are executed inline, without deferreds) or asynchronous.
-        # We want synchronous methods to be executed in a separate thread
-        dt = threads.deferToThread(execute, q, cmd, args)
-
-        request.notifyFinish().addBoth(cancel_execute, dt)
-        asynchronous = request.args.get('asynchronous', [])
-
-        if not asynchronous:
-            dt.addBoth(lambda r: threads.deferToThread(q.get, True, 300))
-
-        dt.addCallback(lambda r: reactor.callFromThread(self.write_results, request, pid, cmd))
-
-        def handleArgumentParsingError(e, pid, cmd):
-            e.trap(ArgumentParsingError)
-            log.err(e, system='http-cmd')
-            request.setResponseCode(400)
-            request.write(str(e.value))
-            request.finish()
-
-        def handleQueueEmpty(e, pid, cmd):
-            e.trap(Queue.Empty)
-            msg = 'Timeout waiting for command %s (%s) to complete' % (request.path, args)
-            log.msg(msg, system='http-cmd')
-            request.setResponseCode(504)
-            request.write(msg)
-            request.finish()
-
-        def handleUnknownError(e, pid, cmd):
-            e.trap(Exception)
-            log.err(e, system='http-cmd')
-            request.setResponseCode(500)
-            request.write(''.join(traceback.format_exc(e.value)))
-            request.finish()
-
-        dt.addErrback(handleArgumentParsingError, pid, cmd)
-        dt.addErrback(handleQueueEmpty, pid, cmd)
-        dt.addErrback(handleUnknownError, pid, cmd)
-        return NOT_DONE_YET
+class TaskOutputView(HttpRestView):
+    """Incremental output of a task:
+
+        GET /proc/<pid>/output?after=<seq>&wait=<seconds>
+
+    returns the output chunks numbered after `seq`. With `wait`, an empty answer is delayed
+    until some output arrives, the task completes or the given seconds pass.
+
+    """
+    baseclass()
+
+    max_wait = 60
+
+    def rw_transaction(self, request):
+        return False
+
+    def render_GET(self, request):
+        output = removeSecurityProxy(self.context).output
+        if output is None:
+            raise NotFound('The output of task %s was not kept' % self.context.__name__)
+
+        try:
+            after = int(request.args.get('after', ['0'])[0])
+            wait = min(float(request.args.get('wait', ['0'])[0]), self.max_wait)
+        except ValueError:
+            raise BadRequest('after and wait have to be numbers')
+
+        return ReactorRender(self.render_output, request, output, after, wait)
+
+    @defer.inlineCallbacks
+    def render_output(self, request, output, after, wait):
+        chunks = output.read(after)
+        if not chunks and wait > 0:
+            waiting = output.wait(after)
+            timeout = reactor.callLater(wait, waiting.cancel)
+            disconnected = []
+
+            def client_gone(reason):
+                disconnected.append(reason)
+                waiting.cancel()
+            request.notifyFinish().addErrback(client_gone)
+
+            try:
+                chunks = yield waiting
+            except defer.CancelledError:
+                if disconnected:
+                    defer.returnValue(NOT_DONE_YET)
+            finally:
+                if timeout.active():
+                    timeout.cancel()
+
+        last = chunks[-1][0] if chunks else after
+        defer.returnValue({'seq': last,
+                           'output': [data for seq, data in chunks],
+                           'truncated': output.truncated(after),
+                           # nothing more is coming after these chunks
+                           'closed': output.closed and output.seq <= last})
+
+
+class RunningTaskOutputView(TaskOutputView):
+    context(ITask)
+    name('output')
+
+
+class CompletedTaskOutputView(TaskOutputView):
+    context(ICompletedTask)
+    name('output')
@@ -1,12 +1,17 @@
+import copy
+import threading
+
 from grokcore.component import Subscription, implements, context, queryOrderedSubscriptions
 from twisted.internet import defer, reactor
+from twisted.python import log
 from twisted.python.threadable import isInIOThread
 from zope.component import queryAdapter
 
+from opennode.oms.config import get_config
 from opennode.oms.endpoint.ssh.cmdline import (ICmdArgumentsSyntax, IContextualCmdArgumentsSyntax,
                                                VirtualConsoleArgumentParser, ArgumentParsingError,
                                                PartialVirtualConsoleArgumentParser)
-from opennode.oms.model.model.proc import Proc
+from opennode.oms.model.model.proc import Proc, TaskOutput
 from opennode.oms.model.traversal import traverse_path
 from opennode.oms.security.checker import proxy_factory
 from opennode.oms.zodb import db, proxy
@@ -15,20 +20,92 @@ from opennode.oms.zodb.extractors import IContextExtractor
 
 class Cmd(object):
 
+    # name of the parsed argument listing the targets which `-j N` processes in parallel
+    parallel_arg = None
+
+    # set by commands which couldn't do what they were asked, e.g. for a missing object
+    failed = False
+
     def __init__(self, protocol):
         self.protocol = protocol
         self.terminal = protocol.terminal
         self.write_buffer = None
 
+        # output written from other threads, waiting to be flushed by the reactor
+        self._output = []
+        self._output_size = 0
+        self._output_lock = threading.Lock()
+        self._flush_scheduled = self._flush_now = False
+
     @defer.inlineCallbacks
     def __call__(self, *args):
         """Subclasses should override this if they need raw arguments."""
         parsed = yield defer.maybeDeferred(self.parse_args, args)
-        yield self.execute(parsed)
+        if getattr(parsed, 'jobs', None) > 0:
+            yield self.execute_parallel(parsed)
+        else:
+            yield self.execute(parsed)
 
     def execute(args):
         """Subclasses should override this if they need parsed arguments."""
 
+    def parallel_targets(self, args):
+        """Returns the targets which `-j N` processes in parallel."""
+        return getattr(args, self.parallel_arg)
+
+    def target_args(self, args, target):
+        """Returns a copy of the parsed `args` restricted to a single target."""
+        args = copy.copy(args)
+        setattr(args, self.parallel_arg, [target])
+        return args
+
+    @defer.inlineCallbacks
+    def execute_parallel(self, args):
+        """Executes the command once per target, at most `args.jobs` at a time.
+
+        Every target is handled by its own instance of the command, so it runs in separate
+        transactions and is registered as a child task of this command. The output of a target
+        is written, prefixed by the target, as soon as it completes.
+
+        """
+        targets = self.parallel_targets(args)
+        semaphore = defer.DeferredSemaphore(args.jobs)
+        results = yield defer.gatherResults([semaphore.run(self._execute_target, args, target)
+                                             for target in targets])
+
+        failed = results.count(False)
+        if failed:
+            self.fail("%s of %s targets failed\n" % (failed, len(targets)))
+
+    @defer.inlineCallbacks
+    def _execute_target(self, args, target):
+        args = self.target_args(args, target)
+        args.jobs = None
+
+        cmd = type(self)(self.protocol)
+        cmd.terminal = output = OutputCapture()
+        cmd.write_buffer = TaskOutput()
+
+        d = defer.Deferred()
+        try:
+            subj = yield defer.maybeDeferred(cmd.subject, args)
+            cmd.pid = self._register_task(d, subj, '%s %s' % (self.name, target), getattr(self, 'pid', None),
+                                          write_buffer=cmd.write_buffer)
+            defer.maybeDeferred(cmd.execute, args).chainDeferred(d)
+            yield d
+        except Exception as e:
+            log.msg("Failed executing '%s' on %s: %s" % (self.name, target, e), system='parallel')
+            output.write('failed: %s\n' % e)
+            ok = False
+        else:
+            ok = not cmd.failed
+        finally:
+            cmd.flush()
+
+        for line in ''.join(output.data).splitlines():
+            self.write('%s: %s\n' % (target, line))
+        defer.returnValue(ok)
+
     @classmethod
     def _format_names(cls):
         if cls.aliases:
@@ -116,14 +193,67 @@ class Cmd(object):
     def current_obj(self):
         return self.traverse('/'.join(self.protocol.path) if self.protocol.path != [''] else '/')
 
+    def fail(self, *args):
+        """Writes an error message and marks the command as failed."""
+        self.failed = True
+        self.write(*args)
+
     def write(self, *args):
         """Ensure that all writes are serialized regardless if the command is executing in another thread.
+
+        Writes from other threads are buffered and handed to the reactor in batches, after
+        `[ssh] output_flush_interval` milliseconds or once `output_flush_size` bytes are pending.
+
         """
         if self.write_buffer is not None and hasattr(self.write_buffer, 'append'):
             self.write_buffer.append(' '.join(map(str, args)))
-        deferredMethod = (reactor.callFromThread if not isInIOThread() else defer.maybeDeferred)
+
         # XXX: HACK: force str for the first param to avoid UnicodeDecodeError happening in Conch
-        return deferredMethod(self.terminal.write, str(args[0]), *args[1:])
+        args = (str(args[0]), ) + args[1:]
+
+        if isInIOThread():
+            self.flush()
+            return defer.maybeDeferred(self.terminal.write, *args)
+
+        with self._output_lock:
+            self._output.append(args)
+            self._output_size += len(args[0])
+
+            if self._output_size >= self.output_flush_size and not self._flush_now:
+                self._flush_now = True
+                reactor.callFromThread(self.flush)
+            elif not self._flush_scheduled:
+                self._flush_scheduled = True
+                reactor.callFromThread(reactor.callLater, self.output_flush_interval, self.flush)
+
+    def flush(self):
+        """Writes the buffered output to the terminal. Has to be called from the reactor thread."""
+        with self._output_lock:
+            output, self._output = self._output, []
+            self._output_size = 0
+            self._flush_scheduled = self._flush_now = False
+
+        chunks = []
+        for args in output:
+            if len(args) > 1:
+                self._write_chunks(chunks)
+                chunks = []
+                self.terminal.write(*args)
+            else:
+                chunks.append(args[0])
+        self._write_chunks(chunks)
+
+    def _write_chunks(self, chunks):
+        if chunks:
+            self.terminal.write(''.join(chunks))
+
+    @property
+    def output_flush_interval(self):
+        return get_config().getint('ssh', 'output_flush_interval', 20) / 1000.0
+
+    @property
+    def output_flush_size(self):
+        return get_config().getint('ssh', 'output_flush_size', 16384)
 
     def traverse_full(self, path):
         if path.startswith('/'):
@@ -152,9 +282,18 @@ class Cmd(object):
         defer.returnValue(subject)
 
     @defer.inlineCallbacks
-    def register(self, d, args, command_line, ptid=None):
+    def register(self, d, args, command_line, ptid=None, keep_output=False):
         subj = yield defer.maybeDeferred(self.subject_from_raw, args)
 
+        # the output of every task is kept, bounded, in its /proc entry
+        if not isinstance(self.write_buffer, TaskOutput):
+            self.write_buffer = TaskOutput(self.write_buffer or ())
+
+        self.pid = self._register_task(d, subj, command_line, ptid, write_buffer=self.write_buffer,
+                                       keep_output=keep_output)
+        defer.returnValue(self.pid)
+
+    def _register_task(self, d, subj, command_line, ptid, write_buffer=None, keep_output=False):
         # XXX: for some reason, when I let subject to be a generator instance, I get an empty
         # generator in the ComputeTasks container, while it magically works when I save it as a tuple
         # under item.subject
@@ -162,13 +301,18 @@ class Cmd(object):
             subj = subj.remove_persistent_proxy()
         assert type(subj) is tuple, "subject of '%s' must be a tuple, got %s" % (self.name, type(subj))
 
-        self.pid = Proc.register(d, subj, command_line, ptid, write_buffer=self.write_buffer,
-                                 principal=self.protocol.principal)
-        defer.returnValue(self.pid)
+        return Proc.register(d, subj, command_line, ptid, write_buffer=write_buffer,
+                             principal=self.protocol.principal, keep_output=keep_output)
 
     def unregister(self):
         Proc.unregister(self.pid)
 
+    def on_interrupt(self, callback):
+        """Calls `callback` when the user interrupts the command with ^C in an interactive shell."""
+        handlers = getattr(getattr(self.protocol, 'sub_protocol', None), 'interrupt_handlers', None)
+        if handlers is not None:
+            handlers.append(callback)
+
     @property
     def user(self):
         if self.protocol.interaction:
@@ -177,6 +321,16 @@ class Cmd(object):
             return None
 
 
+class OutputCapture(object):
+    """Stands in for the terminal of a command whose output is collected rather than displayed."""
+
+    def __init__(self):
+        self.data = []
+
+    def write(self, data, *args):
+        self.data.append(data)
+
+
 class CommandContextExtractor(Subscription):
     implements(IContextExtractor)
     context(Cmd)
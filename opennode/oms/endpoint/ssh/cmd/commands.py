@@ -1,3 +1,5 @@
+import argparse
+import copy
 import datetime
 import os
 import re
@@ -5,6 +7,7 @@ import time
 
 import zope.schema
 from grokcore.component import implements, Adapter, Subscription, baseclass, order
+from persistent import Persistent
 from twisted.conch.insults.insults import modes
 from twisted.internet import defer, utils
 from twisted.python import log
@@ -60,6 +63,19 @@ class CommonArgs(Subscription):
         return parser
 
 
+class ParallelArgs(Subscription):
+    """Lets a command process its targets in parallel, see `Cmd.execute_parallel`."""
+    implements(ICmdArgumentsSyntax)
+    baseclass()
+    order(-1)
+
+    def arguments(self):
+        parser = VirtualConsoleArgumentParser()
+        parser.add_argument('-j', '--jobs', type=int, metavar='N',
+                            help="process up to N targets in parallel, each in its own transaction")
+        return parser
+
+
 class ChangeDirCmd(Cmd):
     implements(ICmdArgumentsSyntax)
 
@@ -131,11 +147,11 @@ class ChangeDirCmd(Cmd):
         objs, unresolved_path = self.traverse_full(path)
 
         if not objs or unresolved_path:
-            self.write('No such object: %s\n' % path)
+            self.fail('No such object: %s\n' % path)
             return
 
         if not IContainer.providedBy(objs[-1]):
-            self.write('Cannot cd to a non-container\n')
+            self.fail('Cannot cd to a non-container\n')
             return
 
         # Fixes #41.
@@ -172,20 +188,29 @@ class ListDirContentsCmd(Cmd):
         parser.add_argument('-d', action='store_true',
                             help="list directory entries instead of contents, and do not dereference "
                             "symbolic links")
+        parser.add_argument('--max-depth', type=int, metavar='N',
+                            help="with -R, descend at most N levels of directories")
         parser.add_argument('paths', nargs='*')
         return parser
 
+    # with -R, loaded objects are released from the db connection cache every this many directories
+    release_interval = 100
+
     @db.ro_transact
     def execute(self, args):
         self.opts_long = args.l
         self.opts_dir = args.d
-        self.visited = []
+        self.max_depth = args.max_depth
+        # OIDs of the listed persistent containers, transient ones can only repeat along the current path
+        self.visited = set()
+        self.listing = []
+        self.listed_count = 0
 
         if args.paths:
             for path in args.paths:
                 obj = self.traverse(path)
                 if not obj:
-                    self.write('No such object: %s\n' % path)
+                    self.fail('No such object: %s\n' % path)
                 else:
                     self._do_ls(obj, path, recursive=args.R)
         else:
@@ -198,9 +223,23 @@ class ListDirContentsCmd(Cmd):
         else:
             return tuple((self.current_obj,))
 
-    def _do_ls(self, obj, path='.', recursive=False):
-        assert obj not in self.visited
-        self.visited.append(obj)
+    def _do_ls(self, obj, path='.', recursive=False, depth=0):
+        raw = removeSecurityProxy(obj)
+        if isinstance(raw, Persistent) and raw._p_oid is not None:
+            self.visited.add(raw._p_oid)
+        self.listing.append(obj)
+        try:
+            self._list(obj, path, recursive, depth)
+        finally:
+            self.listing.pop()
+
+    def _already_listed(self, obj):
+        raw = removeSecurityProxy(obj)
+        if isinstance(raw, Persistent) and raw._p_oid is not None:
+            return raw._p_oid in self.visited
+        return any(removeSecurityProxy(i) is raw for i in self.listing)
+
+    def _list(self, obj, path, recursive, depth):
 
         def pretty_name(item):
             if IContainer.providedBy(item):
@@ -256,14 +295,27 @@ class ListDirContentsCmd(Cmd):
         for line in (make_long_lines(container) if self.opts_long else make_short_lines(container)):
             self.write(line)
 
-        if recursive and IContainer.providedBy(obj) and not self.opts_dir:
-            for ch in container:
-                child_obj = obj[ch.__name__]
-                if (IContainer.providedBy(child_obj)
-                        and not isinstance(child_obj, Symlink)
-                        and child_obj not in self.visited):
-                    self.write("\n%s:\n" % os.path.join(path, ch.__name__.encode('utf8')))
-                    self._do_ls(child_obj, os.path.join(path, ch.__name__), recursive=True)
+        if not recursive or not IContainer.providedBy(obj) or self.opts_dir:
+            return
+
+        if self.max_depth is not None and depth >= self.max_depth:
+            return
+
+        # keep only the subdirectories while descending
+        subdirs = [ch for ch in container if IContainer.providedBy(ch) and not isinstance(ch, Symlink)]
+        del container
+
+        for ch in subdirs:
+            if self._already_listed(ch):
+                continue
+
+            self.listed_count += 1
+            if self.listed_count % self.release_interval == 0:
+                # listed objects aren't needed anymore, keep the connection cache from growing
+                db.get_connection().cacheGC()
+
+            self.write("\n%s:\n" % os.path.join(path, ch.__name__.encode('utf8')))
+            self._do_ls(ch, os.path.join(path, ch.__name__), recursive=True, depth=depth + 1)
 
 
 provideSubscriptionAdapter(CommonArgs, adapts=(ListDirContentsCmd, ))
@@ -304,7 +356,7 @@ class CatObjectCmd(Cmd):
         for path in args.paths:
             obj = self.traverse(path)
             if not obj:
-                self.write("No such object: %s\n" % path)
+                self.fail("No such object: %s\n" % path)
             else:
                 self._do_cat(obj, attrs, args.l, path if args.H else None)
 
@@ -355,6 +407,7 @@ class RemoveCmd(Cmd):
     implements(ICmdArgumentsSyntax)
 
     command('rm')
+    parallel_arg = 'paths'
 
     def arguments(self):
         parser = VirtualConsoleArgumentParser()
@@ -377,7 +430,7 @@ class RemoveCmd(Cmd):
             obj = obj_dir[os.path.basename(path)]
 
             if not obj_dir or not obj:
-                self.write("No such object: %s\n" % path)
+                self.fail("No such object: %s\n" % path)
                 continue
 
             parent = obj.__parent__
@@ -453,17 +506,33 @@ class SetAttrCmd(Cmd):
     def arguments(self):
         parser = VirtualConsoleArgumentParser()
         parser.add_argument('path')
+        # further objects, usually coming from glob expansion; hidden so that completion
+        # offers key=value switches after the first path
+        parser.add_argument('paths', nargs='*', help=argparse.SUPPRESS)
         return parser
 
+    def parallel_targets(self, args):
+        return [args.path] + args.paths
+
+    def target_args(self, args, target):
+        args = copy.copy(args)
+        args.path, args.paths = target, []
+        return args
+
     @db.ro_transact(proxy=False)
     def subject(self, args):
-        return tuple((self.traverse(args.path),))
+        return tuple(self.traverse(path) for path in self.parallel_targets(args))
 
     @defer.inlineCallbacks
     def execute(self, args):
-        obj = (yield db.ro_transact(self.traverse)(args.path))
+        for path in self.parallel_targets(args):
+            yield self.set_attrs(path, args)
+
+    @defer.inlineCallbacks
+    def set_attrs(self, path, args):
+        obj = (yield db.ro_transact(self.traverse)(path))
         if not obj:
-            self.write("No such object: %s\n" % args.path)
+            self.fail("No such object: %s\n" % path)
             return
 
         vh = PreValidateHookMixin(obj)
@@ -477,7 +546,7 @@ class SetAttrCmd(Cmd):
 
         @db.transact
         def apply():
-            obj = self.traverse(args.path)
+            obj = self.traverse(path)
             raw_data = args.keywords
 
             if args.verbose:
@@ -507,6 +576,8 @@ class SetAttrCmd(Cmd):
 
 
 provideSubscriptionAdapter(CommonArgs, adapts=(SetAttrCmd, ))
+provideSubscriptionAdapter(ParallelArgs, adapts=(SetAttrCmd, ))
+provideSubscriptionAdapter(ParallelArgs, adapts=(RemoveCmd, ))
 
 
 class CreateObjCmd(Cmd):
@@ -683,7 +754,7 @@ class FileCmd(Cmd):
         for path in args.paths:
             obj = self.traverse(path)
             if not obj:
-                self.write("No such object: %s\n" % path)
+                self.fail("No such object: %s\n" % path)
             else:
                 rows.append(self._do_file(path, obj))
 
@@ -865,11 +936,12 @@ class TaskListCmd(Cmd):
         # ignore arguments
         tasks = Proc().tasks
         if args.d:
+            Proc().prune_dead_tasks()
             tasks = Proc().dead_tasks
 
-        max_key_len = max(3, *[len(i) for i in Proc().content().keys()])
-        max_user_len = max(3, *[len(i.principal.id) for i in Proc().content().values()
-                                if getattr(i, 'principal', None)])
+        max_key_len = max([3] + [len(i) for i in tasks.keys()])
+        max_user_len = max([3] + [len(i.principal.id) for i in tasks.values()
+                                  if getattr(i, 'principal', None)])
 
         self.write("%s    %s%s TIME CMD\n" % ("TID".rjust(max_key_len),
                                            "PTID    ".rjust(max_key_len) if args.l else '',
@@ -906,7 +978,7 @@ class KillTaskCmd(Cmd):
         for tid in args.tid:
             task = self.find_task(tid)
             if not task:
-                self.write("Cannot find task `%s`\n" % tid)
+                self.fail("Cannot find task `%s`\n" % tid)
                 continue
 
             if args.STOP:
@@ -934,6 +1006,58 @@ class KillTaskCmd(Cmd):
         return None
 
 
+class TailCmd(Cmd):
+    """Outputs the last lines of the output of a task, optionally following it."""
+
+    command('tail')
+
+    implements(ICmdArgumentsSyntax)
+
+    def arguments(self):
+        parser = VirtualConsoleArgumentParser()
+        parser.add_argument('path', help="Task, either as a path like /proc/12 or as its id")
+        parser.add_argument('-n', type=int, default=10, help="Number of lines to output (default 10)")
+        parser.add_argument('-f', '--follow', action='store_true',
+                            help="Output the task's output as it is written, until the task completes")
+        return parser
+
+    @db.ro_transact(proxy=False)
+    def find_output(self, path):
+        task = Proc()[path] if re.match('[0-9]+$', path) else self.traverse(path)
+        return getattr(removeSecurityProxy(task), 'output', None)
+
+    @defer.inlineCallbacks
+    def execute(self, args):
+        output = yield self.find_output(args.path)
+        if output is None:
+            self.write("No output of task `%s`\n" % args.path)
+            return
+
+        chunks = output.read()
+        lines = ''.join(chunk[1] for chunk in chunks).splitlines(True)
+        if args.n > 0 and lines:
+            self.write(''.join(lines[-args.n:]))
+
+        if not args.follow:
+            return
+
+        waiting = []
+        self.on_interrupt(lambda: waiting and waiting[-1].cancel())
+
+        seq = chunks[-1][0] if chunks else 0
+        while True:
+            # only the current wait is kept, a long follow would pile up the past ones
+            waiting[:] = [output.wait(seq)]
+            try:
+                chunks = yield waiting[-1]
+            except defer.CancelledError:
+                return
+            if not chunks:
+                break
+            seq = chunks[-1][0]
+            self.write(''.join(chunk[1] for chunk in chunks))
+
+
 class OmsShellCmd(Cmd):
     """This command represents the oms shell. Currently it cannot run a nested shell."""
 
@@ -977,7 +1101,7 @@ class EditCmd(Cmd):
     def execute(self, args):
         obj = yield db.ro_transact(self.traverse)(args.path)
         if not obj:
-            self.write("No such object: %s\n" % args.path)
+            self.fail("No such object: %s\n" % args.path)
             return
 
         editor = Editor(self.protocol)
@@ -1020,6 +1144,8 @@ class CatLogCmd(Cmd):
         parser.add_argument('-n', help='Number of lines to output')
         parser.add_argument('-u', action='store_true', required=False, default=False,
                             help='Display user log')
+        parser.add_argument('--level', help='Minimum level of the displayed user log events')
+        parser.add_argument('--grep', help='Display only user log events containing this text')
         return parser
 
     @defer.inlineCallbacks
@@ -1045,13 +1171,11 @@ class CatLogCmd(Cmd):
 
         @db.ro_transact
         def get_user_log():
-            eventlog = db.get_root()['oms_root']['eventlog']
-            if self.user.id not in eventlog.listnames():
+            usereventlog = db.get_root()['oms_root']['eventlog'][self.user.id]
+            if usereventlog is None:
                 return
 
-            usereventlog = eventlog[self.user.id]
-
-            for event in sorted(usereventlog.listcontent(), key=lambda event: event.timestamp, reverse=True):
+            for event in usereventlog.query(limit=nr_of_lines, level=args.level, text=args.grep):
                 self.write('%s %s %s\n' % (event.timestamp, event.levelname, event.message))
 
         yield get_user_log()
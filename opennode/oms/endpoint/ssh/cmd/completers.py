@@ -1,15 +1,18 @@
 import argparse
 import os
+from bisect import bisect_left
+from collections import OrderedDict
 
 from grokcore.component import baseclass, context
 from twisted.internet import defer
 from zope.component import provideSubscriptionAdapter
+from zope.security.proxy import removeSecurityProxy
 
 from opennode.oms.endpoint.ssh.cmd import commands
 from opennode.oms.endpoint.ssh.cmd import security
 from opennode.oms.endpoint.ssh.cmd.completion import Completer
 from opennode.oms.endpoint.ssh.cmdline import GroupDictAction
-from opennode.oms.model.model.base import IContainer
+from opennode.oms.model.model.base import IContainer, children_serial
 from opennode.oms.model.model.bin import ICommand
 from opennode.oms.model.model.symlink import Symlink, follow_symlinks
 from opennode.oms.zodb import db
@@ -24,8 +27,8 @@ class PositionalCompleter(Completer):
         """Currently expected action. It looks at the cardinalities """
         for action_group in parser._action_groups:
             for action in action_group._group_actions:
-                # For every positional argument:
-                if not action.option_strings:
+                # For every positional argument which isn't hidden:
+                if not action.option_strings and action.help != argparse.SUPPRESS:
                     actual = 0
                     maximum = 0
 
@@ -51,6 +54,63 @@ class PositionalCompleter(Completer):
                         return action
 
 
+class ChildNamesCache(object):
+    """Per session cache of the sorted child names, with type suffixes, of stored containers.
+
+    Entries are keyed by container OID and are reused until the serial of the container or
+    of the BTree holding its children changes.
+
+    """
+
+    max_size = 64
+
+    def __init__(self):
+        self.entries = OrderedDict()
+
+    def names(self, container):
+        key = self.serial(removeSecurityProxy(container))
+        if key is None:
+            return sorted(self._names(container))
+
+        oid, serial = key
+        cached = self.entries.pop(oid, None)
+        if cached is None or cached[0] != serial:
+            cached = (serial, sorted(self._names(container)))
+
+        self.entries[oid] = cached
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+        return cached[1]
+
+    def serial(self, container):
+        """Returns the (OID, serial) of a container whose children are all stored, otherwise None."""
+        serial = children_serial(container)
+        if serial is not None:
+            return container._p_oid, serial
+
+    def _names(self, container):
+        for obj in container.listcontent():
+            if IContainer.providedBy(follow_symlinks(obj)):
+                suffix = '/'
+            elif ICommand.providedBy(follow_symlinks(obj)):
+                suffix = '*'
+            elif isinstance(obj, Symlink):
+                suffix = '@'
+            else:
+                suffix = ''
+            yield obj.__name__ + suffix
+
+
+def child_names_cache(protocol):
+    if protocol is None:
+        return ChildNamesCache()
+
+    if getattr(protocol, 'child_names_cache', None) is None:
+        protocol.child_names_cache = ChildNamesCache()
+    return protocol.child_names_cache
+
+
 class PathCompleter(PositionalCompleter):
     """Completes a path name."""
     baseclass()
@@ -63,21 +123,19 @@ class PathCompleter(PositionalCompleter):
             container = self.context.traverse(base_path)
 
             if IContainer.providedBy(container):
-                def suffix(obj):
-                    if IContainer.providedBy(follow_symlinks(obj)):
-                        return '/'
-                    elif ICommand.providedBy(follow_symlinks(obj)):
-                        return '*'
-                    elif isinstance(obj, Symlink):
-                        return '@'
-                    else:
-                        return ''
+                prefix = token[len(os.path.join(base_path, '')):]
+                names = child_names_cache(self.protocol).names(container)
 
-                def name(obj):
-                    return os.path.join(base_path, obj.__name__)
+                res = []
+                for name in names[bisect_left(names, prefix):]:
+                    if not name.startswith(prefix):
+                        break
+                    res.append(os.path.join(base_path, name))
+                return res
 
-                return [name(obj) + suffix(obj) for obj in container.listcontent()
-                        if name(obj).startswith(token)]
+    @property
+    def protocol(self):
+        return getattr(self.context, 'protocol', None)
 
 
 class CommandCompleter(PathCompleter):
@@ -137,6 +195,10 @@ class KeywordPathSubCompleter(PathCompleter):
             path = self.base_path + path
         return self.original_context.traverse(path)
 
+    @property
+    def protocol(self):
+        return getattr(self.original_context, 'protocol', None)
+
     def expected_action(self, parsed, parser):
         return True
 
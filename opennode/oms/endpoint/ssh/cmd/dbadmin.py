@@ -31,7 +31,7 @@ class DBAdminCat(Cmd):
             try:
                 obj = db.load_object(oid, args.tid)
             except Exception:
-                self.write("No such object: %s\n" % oid)
+                self.fail("No such object: %s\n" % oid)
             else:
                 self._do_dbcat(obj, None)
 
@@ -21,6 +21,7 @@ def get_command(name):
     # upstream? Is this a result of over engineering?
     class UndefinedCommand(Cmd):
         def __call__(self, *args):
+            self.failed = True
             self.terminal.write("No such command: %s\n" % name)
 
             def dist(a, b):
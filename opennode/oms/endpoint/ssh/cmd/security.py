@@ -128,7 +128,7 @@ class PermCheckCmd(Cmd):
     def execute(self, args):
         obj = self.traverse(args.path)
         if not obj:
-            self.write("No such object %s\n" % args.path)
+            self.fail("No such object %s\n" % args.path)
             return
 
         if args.p:
@@ -170,7 +170,7 @@ class GetAclCmd(Cmd):
         for path in args.paths:
             obj = self.traverse(path)
             if not obj:
-                self.write("No such object %s\n" % path)
+                self.fail("No such object %s\n" % path)
                 continue
 
             self._do_print_acl(obj, args.v, args.recursive, [obj])
@@ -231,12 +231,12 @@ class SetAclMixin(object):
 
             prin = auth.getPrincipal(principal)
             if isinstance(prin, Group) and kind == 'u':
-                self.write("No such user '%s', it's a group, perhaps you mean 'g:%s:%s'\n" %
-                           (principal, principal, perms))
+                self.fail("No such user '%s', it's a group, perhaps you mean 'g:%s:%s'\n" %
+                          (principal, principal, perms))
                 return
             elif type(prin) is User and kind == 'g':
-                self.write("No such group '%s', it's a user (%s), perhaps you mean 'u:%s:%s'\n" %
-                           (principal, prin, principal, perms))
+                self.fail("No such group '%s', it's a user (%s), perhaps you mean 'u:%s:%s'\n" %
+                          (principal, prin, principal, perms))
                 return
 
             for perm in perms.strip():
@@ -303,7 +303,7 @@ class SetAclCmd(Cmd, SetAclMixin):
                 with self.protocol.interaction:
                     self.set_acl(obj, args.inherit, args.m, args.d, args.x, recursive=args.recursive)
         except NoSuchPermission as e:
-            self.write("No such permission '%s'\n" % (e.message))
+            self.fail("No such permission '%s'\n" % (e.message))
             transaction.abort()
 
 
@@ -417,7 +417,7 @@ class ChownCmd(Cmd):
         principal = auth.getPrincipal(args.user)
 
         if not principal:
-            self.write('No such user: %s\n' % (args.user))
+            self.fail('No such user: %s\n' % (args.user))
             return
 
         def set_owner(path, level):
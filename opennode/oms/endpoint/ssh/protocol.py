@@ -10,6 +10,7 @@ from twisted.conch.insults.insults import ServerProtocol
 from twisted.internet import defer
 from twisted.python import log
 from zope.security.interfaces import ForbiddenAttribute, Unauthorized
+from zope.security.proxy import removeSecurityProxy
 
 from opennode.oms.config import get_config
 from opennode.oms.endpoint.ssh import cmdline
@@ -17,7 +18,7 @@ from opennode.oms.endpoint.ssh.cmd import registry, completion, commands
 from opennode.oms.endpoint.ssh.colored_columnize import columnize
 from opennode.oms.endpoint.ssh.terminal import InteractiveTerminal, BLUE, CYAN, GREEN, CTRL_C
 from opennode.oms.endpoint.ssh.tokenizer import CommandLineTokenizer, CommandLineSyntaxError
-from opennode.oms.model.model.base import IContainer
+from opennode.oms.model.model.base import IContainer, children_serial, registry_generation
 from opennode.oms.model.model.bin import ICommand
 from opennode.oms.model.model.proc import Proc
 from opennode.oms.security.interaction import new_interaction
@@ -76,9 +77,12 @@ class OmsShellProtocol(InteractiveTerminal):
         self.path = ['']
         self.last_error = None
         self.environment = {'PATH': '.:./actions:/bin'}
+        # ((current directory OID, path), {(PATH, name): (validity token, command class)})
+        self.command_cache = (None, {})
         self.path_stack = []
         self.sub_protocol = None
         self.principal = None
+        self.closed = False
         self.use_security_proxy = get_config().getboolean('auth', 'security_proxy_omsh')
 
         @defer.inlineCallbacks
@@ -104,6 +108,11 @@ class OmsShellProtocol(InteractiveTerminal):
         super(OmsShellProtocol, self).connectionMade()
 
     def close_connection(self):
+        # closing the transport can lead back here, e.g. when `quit` closes a web terminal
+        if self.closed:
+            return
+        self.closed = True
+
         Proc.unregister(self.tid)
         super(OmsShellProtocol, self).close_connection()
 
@@ -138,17 +147,18 @@ class OmsShellProtocol(InteractiveTerminal):
 
     @defer.inlineCallbacks
     def spawn_command(self, line):
+        """Executes a single command line. Returns a deferred firing with False if it failed."""
         line = line.strip()
         try:
             command, cmd_args = yield self.parse_line(line)
         except CommandLineSyntaxError as e:
             self.terminal.write("Syntax error: %s\n" % (e.message))
             self.print_prompt()
-            return
+            defer.returnValue(False)
         except Exception as e:
             log.msg("Got exception parsing '%s'" % (line), system='protocol')
             self.terminal.write(''.join(traceback.format_exception(*sys.exc_info())))
-            return
+            defer.returnValue(False)
 
         try:
             self.sub_protocol = CommandExecutionSubProtocol(self)
@@ -157,9 +167,16 @@ class OmsShellProtocol(InteractiveTerminal):
 
             cmdd = defer.maybeDeferred(command, *cmd_args)
             cmdd.chainDeferred(deferred)
-            yield deferred
+            try:
+                yield deferred
+            finally:
+                # output buffered from worker threads has to precede the prompt
+                command.flush()
+
+            if command.failed:
+                defer.returnValue(False)
         except cmdline.ArgumentParsingError:
-            return
+            defer.returnValue(False)
         except ForbiddenAttribute as e:
             msg = e
             log.err(system='ssh')
@@ -179,6 +196,9 @@ class OmsShellProtocol(InteractiveTerminal):
 
             self.terminal.write("Command returned an unhandled error: %s\n" % e)
             self.terminal.write("type last_error for more details\n")
+        else:
+            defer.returnValue(True)
+        defer.returnValue(False)
 
     def _command_completed(self, *args):
         self.print_prompt()
@@ -207,41 +227,125 @@ class OmsShellProtocol(InteractiveTerminal):
         return command, tokenized_cmd_args
 
     def get_command_class(self, name):
+        """Resolves a command name through $PATH, falling back to the builtin commands.
+
+        Resolutions to builtin commands are cached for the current directory and reused until
+        a directory which was searched has children added or removed.
+
+        """
+        # virtual directories don't have an OID
+        cwd = (self.obj_path[-1], tuple(self.path))
+        if self.command_cache[0] != cwd:
+            self.command_cache = (cwd, {})
+
+        key = (self.environment['PATH'], name)
+        cached = self.command_cache[1].get(key)
+        if cached is not None and self._valid_command_resolution(cached[0]):
+            return cached[1]
+
+        command_cls, serials = self._resolve_command_class(name)
+        if serials is not None:
+            self.command_cache[1][key] = ((registry_generation(), len(registry.commands()), serials),
+                                          command_cls)
+        return command_cls
+
+    def _resolve_command_class(self, name):
+        """Returns the command class and the children serials of the stored containers it depends on.
+
+        The serials are None if the resolution depends on containers which don't have one.
+
+        """
         # NOTE: used to leverage the 'traverse()' method which takes into consideration
         # path handling quirks for relative paths
         dummy = commands.NoCommand(self)
+        serials = {}
         for d in self.environment['PATH'].split(':'):
             effective_dir = name if os.path.isabs(name) else os.path.join(d, name)
             try:
                 command = dummy.traverse(effective_dir)
                 if ICommand.providedBy(command):
-                    return command.cmd
+                    command_cls = command.cmd
+                    serials = self._add_dir_serial(serials, dummy, effective_dir)
+                    # action commands are bound to the model they were resolved from
+                    if registry.commands().get(command_cls.name) is not command_cls:
+                        serials = None
+                    return command_cls, serials
             except ForbiddenAttribute:
-                pass
+                serials = None
             except Unauthorized:
                 # skip command paths where we don't have access
-                pass
+                serials = None
+            else:
+                serials = self._add_dir_serial(serials, dummy, effective_dir)
 
         # NOTE: retained temporarily because it contains inner class
-        return registry.get_command(name)
+        return registry.get_command(name), serials
+
+    def _add_dir_serial(self, serials, dummy, path):
+        if serials is None:
+            return None
+
+        path = os.path.dirname(path)
+        try:
+            directory = dummy.traverse(path)
+            # a missing directory can appear only by modifying its closest existing ancestor
+            while directory is None and path not in ('', '/'):
+                path = os.path.dirname(path)
+                directory = dummy.traverse(path)
+        except (ForbiddenAttribute, Unauthorized):
+            return None
+
+        # transient directories (like bin and actions) derive their content from a stored ancestor
+        directory = removeSecurityProxy(directory)
+        while directory is not None and getattr(directory, '_p_oid', None) is None:
+            directory = directory.__parent__
+
+        serial = children_serial(directory) if directory is not None else None
+        if serial is None:
+            return None
+
+        serials[directory._p_oid] = serial
+        return serials
+
+    def _valid_command_resolution(self, token):
+        generation, command_count, serials = token
+        if (generation, command_count) != (registry_generation(), len(registry.commands())):
+            return False
+
+        for oid, serial in serials.items():
+            try:
+                if children_serial(db.deref(oid)) != serial:
+                    return False
+            except KeyError:
+                return False
+        return True
 
     def expand(self, command, tokens):
         return list(itertools.chain.from_iterable([self.expand_token(command, i) for i in tokens]))
 
     def expand_token(self, command, token):
-        if re.match('.*[*[\]].*', os.path.basename(token)):
-            base = os.path.dirname(token)
+        if not re.match('.*[*[\]].*', token):
+            return [token]
+
+        base, pattern = os.path.split(token)
+        # globs in intermediate components, like `/machines/*/actions`, expand to several bases
+        bases = self.expand_token(command, base) if base != token else [base]
+
+        filtered = []
+        for base in bases:
             current_obj = command.traverse(base)
 
             # Only if intermediate path resolves.
             if current_obj and IContainer.providedBy(current_obj):
-                filtered = [os.path.join(base, i)
-                            for i in fnmatch.filter(current_obj.listnames(), os.path.basename(token))]
-                # Mimic Bash behavior: if expansion doesn't provide results then pass the glob pattern to
-                # the command.
-                if filtered:
-                    return filtered
-        return [token]
+                if re.match('.*[*[\]].*', pattern):
+                    filtered.extend(os.path.join(base, i)
+                                    for i in fnmatch.filter(current_obj.listnames(), pattern))
+                elif not pattern or current_obj[pattern] is not None:
+                    filtered.append(os.path.join(base, pattern))
+
+        # Mimic Bash behavior: if expansion doesn't provide results then pass the glob pattern to
+        # the command.
+        return filtered or [token]
 
     @protocolInlineCallbacks
     def handle_TAB(self):
@@ -327,6 +431,7 @@ class CommandExecutionSubProtocol(object):
     def __init__(self, parent):
         self.parent = parent
         self.buffer = []
+        self.interrupt_handlers = []
 
     def handle_EOF(self):
         pass
@@ -348,6 +453,8 @@ class CommandExecutionSubProtocol(object):
 
         # HACK: poor man's interrupt
         if keyID == CTRL_C:
+            for handler in self.interrupt_handlers:
+                handler()
             return self.parent.exit_sub_protocol()
 
         self.buffer.append((keyID, mod))
@@ -1,13 +1,25 @@
+import json
+from collections import deque
+
 from twisted.conch import interfaces as iconch
 from twisted.conch.manhole_ssh import TerminalSession, TerminalSessionTransport, TerminalRealm, TerminalUser
+from twisted.conch.manhole_ssh import _Glue
 from twisted.conch.ssh.session import SSHSession
 from twisted.conch.insults import insults
 from twisted.internet import defer
+from twisted.internet.error import ProcessDone, ProcessTerminated
+from twisted.python.failure import Failure
 from zope.authentication.interfaces import IAuthentication
 from zope.component import getUtility
 
+from opennode.oms.endpoint.ssh.cmd.base import OutputCapture
 from opennode.oms.endpoint.ssh.protocol import OmsShellProtocol
 from opennode.oms.log import UserLogger
+from opennode.oms.model.model.proc import Proc
+
+
+# `ssh oms omsh --batch < script` runs a script instead of a single command
+BATCH_COMMAND = 'omsh --batch'
 
 
 class BatchOmsShellProtocol(OmsShellProtocol):
@@ -18,8 +30,124 @@ class BatchOmsShellProtocol(OmsShellProtocol):
         pass
 
 
+class ScriptShellProtocol(OmsShellProtocol):
+    """Shell session shared by all the commands of a batch script, used without a terminal."""
+    batch = True
+    enable_colors = False
+    history_save_enabled = False
+
+    def __init__(self, runner):
+        super(ScriptShellProtocol, self).__init__()
+        self.runner = runner
+
+    def print_prompt(self):
+        pass
+
+    def close_connection(self):
+        self.runner.done = True
+
+
+class BatchScriptRunner(object):
+    """Runs an omsh script read from stdin, one command per line, in a single shell session.
+
+    Commands are executed in order without terminal emulation. As soon as a command completes
+    its result is written back as a JSON object on a line of its own, e.g.::
+
+        {"line": 1, "command": "cd /computes", "status": "ok", "output": ""}
+
+    The session ends after the last command, or after `quit`, with a non-zero exit status
+    if any of the commands failed.
+
+    """
+
+    def __init__(self, proto, principal):
+        self.proto = proto
+        self.shell = ScriptShellProtocol(self)
+        self.shell.logged_in(principal)
+
+        self.buffer = ''
+        self.pending = deque()
+        self.lineno = 0
+        self.running = self.eof = self.done = self.finished = self.failed = False
+
+    def dataReceived(self, data):
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        self.pending.extend(lines)
+        self.run()
+
+    def eofReceived(self):
+        if self.buffer:
+            self.pending.append(self.buffer)
+            self.buffer = ''
+        self.eof = True
+        self.run()
+
+    def connectionLost(self):
+        self.pending.clear()
+        self.done = True
+        self.finish(close=False)
+
+    @defer.inlineCallbacks
+    def run(self):
+        if self.running or self.finished:
+            return
+
+        self.running = True
+        try:
+            yield self.shell.ensure_initialized()
+            while self.pending and not self.done:
+                yield self.execute(self.pending.popleft())
+        finally:
+            self.running = False
+
+        if self.done or self.eof:
+            self.finish()
+
+    @defer.inlineCallbacks
+    def execute(self, line):
+        self.lineno += 1
+        line = line.strip()
+        if not line or line.startswith('#'):
+            return
+
+        self.shell.terminal = output = OutputCapture()
+        ok = yield self.shell.spawn_command(line)
+        if not ok:
+            self.failed = True
+
+        if not self.finished:
+            self.proto.write(json.dumps({'line': self.lineno, 'command': line,
+                                         'status': 'ok' if ok else 'error',
+                                         'output': ''.join(output.data)}) + '\n')
+
+    def finish(self, close=True):
+        if self.finished:
+            return
+        self.finished = True
+
+        Proc.unregister(self.shell.tid)
+        if close:
+            # sent back as the exit status of the ssh command
+            if self.failed:
+                self.proto.processEnded(Failure(ProcessTerminated(exitCode=1)))
+            else:
+                self.proto.processEnded(Failure(ProcessDone(None)))
+
+
 class OmsTerminalSession(TerminalSession):
+    batch_runner = None
+
     def execCommand(self, proto, cmd):
+        if cmd.strip() == BATCH_COMMAND:
+            avatar = iconch.IConchUser(self.original)
+            self.batch_runner = runner = BatchScriptRunner(proto, avatar.principal)
+            UserLogger(principal=avatar.principal).log('User logged in')
+            proto.makeConnection(_Glue(write=runner.dataReceived,
+                                       loseConnection=lambda: avatar.conn.sendClose(proto.session),
+                                       name="Batch Script Transport"))
+            return
+
         try:
             chained_protocol = insults.ServerProtocol(BatchOmsShellProtocol)
             self.transportFactory(
@@ -40,6 +168,14 @@ class OmsTerminalSession(TerminalSession):
 
         spawn_command()
 
+    def eofReceived(self):
+        if self.batch_runner:
+            self.batch_runner.eofReceived()
+
+    def closed(self):
+        if self.batch_runner:
+            self.batch_runner.connectionLost()
+
 
 class OmsTerminalSessionTransport(TerminalSessionTransport):
     def __init__(self, proto, chainedProtocol, avatar, width, height):
@@ -3,6 +3,7 @@ import os
 from twisted.web import resource
 
 from opennode.oms.endpoint.webterm.root import TerminalServerMixin, OmsShellTerminalProtocol, SSHClientTerminalProtocol
+from opennode.oms.endpoint.webterm.websocket import is_websocket_request
 
 
 class TerminalServer(resource.Resource, TerminalServerMixin):
@@ -34,6 +35,12 @@ class TerminalServer(resource.Resource, TerminalServerMixin):
         request.responseHeaders.addRawHeader('Access-Control-Allow-Origin', '*')
         return TerminalServerMixin.render_POST(self, request)
 
+    def render_GET(self, request):
+        if not is_websocket_request(request):
+            request.setResponseCode(400)
+            return "Expected a WebSocket upgrade request\n"
+        return self.open_websocket(request)
+
 
 class WebTerminalServer(resource.Resource):
     """ShellInABox web terminal protocol handler."""
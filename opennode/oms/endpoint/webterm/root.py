@@ -2,16 +2,24 @@ import json
 import logging
 import time
 import uuid
+from collections import deque
 
 from grokcore.component import baseclass, context, name
 from twisted.conch.insults.insults import ServerProtocol
 from twisted.internet import reactor
 from twisted.web.server import NOT_DONE_YET
+from zope.component import provideSubscriptionAdapter
+from zope.interface import implements
 
+from opennode.oms.config import get_config
 from opennode.oms.endpoint.httprest.base import HttpRestView
+from opennode.oms.endpoint.httprest.root import BadRequest, ReactorRender
 from opennode.oms.endpoint.ssh.protocol import OmsShellProtocol
 from opennode.oms.endpoint.webterm.ssh import ssh_connect_interactive_shell
+from opennode.oms.endpoint.webterm.websocket import WebSocketProtocol, is_websocket_request, upgrade
 from opennode.oms.model.model.bin import Command
+from opennode.oms.model.model.proc import IProcess, Proc, DaemonProcess
+from opennode.oms.util import subscription_factory
 
 log = logging.getLogger(__name__)
 
@@ -32,6 +40,11 @@ class OmsShellTerminalProtocol(object):
     def handle_key(self, key):
         self.shell.terminal.dataReceived(key)
 
+    def connection_lost(self):
+        # nothing to do if the connection was lost because the shell closed itself
+        if not self.shell.closed:
+            self.shell.close_connection()
+
     def terminalSize(self, width, height):
         # Insults terminal doesn't work well after resizes
         # also disabled in the oms shell over ssh.
@@ -55,8 +68,8 @@ class SSHClientTerminalProtocol(object):
     def connection_made(self, terminal, size):
         self.transport = terminal.transport
 
-        ssh_connect_interactive_shell(self.user, self.host, self.port,
-                                      self.transport, self.set_channel, size)
+        self.shell = ssh_connect_interactive_shell(self.user, self.host, self.port,
+                                                   self.transport, self.set_channel, size)
 
     def set_channel(self, channel):
         self.channel = channel
@@ -65,6 +78,15 @@ class SSHClientTerminalProtocol(object):
     def handle_key(self, key):
         self.channel.write(key)
 
+    def connection_lost(self):
+        shell = getattr(self, 'shell', None)
+        if shell is not None:
+            shell.terminal_lost()
+
+        # closes only this console's channel, the ssh connection stays in the pool
+        if callable(getattr(getattr(self, 'channel', None), 'loseConnection', None)):
+            self.channel.loseConnection()
+
     def terminalSize(self, width, height):
         log.debug('self.channel: %s', self.channel)
         if callable(getattr(self.channel, 'terminalSize', None)):
@@ -78,10 +100,7 @@ class WebTransport(object):
         self.session = session
 
     def write(self, text):
-        # Group together writes so that we reduce the number of http roundtrips.
-        # Kind of Nagle's algorithm.
-        self.session.buffer += text
-        reactor.callLater(0.05, self.session.process_queue)
+        self.session.write(text)
 
     def loseConnection(self):
         """Close the connection ensuring the the web client will properly detect this close.
@@ -91,24 +110,51 @@ class WebTransport(object):
         self.write('\r\n')
 
 
+class WebSocketTransport(object):
+    """Used by WebTerminal to send the data through a WebSocket."""
+
+    def __init__(self, session):
+        self.session = session
+
+    def write(self, text):
+        self.session.write(text)
+
+    def loseConnection(self):
+        self.session.flush()
+        self.session.close()
+
+
 class WebTerminal(ServerProtocol):
     """Used by TerminalProtocols (like OmsShellProtocol) to actually manipulate the terminal."""
 
-    def __init__(self, session):
+    def __init__(self, session, transport=None):
         ServerProtocol.__init__(self)
         self.session = session
-        self.transport = WebTransport(session)
+        self.transport = transport or WebTransport(session)
 
 
 class TerminalSession(object):
-    """A session for our ajax terminal emulator."""
+    """A session for our ajax terminal emulator.
+
+    Terminal output is kept as a deque of byte chunks until a polling request picks it up.
+    Writes are grouped together by a single pending flush timer, and once more than
+    `[webterm] max_buffer_size` bytes are pending the oldest output is dropped.
+
+    """
+
+    # chunk writes because the javascript renderer is very slow
+    # this avoids long pauses to the user.
+    chunk_size = 4000
 
     def __init__(self, terminal_protocol, terminal_size):
         self.id = str(uuid.uuid4())
         self.queue = []
-        self.buffer = ""
+        self.chunks = deque()
+        self.buffered = 0
+        self.flush_call = None
+        self.closed = False
 
-        # TODO: handle session timeouts
+        # time of the last request, used to expire idle sessions
         self.timestamp = time.time()
 
         self.terminal_size = terminal_size
@@ -116,6 +162,68 @@ class TerminalSession(object):
         self.terminal_protocol = terminal_protocol
         self.terminal_protocol.connection_made(WebTerminal(self), terminal_size)
 
+    @property
+    def flush_interval(self):
+        return get_config().getint('webterm', 'flush_interval', 50) / 1000.0
+
+    @property
+    def max_buffer_size(self):
+        return get_config().getint('webterm', 'max_buffer_size', 1048576)
+
+    def touch(self):
+        self.timestamp = time.time()
+
+    def write(self, data):
+        if self.closed or not data:
+            return
+
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        self.chunks.append(data)
+        self.buffered += len(data)
+
+        max_size = self.max_buffer_size
+        if max_size and self.buffered > max_size:
+            self._truncate(max_size)
+
+        # Group together writes so that we reduce the number of http roundtrips.
+        # Kind of Nagle's algorithm.
+        if self.flush_call is None:
+            self.flush_call = reactor.callLater(self.flush_interval, self.process_queue)
+
+    def _truncate(self, max_size):
+        """Drops the oldest output, nobody is polling for it."""
+        log.debug('TerminalSession %s dropping %s bytes of output', self.id, self.buffered - max_size)
+        while self.buffered - len(self.chunks[0]) >= max_size:
+            self.buffered -= len(self.chunks.popleft())
+        if self.buffered > max_size:
+            self.chunks[0] = self.chunks[0][self.buffered - max_size:]
+            self.buffered = max_size
+
+    def read(self, size):
+        """Removes and returns up to `size` bytes of output, never splitting a utf-8 sequence."""
+        data = []
+        while self.chunks and size > 0:
+            chunk = self.chunks.popleft()
+            if len(chunk) > size:
+                cut = size
+                while cut > 0 and 0x80 <= ord(chunk[cut]) < 0xc0:
+                    cut -= 1
+                if cut == 0:
+                    if data:
+                        self.chunks.appendleft(chunk)
+                        break
+                    cut = size
+                self.chunks.appendleft(chunk[cut:])
+                chunk = chunk[:cut]
+            data.append(chunk)
+            size -= len(chunk)
+
+        data = ''.join(data)
+        self.buffered -= len(data)
+        return data
+
     def parse_keys(self, key_stream):
         """The ajax protocol encodes keystrokes as a string of hex bytes,
         so each char code occupies to characters in the encoded form."""
@@ -137,37 +245,129 @@ class TerminalSession(object):
         pass
 
     def enqueue(self, request):
-        request.notifyFinish().addErrback(self._responseFailed, len(self.queue))
+        request.notifyFinish().addErrback(self._responseFailed, request)
         self.queue.append(request)
-        if self.buffer:
+        if self.buffered:
             self.process_queue()
 
-    def _responseFailed(self, e, i):
+    def _responseFailed(self, e, request):
         log.debug('Client disconnected. Cancelling request')
-        del self.queue[i]
+        if request in self.queue:
+            self.queue.remove(request)
 
     def process_queue(self):
+        if self.flush_call is not None:
+            if self.flush_call.active():
+                self.flush_call.cancel()
+            self.flush_call = None
+
         # Only one ongoing polling request should be live.
         # But I'm not sure if this can be guaranteed so let's keep them all temporarily.
-        for r in self.queue:
+        queue, self.queue = self.queue, []
+        for r in queue:
             self.flush(r)
-        self.queue = []
 
     def flush(self, request):
-        # chunk writes because the javascript renderer is very slow
-        # this avoids long pauses to the user.
-        chunk_size = 4000
-        unicode_buffer = self.buffer.decode('utf-8')
-        chunk = unicode_buffer[0:chunk_size]
+        chunk = self.read(self.chunk_size).decode('utf-8', 'replace')
 
         log.debug('TerminalSession %s writing: "%s"', self.id, chunk)
         request.write(json.dumps(dict(session=self.id, data=chunk)))
         request.finish()
 
-        self.buffer = unicode_buffer[chunk_size:].encode('utf-8')
+    def close(self):
+        """Disconnects the terminal protocol and discards any pending output."""
+        if self.closed:
+            return
+
+        self.closed = True
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+        self.chunks.clear()
+        self.buffered = 0
+
+        # let pending polls notice that the session is gone
+        queue, self.queue = self.queue, []
+        for r in queue:
+            r.write(json.dumps(dict(session='', data='')))
+            r.finish()
+
+        connection_lost = getattr(self.terminal_protocol, 'connection_lost', None)
+        if connection_lost is not None:
+            connection_lost()
 
     def __repr__(self):
-        return 'TerminalSession(%s, %s, %s, %s)' % (self.id, self.queue, self.buffer, self.timestamp)
+        return 'TerminalSession(%s, %s, %s, %s)' % (self.id, self.queue, self.buffered, self.timestamp)
+
+
+class WebSocketTerminalSession(WebSocketProtocol):
+    """A web terminal session over a WebSocket.
+
+    Binary messages carry the raw terminal input and output. Text messages from the client
+    carry JSON control messages, currently only `{"resize": [width, height]}`.
+
+    """
+
+    def __init__(self, terminal_protocol, terminal_size):
+        self.terminal_protocol = terminal_protocol
+        self.terminal_size = terminal_size
+        self.chunks = []
+        self.flush_call = None
+
+    def connectionMade(self):
+        WebSocketProtocol.connectionMade(self)
+        self.terminal_protocol.connection_made(WebTerminal(self, WebSocketTransport(self)), self.terminal_size)
+
+    def write(self, data):
+        if self.closing or not data:
+            return
+
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.chunks.append(data)
+
+        # a single frame for all the output written while handling the same input
+        if self.flush_call is None:
+            self.flush_call = reactor.callLater(0, self.flush)
+
+    def flush(self):
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+
+        data, self.chunks = ''.join(self.chunks), []
+        if data:
+            self.sendMessage(data)
+
+    def messageReceived(self, message, binary):
+        if binary:
+            self.terminal_protocol.handle_key(message)
+            return
+
+        try:
+            width, height = json.loads(message)['resize']
+        except (ValueError, KeyError, TypeError):
+            log.debug('Ignoring web terminal control message: %s', message)
+            return
+
+        if self.terminal_size != (width, height):
+            self.terminal_size = (width, height)
+            self.terminal_protocol.terminalSize(width, height)
+
+    def windowChanged(self, *args):
+        """Called back by insults on terminalSize."""
+        pass
+
+    def connectionLost(self, reason):
+        WebSocketProtocol.connectionLost(self, reason)
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+        self.chunks = []
+
+        connection_lost = getattr(self.terminal_protocol, 'connection_lost', None)
+        if connection_lost is not None:
+            connection_lost()
 
 
 class TerminalServerMixin(object):
@@ -196,6 +396,7 @@ class TerminalServerMixin(object):
             return json.dumps(dict(session='', data=''))
 
         session = self.sessions[session_id]
+        session.touch()
         session.handle_resize(size)
 
         # There are two types of requests:
@@ -210,6 +411,11 @@ class TerminalServerMixin(object):
         session.enqueue(request)
         return NOT_DONE_YET
 
+    def open_websocket(self, request):
+        """Serves the terminal over a WebSocket instead of long polling, see `WebSocketTerminalSession`."""
+        size = (int(request.args.get('width', ['80'])[0]), int(request.args.get('height', ['24'])[0]))
+        return upgrade(request, WebSocketTerminalSession(self.get_terminal_protocol(request), size))
+
     def get_terminal_protocol(self, request):
         protocol = self.terminal_protocol
         protocol.logged_in(request.interaction.participations[0].principal)
@@ -219,6 +425,12 @@ class TerminalServerMixin(object):
 class ConsoleView(HttpRestView, TerminalServerMixin):
     baseclass()
 
+    def render_GET(self, request):
+        if not is_websocket_request(request):
+            raise BadRequest('Expected a WebSocket upgrade request')
+        # the connection is taken over in the reactor thread, after the view's transaction
+        return ReactorRender(self.open_websocket, request)
+
 
 class OmsShellConsoleView(ConsoleView):
     context(Command)
@@ -229,3 +441,27 @@ class OmsShellConsoleView(ConsoleView):
         # TODO: pass the self.context.cmd so that we can execute this particular command
         # instead of hardcoding the oms shell.
         return OmsShellTerminalProtocol()
+
+
+class WebTerminalReaperDaemonProcess(DaemonProcess):
+    """Closes web terminal sessions which haven't been polled for `[webterm] session_timeout` seconds."""
+    implements(IProcess)
+
+    __name__ = "webterm_reaper"
+
+    interval = 60
+
+    def execute(self):
+        timeout = get_config().getint('webterm', 'session_timeout', 1800)
+        if not timeout:
+            return
+
+        now = time.time()
+        for session_id, session in TerminalServerMixin.sessions.items():
+            if not session.queue and now - session.timestamp > timeout:
+                log.info('Closing idle web terminal session %s', session_id)
+                del TerminalServerMixin.sessions[session_id]
+                session.close()
+
+
+provideSubscriptionAdapter(subscription_factory(WebTerminalReaperDaemonProcess), adapts=(Proc,))
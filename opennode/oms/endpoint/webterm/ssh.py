@@ -1,10 +1,13 @@
 import logging
 import os
+from collections import defaultdict
 
 from twisted.conch.ssh import transport, keys, userauth
 from twisted.conch.ssh import connection, channel, session, common
 from twisted.internet import defer, reactor, protocol
 
+from opennode.oms.config import get_config
+
 log = logging.getLogger(__name__)
 
 
@@ -12,36 +15,88 @@ def ssh_connect_interactive_shell(user, host, port, transport, set_channel,
                                   size, command=None):
     if host == '0.0.0.0':
         raise Exception("invalid ip address '%s'" % host)
-    protocol.ClientCreator(reactor, SSHClientTransport, transport, set_channel,
-                           size, user, host, command).connectTCP(host, port)
+    channel = ShellChannel(transport, set_channel, size, command)
+    connection_pool.open_channel(user, host, port, channel)
+    return channel
+
+
+class SSHConnectionPool(object):
+    """Authenticated ssh client connections keyed by (user, host, port), shared by web consoles.
+
+    A console opens a new session channel on an existing connection when one has room for it,
+    so only the first console to a host pays for the handshake. Connections authenticated with
+    a password typed in a console are never shared.
+
+    """
+
+    def __init__(self):
+        self.connections = defaultdict(list)
+
+    @property
+    def max_channels(self):
+        return get_config().getint('webterm', 'ssh_max_channels_per_connection', 10)
+
+    @property
+    def max_connections(self):
+        return get_config().getint('webterm', 'ssh_max_connections_per_host', 4)
+
+    @property
+    def idle_timeout(self):
+        return get_config().getint('webterm', 'ssh_idle_timeout', 300)
+
+    def open_channel(self, user, host, port, channel):
+        key = (user, host, port)
+
+        candidates = [conn for conn in self.connections[key]
+                      if conn.shared and conn.channel_count() < self.max_channels]
+        if candidates:
+            conn = min(candidates, key=lambda conn: conn.channel_count())
+        elif self.host_connections(host, port) >= self.max_connections:
+            log.info('Too many ssh connections to %s:%s', host, port)
+            channel.terminal_transport.write('Too many ssh connections to %s\r\n' % host)
+            channel.terminal_transport.loseConnection()
+            return
+        else:
+            conn = SSHShellConnection(self, key)
+            self.connections[key].append(conn)
+            d = protocol.ClientCreator(reactor, SSHClientTransport, conn, user, host).connectTCP(host, port)
+
+            @d.addErrback
+            def connect_failed(failure, conn=conn):
+                log.info('Cannot connect to %s:%s: %s', host, port, failure.getErrorMessage())
+                conn.connection_lost()
+
+        conn.add_channel(channel)
+
+    def host_connections(self, host, port):
+        return sum(len(conns) for (user, h, p), conns in self.connections.items() if (h, p) == (host, port))
+
+    def remove(self, conn):
+        conns = self.connections.get(conn.key, [])
+        if conn in conns:
+            conns.remove(conn)
+        if not conns:
+            self.connections.pop(conn.key, None)
 
 
 class SSHClientTransport(transport.SSHClientTransport):
     """Performs a SSH connection to a server."""
 
-    def __init__(self, terminal_transport, set_channel, terminal_size,
-                 user, host, command):
-        self.terminal_transport = terminal_transport
-        self.set_channel = set_channel
-        self.terminal_size = terminal_size
+    def __init__(self, conn, user, host):
+        self.conn = conn
         self.user = user
         self.host = host
-        self.command = command
 
     def verifyHostKey(self, pubKey, fingerprint):
         # TODO: check fingerprints?
         return defer.succeed(1)
 
     def connectionSecure(self):
-        self.requestService(ClientUserAuth(self.user,
-                                           SSHShellConnection(self.terminal_transport,
-                                                              self.set_channel,
-                                                              self.terminal_size,
-                                                              self.command)))
+        self.requestService(ClientUserAuth(self.user, self.conn))
 
     def connectionLost(self, reason):
         transport.SSHClientTransport.connectionLost(self, reason)
-        self.terminal_transport.loseConnection()
+        self.conn.connection_lost()
 
 
 class ClientUserAuth(userauth.SSHUserAuthClient):
@@ -103,7 +158,12 @@ class ClientUserAuth(userauth.SSHUserAuthClient):
 
         """
 
-        terminal = self.transport.terminal_transport
+        # the password is typed in the console which opened the connection,
+        # so the connection can't be shared with other consoles anymore
+        channel = self.instance.pending[0]
+        self.instance.make_private()
+
+        terminal = channel.terminal_transport
         # self.transport.host is stored as a unicode object and Twisted conch
         # doesn't like it
         prompt = u"%s@%s's password: " % (self.user, self.transport.host)
@@ -125,27 +185,88 @@ class ClientUserAuth(userauth.SSHUserAuthClient):
                 else:
                     self.password += ch
 
-        self.transport.set_channel(PasswordReader())
+        channel.set_channel(PasswordReader())
         return deferred_password
 
 
 class SSHShellConnection(connection.SSHConnection):
-    """Represents a SSH client connection opening a interactive remote
-    shell.
+    """Represents a SSH client connection carrying the interactive remote
+    shells of web consoles.
+
+    Channels added before the connection is authenticated are opened once
+    it is. When its last channel closes the connection is kept in the pool
+    for `[webterm] ssh_idle_timeout` seconds.
 
     """
 
-    def __init__(self, terminal_transport, set_channel, terminal_size,
-                 command):
+    def __init__(self, pool, key):
         connection.SSHConnection.__init__(self)
 
-        self.terminal_transport = terminal_transport
-        self.set_channel = set_channel
-        self.terminal_size = terminal_size
-        self.command = command
+        self.pool = pool
+        self.key = key
+        self.pending = []
+        self.started = False
+        self.shared = True
+        self.idle_call = None
+
+    def channel_count(self):
+        return len(self.pending) + len(self.channels)
+
+    def add_channel(self, channel):
+        self._cancel_idle()
+        channel.conn = self
+        if self.started:
+            self.openChannel(channel)
+        else:
+            self.pending.append(channel)
+
+    def remove_pending(self, channel):
+        """Forgets a channel whose console was closed before the connection was authenticated."""
+        if channel in self.pending:
+            self.pending.remove(channel)
+            self.channel_done(channel)
+
+    def make_private(self):
+        """Keeps only the first pending channel, the others go to other connections."""
+        self.shared = False
+        channels, self.pending = self.pending[1:], self.pending[:1]
+        for channel in channels:
+            self.pool.open_channel(self.key[0], self.key[1], self.key[2], channel)
 
     def serviceStarted(self):
-        self.openChannel(ShellChannel(conn=self))
+        connection.SSHConnection.serviceStarted(self)
+        self.started = True
+
+        # consoles closed in the meantime have no reader for their remote shell
+        pending, self.pending = self.pending, []
+        for channel in pending:
+            if not channel.terminal_closed:
+                self.openChannel(channel)
+
+        self.channel_done(None)
+
+    def channel_done(self, channel):
+        if self.channel_count() or self.transport is None:
+            return
+
+        timeout = self.pool.idle_timeout
+        if not self.shared or not timeout:
+            self.transport.loseConnection()
+        else:
+            self.idle_call = reactor.callLater(timeout, self.transport.loseConnection)
+
+    def connection_lost(self):
+        self._cancel_idle()
+        self.pool.remove(self)
+
+        pending, self.pending = self.pending, []
+        for channel in pending:
+            channel.terminal_transport.loseConnection()
+
+    def _cancel_idle(self):
+        if self.idle_call is not None and self.idle_call.active():
+            self.idle_call.cancel()
+        self.idle_call = None
 
 
 class ShellChannel(channel.SSHChannel):
@@ -153,30 +274,49 @@ class ShellChannel(channel.SSHChannel):
 
     """
     name = 'session'
+    terminal_closed = False
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, terminal_transport, set_channel, terminal_size, command=None, **kwargs):
         # Super is old-style class
-        channel.SSHChannel.__init__(self, *args, **kwargs)
-        self.terminal_transport = self.conn.terminal_transport
+        channel.SSHChannel.__init__(self, **kwargs)
+        self.terminal_transport = terminal_transport
+        self.set_channel = set_channel
+        self.terminal_size = terminal_size
+        self.command = command
+
+    def terminal_lost(self):
+        """Called when the console of this channel is closed."""
+        self.terminal_closed = True
+        if self.conn is not None:
+            self.conn.remove_pending(self)
 
     def channelOpen(self, data):
-        self.conn.set_channel(self)
+        if self.terminal_closed:
+            self.loseConnection()
+            return
+
+        self.set_channel(self)
 
         data = session.packRequest_pty_req('xterm-color',
-                                           (self.conn.terminal_size[1],
-                                            self.conn.terminal_size[0], 0, 0),
+                                           (self.terminal_size[1],
+                                            self.terminal_size[0], 0, 0),
                                            '')
         deferred = self.conn.sendRequest(self, 'pty-req', data, wantReply=1)
 
         @deferred
         def on_success(ignored):
-            if self.conn.command:
+            if self.command:
                 self.conn.sendRequest(self, 'exec',
-                                      common.NS(str(self.conn.command)),
+                                      common.NS(str(self.command)),
                                       wantReply=1)
             else:
                 self.conn.sendRequest(self, 'shell', '', wantReply=1)
 
+    def openFailed(self, reason):
+        log.info('Opening ssh channel failed: %s', reason)
+        self.terminal_transport.loseConnection()
+        self.conn.channel_done(self)
+
     def dataReceived(self, data):
         if self.terminal_transport:
             self.terminal_transport.write(data)
@@ -184,7 +324,11 @@ class ShellChannel(channel.SSHChannel):
     def closed(self):
         self.terminal_transport.loseConnection()
         self.loseConnection()
+        self.conn.channel_done(self)
 
     def terminalSize(self, width, height):
         data = session.packRequest_window_change((height, width, 0, 0))
         self.conn.sendRequest(self, 'window-change', data, wantReply=0)
+
+
+connection_pool = SSHConnectionPool()
@@ -0,0 +1,200 @@
+"""Server side of the WebSocket protocol (RFC 6455), on top of twisted.web requests."""
+import base64
+import hashlib
+import struct
+
+from twisted.internet import protocol
+from twisted.python import log
+from twisted.web.server import NOT_DONE_YET
+
+
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xa
+
+
+class WebSocketError(Exception):
+    """The peer violated the WebSocket protocol; carries the close status code to send."""
+
+    def __init__(self, msg, code=1002):
+        super(WebSocketError, self).__init__(msg)
+        self.code = code
+
+
+def is_websocket_request(request):
+    connection = [i.strip().lower() for i in (request.getHeader('connection') or '').split(',')]
+    return ((request.getHeader('upgrade') or '').lower() == 'websocket' and 'upgrade' in connection and
+            request.getHeader('sec-websocket-version') == '13' and
+            bool(request.getHeader('sec-websocket-key')))
+
+
+def accept_key(key):
+    return base64.b64encode(hashlib.sha1(key + GUID).digest())
+
+
+def unmask(data, mask):
+    if not data:
+        return data
+    key = (mask * (len(data) // 4 + 1))[:len(data)]
+    return ('%0*x' % (2 * len(data), int(data.encode('hex'), 16) ^ int(key.encode('hex'), 16))).decode('hex')
+
+
+def upgrade(request, ws_protocol):
+    """Completes the opening handshake of a WebSocket `request` and hands its connection to `ws_protocol`.
+
+    The http request is never finished, so this returns NOT_DONE_YET.
+
+    """
+    assert is_websocket_request(request)
+
+    channel = request.channel
+    transport = channel.transport
+    transport.write('HTTP/1.1 101 Switching Protocols\r\n'
+                    'Upgrade: websocket\r\n'
+                    'Connection: Upgrade\r\n'
+                    'Sec-WebSocket-Accept: %s\r\n\r\n' % accept_key(request.getHeader('sec-websocket-key')))
+
+    # from now on the connection is ours, not of the http channel
+    if hasattr(transport, 'wrappedProtocol'):
+        transport.wrappedProtocol = ws_protocol
+    else:
+        transport.protocol = ws_protocol
+    ws_protocol.http_channel = channel
+    ws_protocol.makeConnection(transport)
+    return NOT_DONE_YET
+
+
+class WebSocketProtocol(protocol.Protocol):
+    """A server side WebSocket connection.
+
+    Whole messages, reassembled from fragments, are passed to `messageReceived`; text messages
+    are decoded to unicode. Messages larger than `max_message_size` bytes close the connection.
+
+    """
+
+    max_message_size = 1 << 20
+    http_channel = None
+
+    def connectionMade(self):
+        self.closing = False
+        self._buffer = ''
+        self._fragments = []
+        self._fragments_size = 0
+        self._opcode = None
+
+    def messageReceived(self, message, binary):
+        """Subclasses override this to handle incoming messages."""
+
+    def sendMessage(self, data, binary=True):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self._send_frame(OP_BINARY if binary else OP_TEXT, data)
+
+    def close(self, code=1000, reason=''):
+        if self.closing:
+            return
+        self._send_frame(OP_CLOSE, struct.pack('!H', code) + reason)
+        self.closing = True
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.closing = True
+        # lets the http request which opened the connection clean up
+        if self.http_channel is not None:
+            self.http_channel.connectionLost(reason)
+
+    def dataReceived(self, data):
+        self._buffer += data
+        try:
+            while not self.closing and self._parse_frame():
+                pass
+        except WebSocketError as e:
+            log.msg('Closing WebSocket connection: %s' % e, system='websocket')
+            self.close(e.code)
+
+    def _parse_frame(self):
+        buf = self._buffer
+        if len(buf) < 2:
+            return False
+
+        b0, b1 = ord(buf[0]), ord(buf[1])
+        offset, length = 2, b1 & 0x7f
+        if length == 126:
+            if len(buf) < 4:
+                return False
+            length, = struct.unpack('!H', buf[2:4])
+            offset = 4
+        elif length == 127:
+            if len(buf) < 10:
+                return False
+            length, = struct.unpack('!Q', buf[2:10])
+            offset = 10
+
+        if not b1 & 0x80:
+            raise WebSocketError('unmasked client frame')
+        if self._fragments_size + length > self.max_message_size:
+            raise WebSocketError('message too large', code=1009)
+
+        if len(buf) < offset + 4 + length:
+            return False
+
+        mask = buf[offset:offset + 4]
+        payload = unmask(buf[offset + 4:offset + 4 + length], mask)
+        self._buffer = buf[offset + 4 + length:]
+
+        self._frame_received(bool(b0 & 0x80), b0 & 0x0f, payload)
+        return True
+
+    def _frame_received(self, fin, opcode, payload):
+        if opcode >= OP_CLOSE:
+            if not fin or len(payload) > 125:
+                raise WebSocketError('invalid control frame')
+            if opcode == OP_CLOSE:
+                self.close(struct.unpack('!H', payload[:2])[0] if len(payload) >= 2 else 1000)
+            elif opcode == OP_PING:
+                self._send_frame(OP_PONG, payload)
+            return
+
+        if opcode == OP_CONTINUATION:
+            if self._opcode is None:
+                raise WebSocketError('unexpected continuation frame')
+        elif opcode in (OP_TEXT, OP_BINARY):
+            if self._opcode is not None:
+                raise WebSocketError('expected a continuation frame')
+            self._opcode = opcode
+        else:
+            raise WebSocketError('unknown opcode %s' % opcode)
+
+        self._fragments.append(payload)
+        self._fragments_size += len(payload)
+        if not fin:
+            return
+
+        message, binary = ''.join(self._fragments), self._opcode == OP_BINARY
+        self._fragments, self._fragments_size, self._opcode = [], 0, None
+
+        if not binary:
+            try:
+                message = message.decode('utf-8')
+            except UnicodeDecodeError:
+                raise WebSocketError('invalid utf-8 text message', code=1007)
+
+        self.messageReceived(message, binary)
+
+    def _send_frame(self, opcode, payload):
+        if self.closing:
+            return
+
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        self.transport.write(header + payload)
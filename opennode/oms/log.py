@@ -2,9 +2,11 @@ import logging
 import logging.config
 import os
 import re
+import threading
 
-from Queue import Queue, Empty
+from collections import deque
 
+from twisted.internet import defer, reactor
 from twisted.python import log
 from zope.component import getUtility
 from zope.authentication.interfaces import IAuthentication
@@ -181,11 +183,22 @@ def get_config_filenames():
 
 
 class UserEventLogZODBHandler(logging.Handler):
-    """ Python logging handler to store log records into ZODB UserEventLog containers """
+    """Python logging handler to store log records into ZODB UserEventLog containers.
+
+    Records are queued without ever blocking the logging call site; a single writer stores
+    everything queued so far, for all users, in one transaction at most every
+    `user_eventlog_flush_interval` milliseconds.
+
+    """
 
     def __init__(self):
         logging.Handler.__init__(self)
-        self.queue = Queue(16)
+        config = get_config()
+        self.flush_interval = config.getint('logging', 'user_eventlog_flush_interval', 500) / 1000.0
+        # oldest records are dropped if the writer cannot keep up
+        self.queue = deque(maxlen=config.getint('logging', 'user_eventlog_queue_size', 10000))
+        self.flush_pending = False
+        self.flush_lock = threading.Lock()
         self.setFormatter(logging.Formatter('%(asctime)s'))
 
     def emit(self, record):
@@ -194,23 +207,40 @@ class UserEventLogZODBHandler(logging.Handler):
 
         self.format(record)
         assert hasattr(record, 'asctime'), str(record)
-        self.queue.put(record)
-
-        @db.transact
-        def flush():
-            eventlog = db.get_root()['oms_root']['eventlog']
-            try:
-                while True:
-                    if self.queue.empty():
-                        break
-                    record = self.queue.get_nowait()
-                    eventlog.add_event(record)
-            except Empty:
-                pass
-
-        if not self.queue.empty():
-            d = flush()
-            d.addErrback(log.err, system='usereventlog-handler')
+        self.queue.append(record)
+
+        with self.flush_lock:
+            if self.flush_pending:
+                return
+            self.flush_pending = True
+
+        reactor.callFromThread(reactor.callLater, self.flush_interval, self.write_queued)
+
+    @defer.inlineCallbacks
+    def write_queued(self):
+        records = []
+        try:
+            while True:
+                records.append(self.queue.popleft())
+        except IndexError:
+            pass
+
+        try:
+            if records:
+                yield self.write(records)
+        except Exception:
+            log.err(system='usereventlog-handler')
+        finally:
+            with self.flush_lock:
+                self.flush_pending = bool(self.queue)
+            if self.flush_pending:
+                reactor.callLater(self.flush_interval, self.write_queued)
+
+    @db.transact
+    def write(self, records):
+        eventlog = db.get_root()['oms_root']['eventlog']
+        for record in records:
+            eventlog.add_event(record)
 
 
 class UserLogger(object):
@@ -5,10 +5,11 @@ import logging
 from uuid import uuid4
 
 from BTrees.OOBTree import OOBTree
-from grokcore.component import Subscription, querySubscriptions, baseclass
+from grokcore.component import Subscription, baseclass
 from zope import schema
 from zope.annotation.interfaces import IAttributeAnnotatable
-from zope.interface import alsoProvides, noLongerProvides
+from zope.component import getSiteManager
+from zope.interface import alsoProvides, noLongerProvides, providedBy
 from zope.interface import implements, directlyProvidedBy, Interface, Attribute
 from zope.interface.interface import InterfaceClass
 from zope.schema.interfaces import IContextSourceBinder
@@ -281,6 +282,76 @@ class ContainerInjector(Subscription):
         return {self.__class__.__dict__['__name__']: self.__class__()}
 
 
+# (container class, provided interfaces, subscription interface) -> factories, for `_subscription_generation`
+_subscription_factories = {}
+_subscription_generation = None
+
+
+def registry_generation():
+    # bumped by zope.interface whenever a component is (un)registered, e.g. when plugins are grokked
+    return getSiteManager().adapters._generation
+
+
+def children_serial(container):
+    """Returns a token which changes whenever children are added to or removed from `container`.
+
+    Only containers whose children are all stored in their `_items` BTree have one,
+    for the others None is returned.
+
+    """
+    container = removeSecurityProxy(container)
+    items = getattr(container, '_items', None)
+    if (getattr(container, '_p_oid', None) is None or not isinstance(items, OOBTree) or
+            not isinstance(container, ReadonlyContainer) or container._overrides_content()):
+        return None
+
+    # an invalidated ghost keeps its old serial until it's loaded again
+    container._p_activate()
+    items._p_activate()
+
+    # children of larger BTrees are stored in separate buckets
+    serials = [container._p_serial, items._p_serial, registry_generation()]
+    bucket = items._firstbucket
+    while bucket is not None:
+        bucket._p_activate()
+        serials.append(bucket._p_serial)
+        bucket = bucket._next
+
+    return tuple(serials)
+
+
+def container_subscriptions(container, interface):
+    """Returns the `interface` subscriptions (injectors or extenders) applicable to `container`.
+
+    The factories are resolved once per container class and provided interfaces, taking
+    their `__interfaces__` filter into account, and cached until the registry changes.
+
+    """
+    global _subscription_generation
+
+    registry = getSiteManager().adapters
+    generation = registry._generation
+    if generation != _subscription_generation:
+        # entries of older registry generations would never be used again
+        _subscription_factories.clear()
+        _subscription_generation = generation
+
+    provided = providedBy(container)
+    key = (type(container), tuple(provided), interface)
+
+    factories = _subscription_factories.get(key)
+    if factories is None:
+        def applicable(factory):
+            interface_filter = getattr(factory, '__interfaces__', [])
+            return not interface_filter or any(provided.isOrExtends(i) for i in interface_filter)
+
+        factories = filter(applicable, registry.subscriptions((provided, ), interface))
+        if generation == _subscription_generation:
+            _subscription_factories[key] = factories
+
+    return filter(None, [factory(container) for factory in factories])
+
+
 class ReadonlyContainer(Model):
     """A container whose items cannot be modified, i.e. are predefined."""
     implements(IContainer)
@@ -294,13 +365,25 @@ class ReadonlyContainer(Model):
                      ))
 
     def __getitem__(self, key):
-        return self.content().get(key)
+        if self._overrides_content():
+            return self.content().get(key)
+
+        # like in `content`, extensions take precedence over stored items
+        item = None
+        for children in self._extensions():
+            if key in children:
+                item = children[key]
+        if item is not None:
+            return item
+
+        self._inject()
+        return self._items.get(key)
 
     def listnames(self):
-        return self.content().keys()
+        return [name for name, item in self._iteritems()]
 
     def listcontent(self):
-        return self.content().values()
+        return [item for name, item in self._iteritems()]
 
     def __iter__(self):
         return iter(self.listcontent())
@@ -311,33 +394,60 @@ class ReadonlyContainer(Model):
 
     @exception_logger
     def content(self):
-        injectors = querySubscriptions(self, IContainerInjector)
-        for injector in injectors:
-            interface_filter = getattr(injector, '__interfaces__', [])
-            if interface_filter and not any(map(lambda i: i.providedBy(self), interface_filter)):
-                continue
+        self._inject()
+
+        items = dict(**self._items)
+        for children in self._extensions():
+            items.update(children)
+
+        return items
+
+    def _overrides_content(self):
+        # subclasses computing their children in `content` have to be served through it
+        return type(self).content.__func__ is not ReadonlyContainer.content.__func__
+
+    def _iteritems(self):
+        if self._overrides_content():
+            return self.content().iteritems()
+
+        self._inject()
 
+        # `_items` can be computed on each access, read it only once
+        items = self._items
+        extensions = {}
+        for children in self._extensions():
+            extensions.update(children)
+
+        result = [(name, item) for name, item in items.iteritems() if name not in extensions]
+        result.extend(extensions.iteritems())
+        return iter(result)
+
+    def _inject(self):
+        # injected items can be lost if the transaction storing them is aborted
+        items = self._items
+        generation, names = getattr(self, '_v_injected', (None, ()))
+        if generation == registry_generation() and all(k in items for k in names):
+            return
+
+        names = []
+        for injector in container_subscriptions(self, IContainerInjector):
             for k, v in injector.inject().items():
-                if k not in self._items:
+                names.append(k)
+                if k not in items:
                     v.__parent__ = self
-                    self._items[k] = v
-
-        items = dict(**self._items)
+                    items[k] = v
 
-        extenders = querySubscriptions(self, IContainerExtender)
-        for extender in extenders:
-            interface_filter = getattr(extender, '__interfaces__', [])
-            if interface_filter and not any(map(lambda i: i.providedBy(self), interface_filter)):
-                continue
+        self._v_injected = (registry_generation(), names)
 
+    def _extensions(self):
+        """Yields the transient children provided by each container extender."""
+        for extender in container_subscriptions(self, IContainerExtender):
             children = extender.extend()
             for v in children.values():
                 v.__parent__ = self
                 v.__transient__ = True
                 v.inherit_permissions = True
-            items.update(children)
-
-        return items
+            yield children
 
     _items = {}
 
@@ -375,7 +485,7 @@ class AddingContainer(ReadonlyContainer):
 
         if not hasattr(self, '__suppress_events'):
             if old_parent is not None and old_parent is not self:
-                handle(item, ModelMovedEvent(item.__parent__, self))
+                handle(item, ModelMovedEvent(old_parent, self))
             else:
                 handle(item, ModelCreatedEvent(self))
         return res
@@ -385,6 +495,9 @@ class AddingContainer(ReadonlyContainer):
         del self._items[old_name]
         self._items[new_name].__name__ = new_name
 
+        if not hasattr(self, '__suppress_events'):
+            handle(self._items[new_name], ModelMovedEvent(self, self))
+
 
 class Container(AddingContainer):
     """A base class for containers whose items are named by their __name__.
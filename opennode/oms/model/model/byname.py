@@ -1,16 +1,92 @@
 from __future__ import absolute_import
 
-from grokcore.component import Subscription, baseclass
+from grokcore.component import Subscription, baseclass, subscribe
 from zope.interface import implements
+from zope.security.proxy import removeSecurityProxy
 
-from .base import IContainerExtender, ReadonlyContainer, IDisplayName
+from .base import IContainerExtender, ReadonlyContainer, IDisplayName, IModel, children_serial
+from .events import IModelCreatedEvent, IModelDeletedEvent, IModelMovedEvent, IModelModifiedEvent
 from .symlink import Symlink, follow_symlinks
 
 
+class ByNameIndex(object):
+    """Maps the display names of the children of a container to their OIDs and back.
+
+    `serial` is the children serial of the container when the index was last brought up to date.
+    Containers without one (like virtual containers) get an index valid only in the transaction
+    `txn` which built it.
+
+    """
+
+    def __init__(self, serial, txn):
+        self.serial = serial
+        self.txn = txn
+        self.names = {}
+        self.oids = {}
+
+    def valid(self, serial, txn):
+        if self.serial is None:
+            return self.txn is txn
+        return self.serial == serial
+
+    def add(self, name, oid):
+        self.remove(oid)
+        self.names[name] = oid
+        self.oids[oid] = name
+
+    def remove(self, oid):
+        name = self.oids.pop(oid, None)
+        if name is not None and self.names.get(name) == oid:
+            del self.names[name]
+            # another child might share the same display name
+            for other_oid, other_name in self.oids.iteritems():
+                if other_name == name:
+                    self.names[name] = other_oid
+                    break
+
+
+def _indexes_for(jar):
+    """Returns the {container OID: ByNameIndex} of a connection, which one thread uses at a time."""
+    indexes = getattr(jar, '_v_by_name_indexes', None)
+    if indexes is None:
+        indexes = jar._v_by_name_indexes = {}
+    return indexes
+
+
+def _pending_updates(jar, create=False):
+    """Returns the models whose by-name entries change when the current transaction commits."""
+    txn = jar.transaction_manager.get()
+    pending = getattr(jar, '_v_by_name_pending', None)
+    if pending is None or pending[0] is not txn:
+        if not create:
+            return []
+        pending = jar._v_by_name_pending = (txn, [])
+        txn.addAfterCommitHook(_apply_updates, (jar, pending[1]))
+    return pending[1]
+
+
+def display_name(item):
+    real_item = follow_symlinks(item)
+
+    # TODO: check why queryAdapter cannot be used here
+    if IDisplayName.providedBy(real_item):
+        named = IDisplayName(real_item)
+        if named:
+            return named.display_name()
+
+
 class ByNameContainer(ReadonlyContainer):
     """Implements a dynamic view creating a symlink for each parent's object
     which provides a `display_name()` value.
 
+    The display names of the children of persistent containers are kept in a
+    per connection `ByNameIndex`, so that lookups and listings don't need to
+    visit every child. It is rebuilt when the children of the container change,
+    updated from model events once they are committed, and not used while the
+    current transaction has uncommitted changes. Entries which don't resolve
+    anymore (e.g. renamed by another process) cause the index to be rebuilt,
+    names missing from it are not looked for.
+
     """
 
     __name__ = 'by-name'
@@ -18,20 +94,171 @@ class ByNameContainer(ReadonlyContainer):
     def __init__(self, parent):
         self.__parent__ = parent
 
+    def __getitem__(self, key):
+        index = self._index()
+        if index is None:
+            return self._scan().get(key)
+
+        oid = index.names.get(key)
+        if oid is None:
+            return None
+
+        item = self._resolve(oid, key)
+        if item is None:
+            # stale entry, check the children themselves
+            index = self._index(rebuild=True)
+            if index is None:
+                return self._scan().get(key)
+            item = self._resolve(index.names.get(key), key)
+            if item is None:
+                return None
+        return Symlink(key, item)
+
+    def listnames(self):
+        index = self._index()
+        if index is None:
+            return self._scan().keys()
+        return index.names.keys()
+
+    def listcontent(self):
+        return self.content().values()
+
     def content(self):
+        index = self._index()
+        if index is None:
+            return self._scan()
+
+        items = self._resolve_all(index)
+        if items is None:
+            index = self._index(rebuild=True)
+            if index is None:
+                return self._scan()
+            items = self._resolve_all(index) or {}
+        return items
+
+    def _resolve_all(self, index):
+        """Returns symlinks to all the indexed children, or None if any entry is stale."""
         items = {}
-        for item in self.__parent__.listcontent():
-            real_item = follow_symlinks(item)
+        for name, oid in index.names.items():
+            item = self._resolve(oid, name)
+            if item is None:
+                return None
+            items[name] = Symlink(name, item)
+        return items
 
-            # TODO: check why queryAdapter cannot be used here
-            if IDisplayName.providedBy(real_item):
-                named = IDisplayName(real_item)
-                if named:
-                    display_name = named.display_name()
-                    items[display_name] = Symlink(display_name, item)
+    def _scan(self):
+        items = {}
+        for item in self.__parent__.listcontent():
+            name = display_name(item)
+            if name:
+                items[name] = Symlink(name, item)
 
         return items
 
+    def _resolve(self, oid, name):
+        if oid is None:
+            return None
+        try:
+            item = self.__parent__._p_jar.get(oid)
+        except KeyError:
+            return None
+        if item.__parent__ is None or display_name(item) != name:
+            return None
+        return item
+
+    def _index(self, rebuild=False):
+        parent = removeSecurityProxy(self.__parent__)
+        jar = getattr(parent, '_p_jar', None)
+        if jar is None or parent._p_oid is None:
+            return None
+
+        # uncommitted changes are seen only by scanning
+        if (_pending_updates(jar) or parent._p_changed or
+                getattr(getattr(parent, '_items', None), '_p_changed', False)):
+            return None
+
+        indexes = _indexes_for(jar)
+        index = indexes.get(parent._p_oid)
+        serial = children_serial(parent)
+        txn = jar.transaction_manager.get()
+        if rebuild or index is None or not index.valid(serial, txn):
+            index = self._build_index(parent, serial, txn)
+            if index is None:
+                indexes.pop(parent._p_oid, None)
+            else:
+                indexes[parent._p_oid] = index
+        return index
+
+    def _build_index(self, parent, serial, txn):
+        index = ByNameIndex(serial, txn)
+        for item in parent.listcontent():
+            name = display_name(item)
+            if not name:
+                continue
+
+            real_item = removeSecurityProxy(follow_symlinks(item))
+            if getattr(real_item, '_p_oid', None) is None:
+                # transient or uncommitted children cannot be indexed
+                return None
+            index.add(name, real_item._p_oid)
+        return index
+
+
+def _apply_updates(status, jar, models):
+    """Brings the indexes of `jar` up to date with the models changed by a committed transaction."""
+    if not status:
+        return
+
+    # indexes without a serial are rebuilt by each transaction anyway
+    indexes = dict((oid, index) for oid, index in _indexes_for(jar).items() if index.serial is not None)
+    touched = set()
+    for model in set(models):
+        oid = getattr(model, '_p_oid', None)
+        if oid is None:
+            continue
+
+        for parent_oid, index in indexes.items():
+            if oid in index.oids:
+                index.remove(oid)
+                touched.add(parent_oid)
+
+        parent = model.__parent__
+        parent_oid = getattr(parent, '_p_oid', None)
+        name = display_name(model)
+        if name and parent_oid in indexes and parent._items.get(model.__name__) is model:
+            indexes[parent_oid].add(name, oid)
+            touched.add(parent_oid)
+
+    for parent_oid in touched:
+        indexes[parent_oid].serial = children_serial(jar.get(parent_oid))
+
+
+def _record(model, container=None):
+    model = removeSecurityProxy(model)
+    jar = getattr(model, '_p_jar', None) or getattr(removeSecurityProxy(container), '_p_jar', None)
+    if jar is not None:
+        _pending_updates(jar, create=True).append(model)
+
+
+@subscribe(IModel, IModelCreatedEvent)
+def update_created(model, event):
+    _record(model, event.container)
+
+
+@subscribe(IModel, IModelMovedEvent)
+def update_moved(model, event):
+    _record(model, event.toContainer)
+
+
+@subscribe(IModel, IModelModifiedEvent)
+def update_modified(model, event):
+    _record(model)
+
+
+@subscribe(IModel, IModelDeletedEvent)
+def update_deleted(model, event):
+    _record(model, getattr(event, 'container', None))
+
 
 class ByNameContainerExtension(Subscription):
     implements(IContainerExtender)
@@ -1,12 +1,16 @@
 from __future__ import absolute_import
 
-from BTrees.OOBTree import OOBTree
+import logging
+
+from BTrees.IOBTree import IOBTree
 from grokcore.component import context
 from zope import schema
 from zope.interface import implements, Interface
 
 from .base import Container, IContainer, ContainerInjector, Model
 from .root import OmsRoot
+from opennode.oms.config import get_config
+from opennode.oms.security.directives import permissions
 
 
 class IUserLogger(Interface):
@@ -64,29 +68,114 @@ class UserEvent(Model):
 
 
 class UserEventLog(Container):
+    """Events logged for a single user, keyed by a monotonically increasing integer index.
+
+    Once `sizelimit` events are stored the oldest ones are evicted; when `sizelimit` is None
+    the `[logging] user_eventlog_size` setting applies (0 means unbounded).
+
+    """
     implements(IUserEventLogContainer)
+    permissions(dict(query='traverse'))
     __contains__ = IUserEvent
 
+    # index of the oldest event which hasn't been evicted yet
+    first_index = 1
+
     def __init__(self, username, sizelimit=None):
         self.__name__ = username
-        self.sizelimit = None
+        self.sizelimit = sizelimit
         self.cur_index = 0
-        self._items = OOBTree()
+        self._items = IOBTree()
+
+    @property
+    def _events(self):
+        # logs created before events were keyed by integers are converted on the fly
+        if not isinstance(self._items, IOBTree):
+            self._items = IOBTree((int(k), v) for k, v in self._items.items())
+            self.first_index = self._items.minKey() if self._items else self.cur_index + 1
+        return self._items
+
+    def _add(self, item):
+        item.__parent__ = self
+        self._events[item._index] = item
+        return item.__name__
+
+    def remove(self, item):
+        del self._events[item._index]
+
+    def __delitem__(self, key):
+        del self._events[int(key)]
+
+    def __getitem__(self, key):
+        try:
+            return self._events.get(int(key))
+        except ValueError:
+            return None
+
+    def content(self):
+        return dict((str(k), v) for k, v in self._events.iteritems())
 
     def add_event(self, rawevent):
         if rawevent.username != self.__name__:
             return
 
-        if self.sizelimit is not None:
-            while self.sizelimit <= len(self._items):
-                del self._items[min(self._items.keys())]
+        events = self._events
+
+        sizelimit = self.sizelimit
+        if sizelimit is None:
+            sizelimit = get_config().getint('logging', 'user_eventlog_size', 1000)
+
+        if sizelimit:
+            # indexes are contiguous, so evicting from the head never needs to scan the tree
+            first_index = self.first_index
+            while self.cur_index - first_index + 1 >= sizelimit:
+                events.pop(first_index, None)
+                first_index += 1
+            self.first_index = first_index
 
         self.cur_index += 1
         item = UserEvent(rawevent, self.cur_index)
         return self.add(item)
 
+    def query(self, limit=None, before=None, since=None, until=None, level=None, text=None):
+        """Returns the matching events, newest first.
+
+        Walks the log backwards from the event preceding index `before` (or from the newest
+        event) and stops once `limit` events matched or events older than `since` are reached.
+        `since` and `until` are timestamps formatted like `UserEvent.timestamp`, `level` is the
+        minimum level name and `text` a case insensitive substring of the message.
+
+        """
+        events = self._events
+        levelno = logging.getLevelName(level.upper()) if level else None
+        text = text.lower() if text else None
+
+        start = self.cur_index if before is None else min(self.cur_index, before - 1)
+
+        res = []
+        for index in xrange(start, self.first_index - 1, -1):
+            if limit is not None and len(res) >= limit:
+                break
+
+            event = events.get(index)
+            if event is None:
+                continue
+
+            if since is not None and event.timestamp < since:
+                break
+            if until is not None and event.timestamp > until:
+                continue
+            if isinstance(levelno, int) and event._rawevent.levelno < levelno:
+                continue
+            if text is not None and text not in event.message.lower():
+                continue
+
+            res.append(event)
+
+        return res
+
     def __str__(self):
-        return '<UserEventLog %s sizelimit=%s>' % (self._items, self.sizelimit)
+        return '<UserEventLog %s sizelimit=%s>' % (self.__name__, self.sizelimit)
 
 
 class EventLog(Container):
@@ -94,7 +183,7 @@ class EventLog(Container):
     __name__ = 'eventlog'
 
     def add_event(self, rawevent):
-        if rawevent.username not in self._items.iterkeys():
+        if rawevent.username not in self._items:
             usereventlog = UserEventLog(rawevent.username)
             self.add(usereventlog)
         else:
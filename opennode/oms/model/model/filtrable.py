@@ -1,8 +1,10 @@
 from grokcore.component import Adapter, context
 from zope.interface import Interface, implements
+from zope.schema.interfaces import IFromUnicode
 
 from opennode.oms.model.schema import get_schema_fields
 from opennode.oms.model.model.base import IModel
+from opennode.oms.model.model.search import indexed_fields
 
 
 class IFiltrable(Interface):
@@ -10,6 +12,33 @@ class IFiltrable(Interface):
         """Returns true if this object matches the given query."""
 
 
+def parse_field_value(field, value):
+    """Converts a `field:value` filter term value into the field type.
+
+    Returns a (min, max) tuple; `min..max` ranges may omit either end.
+    Raises ValueError if the value cannot be converted.
+
+    """
+    def convert(value):
+        if not value:
+            return None
+        try:
+            return IFromUnicode(field).fromUnicode(unicode(value))
+        except Exception as e:
+            raise ValueError(str(e))
+
+    if '..' in value:
+        low, high = value.split('..', 1)
+        return convert(low), convert(high)
+
+    value = convert(value)
+    return value, value
+
+
+def in_range(value, (low, high)):
+    return value is not None and (low is None or value >= low) and (high is None or value <= high)
+
+
 class ModelFieldFiltrable(Adapter):
     implements(IFiltrable)
     context(IModel)
@@ -44,7 +73,17 @@ class ModelFieldFiltrable(Adapter):
 
             name, field, schema = result[0]
             fieldvalue = field.get(schema(self.context))
-            return matches(value, fieldvalue)
+            if matches(value, fieldvalue):
+                return True
+
+            # typed values and ranges, like `memory:1024..4096`
+            if not isinstance(fieldvalue, basestring) and value:
+                try:
+                    return in_range(fieldvalue, parse_field_value(field, value))
+                except ValueError:
+                    return False
+
+            return False
 
         return all(any_field(term.lower()) if ':' not in term else specific_field(*term.split(':', 1))
                    for term in terms)
@@ -56,3 +95,83 @@ class DefaultFiltrable(Adapter):
 
     def match(self, query):
         return False
+
+
+class QueryPlan(object):
+    """Matches objects against a filter query, answering terms on indexed fields from the catalog.
+
+    `field:value` and `field:min..max` terms on fields declared with `index_field` are resolved
+    to a set of intids up front, so only the remaining terms are evaluated on each object.
+    Objects which aren't indexed yet, or don't provide any interface declaring the indexed field,
+    are matched against those terms with `IFiltrable`.
+    Indexes are updated by the indexer daemon, so they can briefly lag behind modifications.
+
+    """
+
+    def __init__(self, query, searcher=None):
+        if searcher is None:
+            from opennode.oms.zodb import db
+            searcher = db.get_root()['oms_root']['search']
+
+        self.query = query
+        self.searcher = searcher
+        self.ids = None
+        # (term, intids, interfaces declaring the indexed field)
+        self.indexed = []
+
+        remaining = []
+        for term in (t for t in query.split(' ') if t):
+            ids = self._indexed_term(*term.split(':', 1)) if ':' in term else None
+            if ids is None:
+                remaining.append(term)
+                continue
+
+            self.indexed.append((term, ids, list(indexed_fields[term.split(':', 1)[0]])))
+            if self.ids is None:
+                self.ids = ids
+            else:
+                self.ids = self.searcher.catalog.family.IF.intersection(self.ids, ids)
+
+        self.remaining = ' '.join(remaining)
+
+    def _indexed_term(self, name, value):
+        indexes = self.searcher.field_indexes(name)
+        if not indexes or not value:
+            return None
+
+        IF = self.searcher.catalog.family.IF
+        res = IF.Set()
+        for index, field in indexes:
+            values = index._fwd_index
+            # string fields match substrings, which only requires scanning the distinct values
+            if '..' not in value and values and isinstance(values.minKey(), basestring):
+                needle = value.encode('utf-8') if isinstance(value, unicode) else value
+                for key, docids in values.items():
+                    key = key.encode('utf-8') if isinstance(key, unicode) else key
+                    if needle in key:
+                        res = IF.union(res, docids)
+                continue
+
+            try:
+                res = IF.union(res, index.apply(parse_field_value(field, value)))
+            except ValueError:
+                return None
+        return res
+
+    def match(self, obj):
+        if self.ids is None:
+            return IFiltrable(obj).match(self.query)
+
+        docid = self.searcher.query_id(obj)
+        if docid is None:
+            return IFiltrable(obj).match(self.query)
+
+        remaining = [self.remaining] if self.remaining else []
+        for term, ids, interfaces in self.indexed:
+            if not any(interface.providedBy(obj) for interface in interfaces):
+                # the index doesn't know about fields of other interfaces with the same name
+                remaining.append(term)
+            elif docid not in ids:
+                return False
+
+        return not remaining or IFiltrable(obj).match(' '.join(remaining))
@@ -0,0 +1,348 @@
+from __future__ import absolute_import
+
+import threading
+
+import persistent
+import transaction
+from BTrees.OOBTree import OOBTree, OOTreeSet
+from grokcore.component import subscribe
+from twisted.internet import reactor
+from twisted.python import log
+from twisted.python.failure import Failure
+from zope.security.proxy import removeSecurityProxy
+
+from .base import AddingContainer, IModel
+from .events import IModelCreatedEvent, IModelDeletedEvent, IModelMovedEvent, IModelModifiedEvent
+from .symlink import Symlink
+from opennode.oms.core import IAfterApplicationInitializedEvent
+
+
+# interface identifier -> interface, for all the interfaces which have to be indexed
+indexed_interfaces = {}
+
+
+def index_interface(interface):
+    """Declares that the OIDs of all models providing `interface` have to be indexed."""
+    indexed_interfaces[interface.__identifier__] = interface
+
+
+class InterfaceIndex(persistent.Persistent):
+    """Maps indexed interfaces to the OIDs of the models providing them.
+
+    Each interface has its own OID set, which is written only when a model starts
+    or stops providing it. The sets are updated from model events when their
+    transaction commits. An interface which isn't indexed yet is built by a
+    transaction of its own, meanwhile it's queried by scanning the whole tree.
+
+    """
+
+    def __init__(self):
+        self.oids = OOBTree()
+
+    def objects(self, interface):
+        """Yields the models providing the indexed `interface`."""
+        name = interface.__identifier__
+        if name not in self.oids:
+            schedule_build([name])
+            return scan(interface)
+
+        return self._objects(name, interface)
+
+    def _objects(self, name, interface):
+        pending = _pending_models()
+        for oid in self.oids[name]:
+            try:
+                obj = self._p_jar.get(oid)
+            except KeyError:
+                continue
+
+            # unindexed descendants of a deleted model
+            if _is_stored(obj) and obj not in pending:
+                yield obj
+
+        # not committed yet
+        for obj, deleted in pending.items():
+            if not deleted and interface.providedBy(obj) and _is_stored(obj):
+                yield obj
+
+    def index(self, model):
+        oid = self._oid(model)
+        if oid is None:
+            return
+
+        for name, interface in indexed_interfaces.items():
+            if name not in self.oids:
+                continue
+
+            if interface.providedBy(model):
+                self.oids[name].insert(oid)
+            elif oid in self.oids[name]:
+                self.oids[name].remove(oid)
+
+    def unindex(self, model):
+        oid = getattr(model, '_p_oid', None)
+        if oid is not None:
+            for oids in self.oids.values():
+                if oid in oids:
+                    oids.remove(oid)
+
+        for child in stored_children(model):
+            self.unindex(child)
+
+    def verify(self, name, oids):
+        """Brings the entries of `oids` up to date, e.g. for models changed while `name` was being built."""
+        interface = indexed_interfaces[name]
+        for oid in oids:
+            try:
+                obj = self._p_jar.get(oid)
+            except KeyError:
+                obj = None
+
+            if obj is not None and _is_reachable(obj) and interface.providedBy(obj):
+                self.oids[name].insert(oid)
+            elif oid in self.oids[name]:
+                self.oids[name].remove(oid)
+
+    def build(self, name):
+        self.oids[name] = OOTreeSet()
+        for obj in scan(indexed_interfaces[name]):
+            oid = self._oid(obj)
+            if oid is not None:
+                self.oids[name].insert(oid)
+
+    def _oid(self, model):
+        if model._p_oid is None:
+            jar = getattr(model.__parent__, '_p_jar', None) or self._p_jar
+            if jar is None:
+                return None
+            # assign an OID right away instead of at commit time
+            jar.add(model)
+        return model._p_oid
+
+
+def stored_children(model):
+    """Returns the models persistently stored in a container, ignoring virtual items."""
+    if isinstance(model, InterfaceIndexedContainer):
+        return []
+    items = getattr(model, '_items', None)
+    if not isinstance(items, OOBTree):
+        return []
+    return [i for i in items.values() if IModel.providedBy(i) and not isinstance(i, Symlink)]
+
+
+def _is_stored(model):
+    parent = model.__parent__
+    return parent is not None and getattr(parent, '_items', {}).get(model.__name__) is model
+
+
+def _is_reachable(model):
+    while model.__parent__ is not None:
+        if not _is_stored(model):
+            return False
+        model = model.__parent__
+    return True
+
+
+def scan(interface):
+    """Returns the stored models providing `interface`, visiting the whole tree."""
+    from opennode.oms.zodb import db
+
+    def collect(container):
+        for child in stored_children(container):
+            if interface.providedBy(child):
+                yield child
+            for obj in collect(child):
+                yield obj
+
+    return list(collect(db.get_root()['oms_root']))
+
+
+def get_interface_index(create=False):
+    """Returns the interface index, or None if it hasn't been built yet and `create` is false."""
+    from opennode.oms.zodb import db
+
+    root = db.get_root()
+    if 'oms_interface_index' not in root:
+        if not create:
+            return None
+        index = root['oms_interface_index'] = InterfaceIndex()
+        root._p_jar.add(index)
+    return root['oms_interface_index']
+
+
+_building = set()
+# interface identifier -> OIDs of the models changed by transactions which couldn't index them
+_missed = {}
+_building_lock = threading.Lock()
+
+
+def schedule_build(names):
+    """Builds the index of the interfaces `names` in a transaction of its own.
+
+    The current transaction could be read only, which would throw the built index away.
+    Models changed while an index was being built are verified once the build commits.
+
+    """
+    with _building_lock:
+        names = set(names) - _building
+        _building.update(names)
+
+    if names:
+        reactor.callFromThread(_build, names)
+
+
+def _build(names):
+    verified = {}
+
+    def done(result):
+        with _building_lock:
+            if not isinstance(result, Failure):
+                for name, oids in verified.items():
+                    _missed[name] = _missed.get(name, set()) - oids
+                    if not _missed[name]:
+                        del _missed[name]
+            _building.difference_update(names)
+            # missed while verifying
+            remaining = [name for name in names if name in _missed]
+
+        if remaining:
+            schedule_build(remaining)
+        return result
+
+    build_indexes(names, verified).addBoth(done).addErrback(log.err, system='interface-index')
+
+
+def build_indexes(names, verified=None):
+    from opennode.oms.zodb import db
+
+    @db.transact
+    def build():
+        index = get_interface_index(create=True)
+        for name in names:
+            if name not in index.oids:
+                log.msg('Building interface index for %s' % name, system='interface-index')
+                index.build(name)
+
+        with _building_lock:
+            missed = dict((name, set(_missed.get(name, ()))) for name in names)
+        for name, oids in missed.items():
+            index.verify(name, oids)
+
+        if verified is not None:
+            verified.clear()
+            verified.update(missed)
+
+    return build()
+
+
+def _record_missed(status, names, models):
+    if not status:
+        return
+
+    oids = set(model._p_oid for model in models if model._p_oid is not None)
+    with _building_lock:
+        for name in names:
+            _missed.setdefault(name, set()).update(oids)
+    schedule_build(names)
+
+
+class InterfaceIndexedContainer(AddingContainer):
+    """A virtual container showing a symlink for each model providing `__indexed__`.
+
+    Backed by the interface index, so listing it doesn't need to scan the tree.
+    The interface has to be registered with `index_interface`.
+
+    """
+
+    __indexed__ = None
+
+    @property
+    def _items(self):
+        # computed once per transaction, until it changes some model
+        key = (transaction.get(), getattr(_pending, 'version', 0))
+        cached = getattr(self, '_v_items', None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        index = get_interface_index()
+        if index is None:
+            schedule_build([self.__indexed__.__identifier__])
+            objects = scan(self.__indexed__)
+        else:
+            objects = index.objects(self.__indexed__)
+        items = dict((obj.__name__, Symlink(obj.__name__, obj)) for obj in objects)
+
+        self._v_items = (key, items)
+        return items
+
+
+def _is_indexable(model):
+    return (indexed_interfaces and not isinstance(model, Symlink) and
+            not getattr(model, '__transient__', False) and isinstance(model, persistent.Persistent))
+
+
+_pending = threading.local()
+
+
+def _pending_models(create=False):
+    """Returns the models changed by the current transaction, mapped to whether they were deleted."""
+    txn = transaction.get()
+    pending = getattr(_pending, 'x', None)
+    if pending is None or pending[0] is not txn:
+        if not create:
+            return {}
+        pending = _pending.x = (txn, {})
+        txn.addBeforeCommitHook(_apply_updates, (pending[1], ))
+    return pending[1]
+
+
+def _apply_updates(models):
+    # each model is indexed once per transaction, according to its last change
+    index = get_interface_index()
+    if index is not None:
+        for model, deleted in models.items():
+            if deleted:
+                index.unindex(model)
+            else:
+                index.index(model)
+
+    # indexes built from a snapshot which might not include this transaction
+    unbuilt = [name for name in indexed_interfaces if index is None or name not in index.oids]
+    if unbuilt:
+        changed = []
+        for model, deleted in models.items():
+            changed.append(model)
+            if deleted:
+                changed.extend(_descendants(model))
+        transaction.get().addAfterCommitHook(_record_missed, (unbuilt, changed))
+
+
+def _descendants(model):
+    for child in stored_children(model):
+        yield child
+        for obj in _descendants(child):
+            yield obj
+
+
+@subscribe(IModel, IModelCreatedEvent)
+@subscribe(IModel, IModelMovedEvent)
+@subscribe(IModel, IModelModifiedEvent)
+def index_model(model, event):
+    model = removeSecurityProxy(model)
+    if _is_indexable(model):
+        _pending_models(create=True)[model] = False
+        _pending.version = getattr(_pending, 'version', 0) + 1
+
+
+@subscribe(IModel, IModelDeletedEvent)
+def unindex_model(model, event):
+    model = removeSecurityProxy(model)
+    if _is_indexable(model):
+        _pending_models(create=True)[model] = True
+        _pending.version = getattr(_pending, 'version', 0) + 1
+
+
+@subscribe(IAfterApplicationInitializedEvent)
+def build_interface_index(event):
+    if indexed_interfaces:
+        schedule_build(indexed_interfaces.keys())
@@ -1,19 +1,27 @@
 from __future__ import absolute_import
 
+import logging
+import logging.handlers
+import itertools
+import random
+import threading
 import time
-from collections import OrderedDict
+from collections import OrderedDict, deque
 
 from grokcore.component import querySubscriptions, Adapter, context, subscribe, baseclass
+from twisted.internet import defer, reactor
 from twisted.python import log
+from twisted.python.threadable import isInIOThread
+from twisted.python.failure import Failure
 from zope import schema
 from zope.authentication.interfaces import IAuthentication
 from zope.component import getUtility
 from zope.component import provideSubscriptionAdapter
 from zope.interface import Interface, implements, alsoProvides
 
-from .base import ReadonlyContainer
+from .base import ReadonlyContainer, Model
 from .actions import ActionsContainerExtension, Action, action
-from opennode.oms.util import Singleton
+from opennode.oms.util import Singleton, async_sleep
 from opennode.oms.config import get_config
 from opennode.oms.core import IAfterApplicationInitializedEvent
 
@@ -24,11 +32,25 @@ class ITask(Interface):
     uptime = schema.Int(title=u"uptime", description=u"Task uptime in seconds", readonly=True, required=False)
     ptid = schema.TextLine(title=u"parent task", description=u"Parent task", readonly=True, required=False)
     stdout = schema.TextLine(title=u"stdout", description=u"Standard output", readonly=True, required=False)
+    status = schema.TextLine(title=u"status", description=u"Task status", readonly=True, required=False)
 
     def signal(name):
         """Process a signal"""
 
 
+class ICompletedTask(Interface):
+    """Summary of a finished task."""
+    cmdline = schema.TextLine(title=u"command line", description=u"Command line", readonly=True, required=False)
+    ptid = schema.TextLine(title=u"parent task", description=u"Parent task", readonly=True, required=False)
+    status = schema.TextLine(title=u"exit status", description=u"Exit status", readonly=True, required=False)
+    duration = schema.Float(title=u"duration", description=u"Task run time in seconds", readonly=True,
+                            required=False)
+    output_size = schema.Int(title=u"output size", description=u"Size of the task output in bytes",
+                             readonly=True, required=False)
+    stdout = schema.TextLine(title=u"stdout", description=u"Standard output, if kept after completion",
+                             readonly=True, required=False)
+
+
 class ISuspendableTask(Interface):
     """A task which can be suspendedD."""
 
@@ -47,10 +69,86 @@ class IProcess(Interface):
         """Process a signal"""
 
 
+class IDaemonTask(Interface):
+    """Scheduling statistics of a daemon task."""
+    runs = schema.Int(title=u"runs", description=u"Number of completed runs", readonly=True, required=False)
+    failures = schema.Int(title=u"failures", description=u"Number of failed runs", readonly=True, required=False)
+    last_duration = schema.Float(title=u"last duration", description=u"Duration of the last run in seconds",
+                                 readonly=True, required=False)
+    mean_duration = schema.Float(title=u"mean duration", description=u"Mean duration of a run in seconds",
+                                 readonly=True, required=False)
+    next_run = schema.Int(title=u"next run", description=u"Seconds until the next run", readonly=True,
+                          required=False)
+
+
 class DaemonProcess(object):
+    """Base class for background daemons.
+
+    Subclasses implement `execute`, which `run` invokes every `interval` seconds plus a random
+    delay of up to `jitter` times the interval, `[daemons] jitter` unless set by the subclass.
+    A run never starts before the previous one has finished, and after consecutive failures
+    the delay doubles up to `max_backoff` seconds.
+
+    """
+
+    interval = 1
+    jitter = None
+    max_backoff = 300
+
+    runs = 0
+    failures = 0
+    consecutive_failures = 0
+    last_duration = 0.0
+    total_duration = 0.0
+    next_run = None
+
     def __init__(self):
         config = get_config()
         self.paused = not config.getboolean('daemons', self.__name__, True)
+        if self.jitter is None:
+            self.jitter = config.getfloat('daemons', 'jitter', 0.1)
+
+    @property
+    def mean_duration(self):
+        return self.total_duration / self.runs if self.runs else 0.0
+
+    @defer.inlineCallbacks
+    def run(self):
+        while True:
+            if not self.paused:
+                yield self.run_once()
+
+            delay = self.next_delay()
+            self.next_run = time.time() + delay
+            yield async_sleep(delay)
+
+    @defer.inlineCallbacks
+    def run_once(self):
+        start = time.time()
+        try:
+            yield self.execute()
+        except Exception:
+            self.failures += 1
+            self.consecutive_failures += 1
+            log.err(system=self.__name__)
+        else:
+            self.consecutive_failures = 0
+        finally:
+            self.runs += 1
+            self.last_duration = time.time() - start
+            self.total_duration += self.last_duration
+
+    def next_delay(self):
+        delay = self.interval
+        if self.consecutive_failures:
+            delay = min(max(delay, 1) * 2 ** min(self.consecutive_failures, 16), max(self.max_backoff, delay))
+        if self.jitter:
+            delay += random.uniform(0, self.jitter * delay)
+        return delay
+
+    def execute(self):
+        """Performs a single run of the daemon, optionally returning a deferred."""
+        raise NotImplementedError
 
     def signal_handler(self, name):
         if name == 'STOP':
@@ -71,14 +169,130 @@ class DaemonStateRenderer(Adapter):
     context(DaemonProcess)
 
     def __str__(self):
-        return "[%s%s]" % (self.context.__name__, ': paused' if self.context.paused else '')
+        daemon = self.context
+        res = "[%s%s]" % (daemon.__name__, ': paused' if daemon.paused else '')
+        if daemon.runs:
+            res += " runs: %s, failures: %s, last: %.2fs, mean: %.2fs" % (
+                daemon.runs, daemon.failures, daemon.last_duration, daemon.mean_duration)
+        if daemon.next_run is not None:
+            res += ", next in %ds" % max(0, daemon.next_run - time.time())
+        return res
+
+
+class TaskOutput(object):
+    """Bounded output of a task, kept as chunks numbered from 1.
+
+    Once more than `[proc] output_max_size` bytes are kept the oldest chunks are dropped, so
+    clients reading incrementally pass the number of the last chunk they've seen and can tell
+    when they missed some. Iterating yields the kept chunks, like the plain list buffers did.
+
+    Chunks can be appended from any thread; `wait` has to be called from the reactor thread.
+
+    """
+
+    def __init__(self, chunks=(), max_size=None):
+        if max_size is None:
+            max_size = get_config().getint('proc', 'output_max_size', 65536)
+        self.max_size = max_size
+        self.chunks = deque()
+        self.size = 0
+        self.total_size = 0
+        self.seq = 0
+        self.closed = False
+        self.waiters = []
+        self.lock = threading.Lock()
+
+        for data in chunks:
+            self.append(data)
+
+    def append(self, data):
+        with self.lock:
+            self.seq += 1
+            self.chunks.append((self.seq, data))
+            self.size += len(data)
+            self.total_size += len(data)
+            while self.size > self.max_size and len(self.chunks) > 1:
+                self.size -= len(self.chunks.popleft()[1])
+            if self.size > self.max_size:
+                # a single chunk larger than the whole output keeps only its tail
+                seq, data = self.chunks.pop()
+                data = data[len(data) - self.max_size:]
+                self.chunks.append((seq, data))
+                self.size = len(data)
+            waiting = bool(self.waiters)
+
+        if waiting:
+            self._notify()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self._notify()
+
+    def read(self, after=0):
+        """Returns the kept chunks numbered after `after`, as (seq, data) pairs."""
+        with self.lock:
+            return self._read(after)
+
+    def wait(self, after=0):
+        """Returns a deferred firing with the chunks numbered after `after` as soon as there are
+        any, or with an empty list once the output is closed.
+
+        """
+        with self.lock:
+            chunks = self._read(after)
+            if chunks or self.closed:
+                return defer.succeed(chunks)
+
+            waiter = (after, defer.Deferred(lambda d: self._cancel(waiter)))
+            self.waiters.append(waiter)
+            return waiter[1]
+
+    def truncated(self, after):
+        """Tells whether chunks following `after` were dropped."""
+        with self.lock:
+            return bool(self.chunks) and self.chunks[0][0] > after + 1
+
+    def _read(self, after):
+        if after >= self.seq:
+            return []
+        first = self.chunks[0][0] if self.chunks else 1
+        return list(itertools.islice(self.chunks, max(0, after - first + 1), None))
+
+    def _cancel(self, waiter):
+        with self.lock:
+            self.waiters.remove(waiter)
+
+    def _notify(self):
+        if isInIOThread():
+            self._wake()
+        else:
+            reactor.callFromThread(self._wake)
+
+    def _wake(self):
+        ready = []
+        with self.lock:
+            for waiter in list(self.waiters):
+                chunks = self._read(waiter[0])
+                if chunks or self.closed:
+                    self.waiters.remove(waiter)
+                    ready.append((waiter[1], chunks))
+
+        for d, chunks in ready:
+            d.callback(chunks)
+
+    def __iter__(self):
+        return iter([data for seq, data in self.read()])
+
+    def __len__(self):
+        return len(self.chunks)
 
 
 class Task(ReadonlyContainer):
     implements(ITask)
 
     def __init__(self, name, parent, subject, deferred, cmdline, ptid,
-                 signal_handler=None, principal=None, write_buffer=None):
+                 signal_handler=None, principal=None, write_buffer=None, keep_output=False):
         self.__name__ = name
         self.__parent__ = parent
         self.subject = subject
@@ -94,6 +308,8 @@ class Task(ReadonlyContainer):
             auth = getUtility(IAuthentication, context=None)
             self.__owner__ = auth.getPrincipal('root')
         self.write_buffer = write_buffer
+        # whether the output survives in /proc/completed, for clients polling asynchronous commands
+        self.keep_output = keep_output
 
         # XXX: Workaround to handle ON-425
         # Refactor with adapters handling each specific signal
@@ -110,13 +326,90 @@ class Task(ReadonlyContainer):
 
     @property
     def stdout(self):
+        return list(self.write_buffer) if self.write_buffer is not None else None
+
+    @property
+    def output(self):
         return self.write_buffer
 
+    @property
+    def status(self):
+        return u'running'
+
     def signal(self, name):
         if self.signal_handler:
             self.signal_handler(name)
 
 
+class DaemonTask(Task):
+    """A task running a `DaemonProcess`, exposing its scheduling statistics."""
+    implements(IDaemonTask)
+
+    @property
+    def runs(self):
+        return self.subject.runs
+
+    @property
+    def failures(self):
+        return self.subject.failures
+
+    @property
+    def last_duration(self):
+        return self.subject.last_duration
+
+    @property
+    def mean_duration(self):
+        return self.subject.mean_duration
+
+    @property
+    def next_run(self):
+        if self.subject.next_run is not None:
+            return int(max(0, self.subject.next_run - time.time()))
+
+
+class CompletedTask(Model):
+    """A compact summary of a finished task.
+
+    Doesn't retain the subject, the deferred nor, unless the task asked to keep it, the output
+    buffer of the original task.
+
+    """
+    implements(ICompletedTask)
+
+    def __init__(self, task, status):
+        self.__name__ = task.__name__
+        self.__parent__ = task.__parent__
+        self.cmdline = task.cmdline if isinstance(task.cmdline, basestring) else str(task.cmdline)
+        self.ptid = task.ptid
+        self.principal = task.principal
+        if task.principal is not None:
+            self.__owner__ = task.principal
+        else:
+            auth = getUtility(IAuthentication, context=None)
+            self.__owner__ = auth.getPrincipal('root')
+        self.status = status
+        self.timestamp = task.timestamp
+        self.completed = time.time()
+        self.output_size = task.write_buffer.total_size if task.write_buffer is not None else 0
+        self.output = task.write_buffer if task.keep_output else None
+
+    @property
+    def duration(self):
+        return self.completed - self.timestamp
+
+    @property
+    def stdout(self):
+        return list(self.output) if self.output is not None else None
+
+    @property
+    def uptime(self):
+        return self.duration
+
+    @property
+    def nicknames(self):
+        return [self.cmdline, ]
+
+
 class Proc(ReadonlyContainer):
     __metaclass__ = Singleton
 
@@ -128,9 +421,15 @@ class Proc(ReadonlyContainer):
         # represents the init process, just for fun.
         self.tasks = OrderedDict({'1': Task('1', self, self, None, '/bin/init', '0')})
 
+        # completed tasks, oldest first
         self.dead_tasks = OrderedDict()
         self.next_id = 1
 
+        config = get_config()
+        self.max_dead_tasks = config.getint('proc', 'completed_max_size', 100)
+        self.max_dead_task_age = config.getint('proc', 'completed_max_age', 3600)
+        self.output_log = config.getstring('proc', 'completed_output_log', '')
+
     def start_daemons(self):
         for i in querySubscriptions(self, IProcess):
             log.msg('Starting %s' % i, system='proc')
@@ -138,57 +437,108 @@ class Proc(ReadonlyContainer):
 
     def spawn(self, process):
         self._register(process.run(), process, IProcessStateRenderer(process),
-                       signal_handler=process.signal_handler)
+                       signal_handler=process.signal_handler, factory=DaemonTask)
 
     def __str__(self):
         return 'Tasks'
 
     def content(self):
         res = dict(self.tasks)
-        res['completed'] = CompletedProc(self, self.dead_tasks)
+        res['completed'] = CompletedProc(self)
         return res
 
+    def __getitem__(self, key):
+        # a task stays reachable under its pid once completed, so that clients can poll it
+        item = super(Proc, self).__getitem__(key)
+        if item is None:
+            item = CompletedProc(self).tasks.get(key)
+        return item
+
     @classmethod
-    def register(cls, deferred, subject, cmdline=None, ptid='1', principal=None, write_buffer=None):
+    def register(cls, deferred, subject, cmdline=None, ptid='1', principal=None, write_buffer=None,
+                 keep_output=False):
         pid = Proc()._register(deferred, subject, cmdline, ptid, principal=principal,
-                               write_buffer=write_buffer)
+                               write_buffer=write_buffer, keep_output=keep_output)
         log.msg('Registered as process %s: %s' % (pid, cmdline), system='proc')
         return pid
 
     def _register(self, deferred, subject, cmdline,
-                  ptid='1', signal_handler=None, principal=None, write_buffer=None):
+                  ptid='1', signal_handler=None, principal=None, write_buffer=None, factory=Task,
+                  keep_output=False):
         self.next_id += 1
         new_id = str(self.next_id)
-        self.tasks[new_id] = Task(new_id, self, subject, deferred, cmdline, ptid, signal_handler,
-                                  principal, write_buffer)
+        if not isinstance(write_buffer, TaskOutput):
+            write_buffer = TaskOutput(write_buffer or ())
+        self.tasks[new_id] = factory(new_id, self, subject, deferred, cmdline, ptid, signal_handler,
+                                     principal, write_buffer, keep_output=keep_output)
         if deferred:
             deferred.addBoth(self._unregister, new_id)
 
         return new_id
 
     @classmethod
-    def unregister(cls, id_):
+    def unregister(cls, id_, result=None):
         self = Proc()
-        self.dead_tasks[id_] = self.tasks[id_]
-        del self.tasks[id_]
+        task = self.tasks.pop(id_)
+        if task.write_buffer is not None:
+            task.write_buffer.close()
+
+        if isinstance(result, Failure):
+            status = u'failed: %s' % result.getErrorMessage()
+        else:
+            status = u'done'
+
+        self.spill_output(task, status)
+        self.dead_tasks[id_] = CompletedTask(task, status)
+        self.prune_dead_tasks()
         log.msg('Unregistered process %s: %s' % (id_, self.dead_tasks[id_].cmdline), system='proc')
 
     @classmethod
     def _unregister(cls, res, id_):
-        cls.unregister(id_)
+        cls.unregister(id_, res)
         return res
 
+    def prune_dead_tasks(self):
+        """Drops the oldest completed tasks exceeding the configured size or age limits."""
+        while len(self.dead_tasks) > self.max_dead_tasks:
+            self.dead_tasks.popitem(last=False)
+
+        if self.max_dead_task_age:
+            deadline = time.time() - self.max_dead_task_age
+            while self.dead_tasks and next(self.dead_tasks.itervalues()).completed < deadline:
+                self.dead_tasks.popitem(last=False)
+
+    def spill_output(self, task, status):
+        """Appends the kept output of a finished task to the configured output log, if any."""
+        if not self.output_log or not task.write_buffer:
+            return
+
+        logger = logging.getLogger('opennode.oms.proc.output')
+        if not logger.handlers:
+            handler = logging.handlers.WatchedFileHandler(self.output_log)
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            logger.addHandler(handler)
+            logger.propagate = False
+
+        logger.info('task %s (%s) %s: %s\n%s', task.__name__,
+                    task.principal.id if task.principal else '-', status, task.cmdline,
+                    ''.join(task.write_buffer))
+
 
 class CompletedProc(ReadonlyContainer):
     __name__ = 'completed'
     _inherit_permissions = True
 
-    def __init__(self, parent, tasks):
+    def __init__(self, parent):
         self.__parent__ = parent
-        self.tasks = tasks
+
+    @property
+    def tasks(self):
+        self.__parent__.prune_dead_tasks()
+        return self.__parent__.dead_tasks
 
     def content(self):
-        return self.tasks
+        return dict(self.tasks)
 
 
 class SignalAction(Action):
@@ -1,15 +1,24 @@
 from __future__ import absolute_import
 
-from BTrees.OOBTree import OOTreeSet, difference
+import heapq
+from collections import OrderedDict, defaultdict
+from itertools import islice
+from operator import itemgetter
+
+from BTrees.OIBTree import OIBTree
 from grokcore.component import context, subscribe, Adapter, baseclass
+from twisted.internet import defer
 from twisted.python import log
 from zope import schema
 from zope.app.catalog.catalog import Catalog
 from zope.app.intid import IntIds
-from zope.app.intid.interfaces import IIntIds
-from zope.catalog.keyword import KeywordIndex
+from zope.catalog.attribute import AttributeIndex
+from zope.catalog.field import FieldIndex
+from zope.catalog.keyword import IKeywordIndex
 from zope.catalog.text import TextIndex
-from zope.component import provideAdapter, provideUtility, provideSubscriptionAdapter, queryAdapter
+from zope.component import provideAdapter, provideSubscriptionAdapter, queryAdapter
+from zope.container.contained import Contained
+from zope.index.keyword import KeywordIndex
 from zope.interface import Interface, implements
 from zope.keyreference.interfaces import NotYet
 from zope.keyreference.persistent import KeyReferenceToPersistent
@@ -122,46 +131,269 @@ class ModelTags(Adapter):
     tags = property(get_tags, set_tags)
 
 
+class CountingKeywordIndex(KeywordIndex):
+    """A keyword index which also keeps how many documents carry each keyword."""
+
+    def clear(self):
+        super(CountingKeywordIndex, self).clear()
+        self.counts = OIBTree()
+
+    def index_doc(self, docid, seq):
+        if not seq:
+            return self.unindex_doc(docid)
+
+        old = set(self._rev_index.get(docid, ()))
+        super(CountingKeywordIndex, self).index_doc(docid, seq)
+        self._count(old, set(self._rev_index.get(docid, ())))
+
+    def unindex_doc(self, docid):
+        old = set(self._rev_index.get(docid, ()))
+        super(CountingKeywordIndex, self).unindex_doc(docid)
+        self._count(old, set(self._rev_index.get(docid, ())))
+
+    def _count(self, old, new):
+        for keyword in new - old:
+            self.counts[keyword] = self.counts.get(keyword, 0) + 1
+        for keyword in old - new:
+            count = self.counts.get(keyword, 0) - 1
+            if count > 0:
+                self.counts[keyword] = count
+            elif keyword in self.counts:
+                del self.counts[keyword]
+
+
+class TagIndex(AttributeIndex, CountingKeywordIndex, Contained):
+    implements(IKeywordIndex)
+
+
+# field name -> interfaces whose field with that name has a field index
+indexed_fields = defaultdict(list)
+
+
+def index_field(interface, name):
+    """Declares that the `name` schema field of the models providing `interface` has to be indexed.
+
+    Field indexes answer `name:value` and `name:min..max` filter terms without evaluating
+    the field on each model. Field values have to be orderable, so collection fields
+    cannot be indexed. Fields declared after the catalog was built are used only once
+    the search index is rebuilt.
+
+    """
+    if interface not in indexed_fields[name]:
+        indexed_fields[name].append(interface)
+
+
+def field_index_name(interface, name):
+    return 'field:%s.%s' % (interface.__identifier__, name)
+
+
 class SearchContainer(ReadonlyContainer):
     __name__ = 'search'
 
+    # names of the field indexes which were populated by a full reindex
+    complete_field_indexes = frozenset()
+
+    # catalog being rebuilt by `ReindexAction`, swapped in once complete
+    shadow_catalog = None
+    rebuilt_ids = None
+
+    ids = None
+
     def __init__(self):
         self.clear()
 
     def clear(self):
+        """Empties the catalog. Intids are kept, so they stay stable across reindexing."""
         self.tag_container = SearchByTagContainer(self)
-        self.catalog = Catalog()
-        self.catalog['tags'] = KeywordIndex('tags', ITagged)
-        self.catalog['name'] = TextIndex('display_name', IDisplayName, True)
-        self.catalog['__all'] = TextIndex('tokens', ITokenized, True)
+        self.catalog = self._new_catalog()
+        self.complete_field_indexes = frozenset(name for name in self.catalog if name.startswith('field:'))
+        self.shadow_catalog = self.rebuilt_ids = None
+
+        if self.ids is None:
+            self.ids = IntIds()
+
+    def _new_catalog(self):
+        catalog = Catalog()
+        catalog['tags'] = TagIndex('tags', ITagged)
+        catalog['name'] = TextIndex('display_name', IDisplayName, True)
+        catalog['__all'] = TextIndex('tokens', ITokenized, True)
+        self._add_field_indexes(catalog)
+        return catalog
+
+    def _add_field_indexes(self, catalog):
+        for name, interfaces in indexed_fields.items():
+            for interface in interfaces:
+                index_name = field_index_name(interface, name)
+                if index_name not in catalog:
+                    catalog[index_name] = FieldIndex(name, interface)
+
+    def _catalogs(self):
+        if self.shadow_catalog is not None:
+            return [self.catalog, self.shadow_catalog]
+        return [self.catalog]
+
+    def start_rebuild(self):
+        """Starts building a new catalog, while searches keep using the current one.
+
+        Objects (un)indexed until `finish_rebuild` is called go in both catalogs.
+
+        """
+        self.shadow_catalog = self._new_catalog()
+        self.rebuilt_ids = self.ids.family.IF.TreeSet()
+
+    def finish_rebuild(self):
+        """Replaces the catalog with the rebuilt one.
+
+        Intids of the objects which weren't indexed during the rebuild are released.
+        Returns the number of released intids.
+
+        """
+        if self.shadow_catalog is None:
+            return 0
+
+        self.catalog = self.shadow_catalog
+        self.complete_field_indexes = frozenset(name for name in self.catalog if name.startswith('field:'))
+
+        # objects of stale intids are usually deleted and could be packed away already,
+        # so their entries are removed without loading them
+        stale = [docid for docid in self.ids.refs if docid not in self.rebuilt_ids]
+        for docid in stale:
+            ref = self.ids.refs.pop(docid)
+            self.ids.ids.pop(ref, None)
+
+        self.shadow_catalog = self.rebuilt_ids = None
+        return len(stale)
 
-        self.ids = IntIds()
+    def field_indexes(self, name):
+        """Returns the field indexes and schema fields for the field `name`.
+
+        Returns None unless every interface declaring an index for `name` has a complete one.
+
+        """
+        interfaces = indexed_fields.get(name)
+        if not interfaces:
+            return None
+
+        res = []
+        for interface in interfaces:
+            index_name = field_index_name(interface, name)
+            if index_name not in self.complete_field_indexes:
+                return None
+            res.append((self.catalog[index_name], interface[name]))
+        return res
 
     def index_object(self, obj):
-        real_obj = follow_symlinks(obj)
         try:
-            self.catalog.index_doc(self.ids.register(real_obj), real_obj)
+            self._index_object(obj)
         except NotYet:
             log.msg("cannot index object %s because it's not yet committed" % obj, system='search')
 
     def _index_object(self, obj):
         real_obj = follow_symlinks(obj)
-        self.catalog.index_doc(self.ids.register(real_obj), real_obj)
+        docid = self.ids.register(real_obj)
 
-    def unindex_object(self, obj):
+        for catalog in self._catalogs():
+            self._add_field_indexes(catalog)
+            catalog.index_doc(docid, real_obj)
+
+        if self.rebuilt_ids is not None:
+            self.rebuilt_ids.insert(docid)
+
+    def query_id(self, obj):
+        """Returns the intid of `obj`, or None if it isn't indexed."""
         try:
-            self.catalog.unindex_doc(self.ids.register(obj))
+            return self.ids.queryId(removeSecurityProxy(follow_symlinks(obj)))
         except NotYet:
-            log.msg("cannot unindex object %s because it's not yet committed" % obj, system='search')
+            return None
 
-    def search(self, **kwargs):
-        # HACK, we should be able to setup a persistent utility
-        provideUtility(self.ids, IIntIds)
-        return list(self.catalog.searchResults(**kwargs))
+    def unindex_object(self, obj):
+        docid = self.query_id(obj)
+        if docid is None:
+            return
 
-    def search_goog(self, query):
+        for catalog in self._catalogs():
+            catalog.unindex_doc(docid)
+
+        self.ids.unregister(follow_symlinks(obj))
+        if self.rebuilt_ids is not None and docid in self.rebuilt_ids:
+            self.rebuilt_ids.remove(docid)
+
+    def search(self, limit=None, offset=0, ranked=False, **kwargs):
+        return list(self.objects(self.query(limit=limit, offset=offset, ranked=ranked, **kwargs)))
+
+    def search_goog(self, query, **kwargs):
+        return self.search(**dict(kwargs, **self._goog_query(query)))
+
+    def count_goog(self, query):
+        return self.count(**self._goog_query(query))
+
+    def _goog_query(self, query):
         # hack, zope catalog treats ':' specially
-        return self.search(__all=query.replace(':', '_'))
+        return {'__all': query.replace(':', '_')}
+
+    def query(self, limit=None, offset=0, ranked=False, **kwargs):
+        """Returns the intids of the objects matching the index query `kwargs`, without loading them.
+
+        Only the intids between `offset` and `offset + limit` are returned. With `ranked`,
+        results of text index queries are ordered by decreasing relevance, otherwise by intid.
+
+        """
+        result = self.catalog.apply(kwargs)
+        if not result:
+            return []
+
+        end = None if limit is None else offset + limit
+
+        # text indexes return a mapping from intid to score
+        if ranked and hasattr(result, 'items'):
+            if end is None:
+                ranking = sorted(result.items(), key=itemgetter(1), reverse=True)
+            else:
+                ranking = heapq.nlargest(end, result.items(), key=itemgetter(1))
+            return [docid for docid, score in ranking[offset:end]]
+
+        return list(islice(result, offset, end))
+
+    def count(self, **kwargs):
+        """Returns the number of objects matching the index query `kwargs`."""
+        return len(self.catalog.apply(kwargs) or ())
+
+    def objects(self, ids):
+        """Yields the objects registered with the given intids, skipping stale ones."""
+        for docid in ids:
+            obj = self.ids.queryObject(docid)
+            if obj is not None:
+                yield obj
+
+    def tag_facets(self, tags):
+        """Returns how many indexed objects tagged with all the given `tags` carry each other tag.
+
+        Uses the forward and reverse mappings of the tags keyword index, so it visits
+        each matching object once instead of running a query per candidate tag.
+        The counts of all the tags are kept by the index itself.
+
+        """
+        index = self.catalog['tags']
+
+        if not tags:
+            # catalogs built before the index kept counts are upgraded by reindexing
+            if not hasattr(index, 'counts'):
+                return dict((tag, len(docids)) for tag, docids in index._fwd_index.items())
+            return dict(index.counts.items())
+
+        docids = None
+        for tag in tags:
+            tagged = index._fwd_index.get(tag)
+            if tagged is None:
+                return {}
+            docids = tagged if docids is None else index.family.IF.intersection(docids, tagged)
+
+        facets = defaultdict(int)
+        for docid in docids:
+            for tag in index._rev_index.get(docid, ()):
+                if tag not in tags:
+                    facets[tag] += 1
+        return facets
 
     @property
     def _items(self):
@@ -169,31 +401,44 @@ class SearchContainer(ReadonlyContainer):
 
 
 class SearchResult(ReadonlyContainer):
-    def __init__(self, parent, query):
+    """A page of full text search results, shown as symlinks named after the found objects."""
+
+    def __init__(self, parent, query, limit=None, offset=0, ranked=False):
         self.__parent__ = parent
         self.__name__ = query
         self.query = query
+        self.limit = limit
+        self.offset = offset
+        self.ranked = ranked
 
     def search_goog(self, query):
         return self.__parent__.search_goog(query)
 
     @property
     def _items(self):
-        res = {}
-        for item in self.__parent__.search_goog(self.query):
-            name = item.__name__
-            if IDisplayName.providedBy(item):
-                name = IDisplayName(item).display_name()
-
-            def find_free_name(tentative_name, idx):
-                next_name = '%s_%s' % (name, idx)
-                if tentative_name in res:
-                    return find_free_name(next_name, idx + 1)
-                return tentative_name
-
-            name = find_free_name(name, 0)
-            res[name] = Symlink(name, item)
-        return res
+        return symlinks(self.__parent__.search_goog(self.query, limit=self.limit, offset=self.offset,
+                                                    ranked=self.ranked))
+
+
+def symlinks(items):
+    """Returns symlinks to `items` keyed by display name, with a numeric suffix for duplicates.
+
+    The symlinks are kept in the order of `items`.
+
+    """
+    res = OrderedDict()
+    for item in items:
+        name = item.__name__
+        if IDisplayName.providedBy(item):
+            name = IDisplayName(item).display_name()
+
+        free_name, idx = name, 0
+        while free_name in res:
+            free_name = '%s_%s' % (name, idx)
+            idx += 1
+
+        res[free_name] = Symlink(free_name, item)
+    return res
 
 
 @subscribe(Model, IModelModifiedEvent)
@@ -233,17 +478,23 @@ class ReindexAction(Action):
 
     action('reindex')
 
+    # number of objects indexed in each transaction
+    batch_size = 500
+
+    @defer.inlineCallbacks
     def execute(self, cmd, args):
 
         # TODO: break this import cycle by moving this action somewhere else
         from opennode.oms.zodb import db
 
+        # the new catalog is built over several transactions, searches keep using the old one
         @db.transact
-        def doit():
+        def start():
             search = db.get_root()['oms_root']['search']
-            search.clear()
+            search.start_rebuild()
 
-            objs = set()
+            objs = []
+            seen = set()
 
             def collect(container):
                 for item in container.listcontent():
@@ -251,46 +502,75 @@ class ReindexAction(Action):
                     if IContainer.providedBy(item) and not isinstance(item, Container):
                         continue
 
-                    if IModel.providedBy(item) and not isinstance(item, Symlink):
-                        objs.add(item)
+                    if IModel.providedBy(item) and not isinstance(item, Symlink) and id(item) not in seen:
+                        seen.add(id(item))
+                        objs.append(item)
 
                     if IContainer.providedBy(item):
                         collect(item)
 
             collect(db.get_root()['oms_root'])
 
+            oids = []
             for obj in objs:
+                if obj._p_oid is None:
+                    search.index_object(obj)
+                else:
+                    oids.append(obj._p_oid)
+            return len(objs), oids
+
+        @db.transact
+        def index(oids):
+            search = db.get_root()['oms_root']['search']
+            for oid in oids:
+                try:
+                    obj = search._p_jar.get(oid)
+                except KeyError:
+                    continue
+
+                # deleted in the meantime
+                parent = obj.__parent__
+                if parent is None or parent[obj.__name__] is not obj:
+                    continue
+
                 search.index_object(obj)
 
-            cmd.write("reindexed %s objects\n" % (len(objs)))
+        @db.transact
+        def finish():
+            return db.get_root()['oms_root']['search'].finish_rebuild()
+
+        count, oids = yield start()
+        for i in xrange(0, len(oids), self.batch_size):
+            yield index(oids[i:i + self.batch_size])
+        released = yield finish()
 
-        return doit()
+        log.msg("reindexed %s objects, released %s stale ids" % (count, released), system='search')
+        cmd.write("reindexed %s objects\n" % (count))
 
 
 class ITag(Interface):
     name = schema.TextLine(title=u"Name")
+    count = schema.Int(title=u"Count", description=u"Number of tagged objects", readonly=True,
+                       required=False)
 
 
 class Tag(ReadonlyContainer):
     implements(ITag)
 
-    def __init__(self, name, searcher, parent, other_tags, tag_path):
+    def __init__(self, name, searcher, parent, tag_path, count=None):
         self.name = name
         self.__name__ = name.encode('utf-8')
         self.__parent__ = parent
         self.searcher = searcher
-        self.other_tags = difference(other_tags, OOTreeSet([self.__name__]))
         self.tag_path = tag_path + [name]
+        self.count = count
 
     @property
     def _items(self):
         res = {'items': TagItems(self, self.searcher)}
-        for i in self.other_tags:
-            sub_tag = Tag(i, self.searcher, self, self.other_tags, self.tag_path)
-
-            # only add it if it yields some results.
-            if TagItems(sub_tag, self.searcher)._items:
-                res[i] = sub_tag
+        # only co-occurring tags yield some results
+        for tag, count in self.searcher.tag_facets(self.tag_path).items():
+            res[tag] = Tag(tag, self.searcher, self, self.tag_path, count)
         return res
 
 
@@ -303,21 +583,7 @@ class TagItems(ReadonlyContainer):
 
     @property
     def _items(self):
-        res = {}
-        for item in self.searcher.search(tags=self.__parent__.tag_path):
-            name = item.__name__
-            if IDisplayName.providedBy(item):
-                name = IDisplayName(item).display_name()
-
-            def find_free_name(tentative_name, idx):
-                next_name = '%s_%s' % (name, idx)
-                if tentative_name in res:
-                    return find_free_name(next_name, idx + 1)
-                return tentative_name
-
-            name = find_free_name(name, 0)
-            res[name] = Symlink(name, item)
-        return res
+        return symlinks(self.searcher.search(tags=self.__parent__.tag_path))
 
 
 class SearchByTagContainer(AddingContainer):
@@ -333,11 +599,8 @@ class SearchByTagContainer(AddingContainer):
 
     @property
     def _items(self):
-        res = {}
-        tag_set = OOTreeSet(self.tags)
-        for i in self.tags:
-            res[i] = Tag(i, self.__parent__, self, tag_set, [])
-        return res
+        return dict((tag, Tag(tag, self.__parent__, self, [], count))
+                    for tag, count in self.__parent__.tag_facets([]).items())
 
     def _add(self, item):
         self.tags.add(item.__name__)
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 
+import threading
 import time
 
 from grokcore.component import Subscription, baseclass, Adapter, context, subscribe
@@ -9,7 +10,7 @@ from zope.interface import implements
 from .base import ReadonlyContainer, Model, IModel, IContainerExtender
 from opennode.oms.config import get_config
 from opennode.oms.model.model.events import IModelModifiedEvent, IModelDeletedEvent, IModelCreatedEvent
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 
 
 class IStream(IModel):
@@ -40,12 +41,21 @@ class TransientStream(Adapter):
 
     MAX_LEN = 100
 
+    # Seconds a deleted model is remembered. Readers have to check again through the
+    # db paths they found backed by a transient stream at least this often.
+    TOMBSTONE_TTL = 3600
+
     # Since this class is designed to be not persistent nor unique during
     # execution, but reinstantiated at each traversal, we have to keepp
     # the actual data somewhere. A two level dictionary structure serves the purpose
     # key (parent model + metric name)
     transient_store = defaultdict(list)
 
+    # Canonical paths of deleted models, oldest deletion first. Readers which access
+    # the transient store directly by path (without traversing the db) use it to detect deletions.
+    tombstones = OrderedDict()
+    tombstones_lock = threading.Lock()
+
     @property
     def data(self):
         from opennode.oms.model.traversal import canonical_path
@@ -57,8 +67,48 @@ class TransientStream(Adapter):
         if not self.data and get_config().getboolean('metrics', 'fake_metrics', False):
             return self._fake_events(after, limit)
 
+        return self.filter_events(self.data, after, limit)
+
+    @classmethod
+    def events_for_path(cls, path, after, limit=None):
+        """Returns the events of the stream of the model living at the given canonical path.
+        Doesn't access the db, thus it's safe to call it from the reactor thread.
+
+        """
+        return cls.filter_events(cls.transient_store.get(path, []), after, limit)
+
+    @classmethod
+    def is_deleted(cls, path):
+        """True if the model at the given canonical path, or one of its ancestors, was deleted."""
+        with cls.tombstones_lock:
+            while path:
+                if path in cls.tombstones:
+                    return True
+                path = path.rpartition('/')[0]
+        return False
+
+    @classmethod
+    def add_tombstone(cls, path):
+        now = time.time()
+        with cls.tombstones_lock:
+            cls.tombstones.pop(path, None)
+            cls.tombstones[path] = now
+
+            while cls.tombstones:
+                oldest, deleted = next(cls.tombstones.iteritems())
+                if deleted > now - cls.TOMBSTONE_TTL:
+                    break
+                del cls.tombstones[oldest]
+
+    @classmethod
+    def remove_tombstone(cls, path):
+        with cls.tombstones_lock:
+            cls.tombstones.pop(path, None)
+
+    @staticmethod
+    def filter_events(data, after, limit=None):
         res = []
-        for idx, (ts, value) in enumerate(self.data):
+        for idx, (ts, value) in enumerate(data):
             if ts <= after or (limit and idx >= limit):
                 break
             res.append((ts, value))
@@ -141,6 +191,8 @@ def model_created(model, event):
     from opennode.oms.model.traversal import canonical_path
     timestamp = int(time.time() * 1000)
 
+    TransientStream.remove_tombstone(canonical_path(model))
+
     parent = event.container
     if IStream.providedBy(parent) or queryAdapter(parent, IStream):
         IStream(parent).add((timestamp, dict(event='add', name=model.__name__,
@@ -160,3 +212,5 @@ def model_deleted(model, event):
     if IStream.providedBy(model) or queryAdapter(model, IStream):
         IStream(model).add((timestamp, dict(event='delete', name=model.__name__,
                                             url=canonical_path(model))))
+
+    TransientStream.add_tombstone(canonical_path(model))
@@ -1,9 +1,14 @@
 import logging
 import re
+import threading
+import weakref
 
-from grokcore.component import Adapter, implements, baseclass
+from grokcore.component import Adapter, implements, baseclass, subscribe
 from zope.interface import Interface
+from zope.security.proxy import Proxy, removeSecurityProxy
 
+from opennode.oms.model.model.base import IModel
+from opennode.oms.model.model.events import IModelMovedEvent, IModelDeletedEvent
 from opennode.oms.model.model.symlink import follow_symlinks
 
 
@@ -42,6 +47,146 @@ def parse_path(path):
     return path
 
 
+class PathCache(object):
+    """Caches canonical paths by OID and the OIDs resolved for absolute paths.
+
+    Entries are kept per ZODB connection and are dropped altogether whenever a model
+    is moved, renamed or deleted, both when the event is handled and after its
+    transaction commits. Models can also be moved by other processes, so cached
+    entries are checked against the names and parents they were computed from.
+
+    """
+
+    def __init__(self):
+        self.paths = weakref.WeakKeyDictionary()
+        self.oids = weakref.WeakKeyDictionary()
+        # the cache is shared by all the threads running transactions
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, obj):
+        obj = removeSecurityProxy(obj)
+        jar = getattr(obj, '_p_jar', None)
+        oid = getattr(obj, '_p_oid', None)
+        if jar is not None and oid is not None:
+            return jar, oid
+        return None, None
+
+    def get_path(self, obj, parent):
+        """Returns the cached path of `obj` if it's still named and contained as when cached.
+
+        The path of `parent` has to be already known to be valid.
+
+        """
+        jar, oid = self._key(obj)
+        if jar is None:
+            return None
+
+        entry = self.paths.get(jar, {}).get(oid)
+        if entry is None:
+            return None
+
+        path, name, parent_oid = entry
+        if name != obj.__name__ or parent_oid != self._key(parent)[1]:
+            return None
+        return path
+
+    def set_path(self, obj, parent, path):
+        jar, oid = self._key(obj)
+        if jar is not None:
+            with self.lock:
+                self.paths.setdefault(jar, {})[oid] = (path, obj.__name__, self._key(parent)[1])
+
+    def get_objects(self, obj, path):
+        """Returns the objects along `path` starting from `obj` or None if not cached.
+
+        Each cached object has to still be stored under its name in the previous one,
+        since it could have been moved or deleted without any event, e.g. by another process.
+
+        """
+        if type(obj) is Proxy:
+            return None
+
+        jar, oid = self._key(obj)
+        if jar is None:
+            return None
+
+        oids = self.oids.get(jar, {}).get((oid, path))
+        if oids is not None:
+            try:
+                objs = [jar.get(i) for i in oids]
+            except KeyError:
+                objs = None
+
+            if objs is not None and self._contained(obj, path.split('/'), objs):
+                self._count(True)
+                return objs
+
+            with self.lock:
+                self.oids.get(jar, {}).pop((oid, path), None)
+
+        self._count(False)
+        return None
+
+    def set_objects(self, obj, path, objs):
+        if type(obj) is Proxy:
+            return
+
+        jar, oid = self._key(obj)
+        if jar is None:
+            return
+
+        # only objects reached through their own containers can be validated on lookup
+        oids = [getattr(i, '_p_oid', None) for i in objs]
+        if (None not in oids and all(getattr(i, '_p_jar', None) is jar for i in objs) and
+                self._contained(obj, path.split('/'), objs)):
+            with self.lock:
+                self.oids.setdefault(jar, {})[(oid, path)] = oids
+
+    def _contained(self, obj, names, objs):
+        previous = removeSecurityProxy(obj)
+        for name, item in zip(names, objs):
+            items = getattr(previous, '_items', None)
+            if (item.__name__ != name or item.__parent__ is not previous or
+                    items is None or items.get(name) is not item):
+                return False
+            previous = item
+        return True
+
+    def _count(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def clear(self):
+        with self.lock:
+            self.paths.clear()
+            self.oids.clear()
+
+
+path_cache = PathCache()
+
+
+def invalidate_path_cache():
+    path_cache.clear()
+
+    import transaction
+    transaction.get().addAfterCommitHook(lambda status: path_cache.clear())
+
+
+@subscribe(IModel, IModelMovedEvent)
+@subscribe(IModel, IModelDeletedEvent)
+def model_moved_or_deleted(model, event):
+    invalidate_path_cache()
+
+
 def traverse_path(obj, path):
     """Starting from the given object, traverses all its descendant
     objects to find an object that matches the given path.
@@ -56,6 +201,11 @@ def traverse_path(obj, path):
     if not path:
         return [obj], []
 
+    key = '/'.join(path)
+    cached = path_cache.get_objects(obj, key)
+    if cached is not None:
+        return cached, []
+
     ret = [obj]
     while path:
         name = path[0]
@@ -72,6 +222,10 @@ def traverse_path(obj, path):
         ret.append(next_obj)
         path = path[1:]
 
+    # only fully resolved paths are cached, a missing object could be created any time
+    if not path:
+        path_cache.set_objects(obj, key, ret[1:])
+
     return ret[1:], path
 
 
@@ -93,11 +247,26 @@ def traverse1(path):
 
 
 def canonical_path(item):
-    path = []
-    from opennode.oms.security.authentication import sudo
+    chain = []
     while item:
-        p = sudo(follow_symlinks(sudo(item)))
+        p = follow_symlinks(removeSecurityProxy(item))
         assert p.__name__ is not None, '%s.__name__ is None' % p
-        path.insert(0, p.__name__)
+        chain.append(p)
         item = p.__parent__
-    return '/'.join(path)
+
+    # a cached path is valid only if the paths of all the parents are
+    path = None
+    parent = None
+    missed = False
+    for p in reversed(chain):
+        cached = path_cache.get_path(p, parent) if not missed else None
+        if cached is None:
+            missed = True
+            path = p.__name__ if path is None else path + '/' + p.__name__
+            path_cache.set_path(p, parent, path)
+        else:
+            path = cached
+        parent = p
+
+    path_cache._count(not missed)
+    return path or ''
@@ -0,0 +1,92 @@
+import unittest
+
+import mock
+from nose.tools import eq_, assert_raises
+from twisted.internet import defer
+from zope.authentication.interfaces import IAuthentication
+from zope.component import getUtility
+
+from opennode.oms.endpoint.httprest.root import BadRequest, NotFound
+from opennode.oms.endpoint.ssh.cmd.commands import EchoCmd
+from opennode.oms.endpoint.httprest.view import CommandView, CompletedTaskOutputView, RunningTaskOutputView
+from opennode.oms.model.model.proc import Proc
+from opennode.oms.security.interaction import new_interaction
+from opennode.oms.tests.util import run_in_reactor, clean_db
+from opennode.oms.zodb import db
+
+
+class CommandViewTestCase(unittest.TestCase):
+
+    @run_in_reactor
+    @clean_db
+    def setUp(self):
+        self.view = CommandView(db.get_root()['oms_root']['bin']['echo'])
+
+    def _request(self, **args):
+        request = mock.Mock()
+        request.path = '/bin/echo'
+        request.args = args
+        request.interaction = new_interaction(getUtility(IAuthentication).getPrincipal('root'))
+        request.notifyFinish.return_value = defer.Deferred()
+        return request
+
+    def _put(self, **args):
+        res = []
+        self.view.render_PUT(self._request(**args)).render().addBoth(res.append)
+        return res[0]
+
+    @run_in_reactor
+    def test_synchronous_command(self):
+        res = self._put(arg=['hello', 'world'])
+        eq_(res['status'], 'ok')
+        eq_(res['stdout'], ['hello world\n'])
+        eq_(Proc()[res['pid']].status, u'done')
+        eq_(res['truncated'], False)
+
+    @run_in_reactor
+    def test_synchronous_command_truncated_output(self):
+        def execute(cmd, args):
+            for string in args.strings:
+                cmd.write('%s\n' % string)
+
+        with mock.patch.object(EchoCmd, 'execute', execute):
+            with mock.patch('opennode.oms.model.model.proc.get_config') as get_config:
+                get_config.return_value.getint.return_value = 8
+                res = self._put(arg=['hello', 'world'])
+        eq_(res['stdout'], ['world\n'])
+        eq_(res['truncated'], True)
+
+    @run_in_reactor
+    def test_asynchronous_command(self):
+        res = self._put(arg=['hello'], asynchronous=['1'])
+        eq_(res['href'], '/proc/%s' % res['pid'])
+        assert 'stdout' not in res
+
+        task = Proc()[res['pid']]
+        eq_(task.status, u'done')
+        eq_(task.stdout, ['hello\n'])
+
+    @run_in_reactor
+    def test_bad_arguments(self):
+        res = self._put(**{'--no-such-option': ['1']})
+        res.trap(BadRequest)
+
+    @run_in_reactor
+    def test_task_output(self):
+        d = defer.Deferred()
+        pid = Proc.register(d, None, 'some cmd', write_buffer=['foo\n'])
+        view = RunningTaskOutputView(Proc()[pid])
+
+        res = []
+        view.render_GET(self._request(after=['0'])).render().addCallback(res.append)
+        eq_(res[0], {'seq': 1, 'output': ['foo\n'], 'truncated': False, 'closed': False})
+
+        view.render_GET(self._request(after=['1'], wait=['10'])).render().addCallback(res.append)
+        eq_(len(res), 1)
+        Proc()[pid].output.append('bar\n')
+        eq_(res[1]['seq'], 2)
+        eq_(res[1]['output'], ['bar\n'])
+
+        d.callback(None)
+        with assert_raises(NotFound):
+            CompletedTaskOutputView(Proc()[pid]).render_GET(self._request())
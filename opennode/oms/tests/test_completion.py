@@ -8,9 +8,10 @@ from zope.component import getUtility
 
 from opennode.oms.endpoint.ssh.cmd import registry, commands
 from opennode.oms.endpoint.ssh.cmd.base import Cmd
+from opennode.oms.endpoint.ssh.cmd.completers import ChildNamesCache
 from opennode.oms.endpoint.ssh.protocol import OmsShellProtocol
 from opennode.oms.model.model import creatable_models
-from opennode.oms.model.model.base import Model, Container
+from opennode.oms.model.model.base import Model, Container, children_serial
 from opennode.oms.tests.test_compute import Compute
 from opennode.oms.tests.util import run_in_reactor, assert_mock, no_more_calls, skip, current_call
 from opennode.oms.zodb import db
@@ -297,3 +298,50 @@ class CmdCompletionTestCase(unittest.TestCase):
         self._tab_after('cd /computes/%s' % cid)
         with assert_mock(self.terminal) as t:
             t.write('/')
+
+    @run_in_reactor
+    def test_child_names_cache(self):
+        machines = db.get_root()['oms_root']['machines']
+        cid = machines.add(self.make_compute())
+        transaction.commit()
+
+        cache = ChildNamesCache()
+        names = cache.names(machines)
+        assert cid + '/' in names
+        assert names == sorted(names)
+
+        with mock.patch.object(ChildNamesCache, '_names') as _names:
+            assert cache.names(machines) is names
+            assert not _names.called
+
+        other = machines.add(self.make_compute(u'penguin'))
+        transaction.commit()
+        assert other + '/' in cache.names(machines)
+
+        self._tab_after('ls /machines/%s' % other[:-1])
+        with assert_mock(self.terminal) as t:
+            t.write(other[-1] + '/')
+            no_more_calls(t)
+
+    @run_in_reactor
+    def test_child_names_cache_sees_other_connections(self):
+        machines = db.get_root()['oms_root']['machines']
+        machines.add(self.make_compute())
+        transaction.commit()
+        cache = ChildNamesCache()
+        cache.names(machines)
+        serial = children_serial(machines)
+
+        tm = transaction.TransactionManager()
+        conn = db.get_db().open(tm)
+        try:
+            # without events, whose handlers would use this thread's connection
+            cid = conn.root()['oms_root']['machines']._add(self.make_compute(u'penguin'))
+            tm.commit()
+        finally:
+            conn.close()
+
+        # the commit of the other connection becomes visible in a new transaction
+        transaction.begin()
+        assert children_serial(machines) != serial
+        assert cid + '/' in cache.names(machines)
@@ -12,9 +12,10 @@ from zope.interface import Interface, implements, alsoProvides
 from opennode.oms.security.directives import permissions
 
 from opennode.oms.model.model.actions import ActionsContainerExtension
-from opennode.oms.model.model.base import IContainer, Container, AddingContainer, IIncomplete, IDisplayName, ContainerInjector
+from opennode.oms.model.model.base import Container, IIncomplete, IDisplayName, ContainerInjector
 from opennode.oms.model.model.root import OmsRoot
 from opennode.oms.model.model.byname import ByNameContainerExtension
+from opennode.oms.model.model.interfaceindex import InterfaceIndexedContainer, index_interface
 #from opennode.oms.model.model.console import Consoles
 #from opennode.oms.model.model.network import NetworkInterfaces, NetworkRoutes
 from opennode.oms.model.model.search import ModelTags
@@ -280,31 +281,14 @@ class IVirtualCompute(Interface):
     autostart = schema.Bool(title=u"Autostart", description=u"Start on boot", required=False)
 
 
-class Computes(AddingContainer):
+class Computes(InterfaceIndexedContainer):
     __name__ = 'computes'
     __contains__ = Compute
+    __indexed__ = ICompute
 
     def __str__(self):
         return 'Compute list'
 
-    @property
-    def _items(self):
-        # break an import cycle
-        from opennode.oms.zodb import db
-        machines = db.get_root()['oms_root']['machines']
-
-        computes = {}
-
-        def collect(container):
-            for item in container.listcontent():
-                if ICompute.providedBy(item):
-                    computes[item.__name__] = Symlink(item.__name__, item)
-                if IContainer.providedBy(item):
-                    collect(item)
-
-        collect(machines)
-        return computes
-
     def _add(self, item):
         # break an import cycle
         from opennode.oms.zodb import db
@@ -319,6 +303,7 @@ class Computes(AddingContainer):
 
 provideSubscriptionAdapter(ActionsContainerExtension, adapts=(Compute, ))
 provideSubscriptionAdapter(ByNameContainerExtension, adapts=(Computes, ))
+index_interface(ICompute)
 
 
 class ComputesRootInjector(ContainerInjector):
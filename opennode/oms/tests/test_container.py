@@ -0,0 +1,280 @@
+import unittest
+
+import mock
+import transaction
+from nose.tools import eq_
+from zope.component import getGlobalSiteManager, handle
+
+from opennode.oms.model.model import base, byname, interfaceindex
+from opennode.oms.model.model.byname import ByNameContainer
+from opennode.oms.model.model.events import ModelDeletedEvent, ModelModifiedEvent
+from opennode.oms.model.model.symlink import follow_symlinks
+from opennode.oms.tests.test_compute import Compute, ICompute, Machines
+from opennode.oms.tests.util import run_in_reactor, clean_db
+from opennode.oms.zodb import db
+
+
+class ContainerTestCase(unittest.TestCase):
+
+    @run_in_reactor
+    def test_lazy_getitem(self):
+        machines = Machines()
+        compute = Compute(u'tux-for-test', u'active')
+        machines.add(compute)
+
+        # the stored items are not copied to look up a single child
+        with mock.patch.object(machines, '_items', mock.MagicMock(wraps=machines._items)) as items:
+            eq_(machines[compute.__name__], compute)
+            assert items.get.called
+            assert not items.keys.called and not items.iteritems.called
+
+        # transient children are resolved by name when not stored
+        eq_(compute['actions'].__name__, 'actions')
+        eq_(compute['nonexisting'], None)
+
+        names = compute.listnames()
+        assert isinstance(names, list)
+        eq_(sorted(names), ['actions'])
+
+    @run_in_reactor
+    def test_subscriptions_cache_invalidation(self):
+        machines = Machines()
+        eq_(sorted(machines.listnames()), [])
+
+        class ExtraExtension(base.ContainerExtension):
+            __class__ = Machines
+
+        gsm = getGlobalSiteManager()
+        gsm.registerSubscriptionAdapter(ExtraExtension, required=(Machines, ),
+                                        provided=base.IContainerExtender)
+        try:
+            eq_(sorted(machines.listnames()), ['machines'])
+        finally:
+            gsm.unregisterSubscriptionAdapter(ExtraExtension, required=(Machines, ),
+                                              provided=base.IContainerExtender)
+        eq_(sorted(machines.listnames()), [])
+        # entries of older registry generations are dropped
+        assert not any(ExtraExtension in factories for factories in base._subscription_factories.values())
+
+    @run_in_reactor
+    def test_extensions_take_precedence_over_items(self):
+        machines = Machines()
+        machines._items['machines'] = Machines()
+
+        class ExtraExtension(base.ContainerExtension):
+            __class__ = Machines
+
+        gsm = getGlobalSiteManager()
+        gsm.registerSubscriptionAdapter(ExtraExtension, required=(Machines, ),
+                                        provided=base.IContainerExtender)
+        try:
+            eq_(machines.listnames(), ['machines'])
+            assert machines['machines'].__transient__
+            assert machines.listcontent()[0].__transient__
+            assert machines.content()['machines'].__transient__
+        finally:
+            gsm.unregisterSubscriptionAdapter(ExtraExtension, required=(Machines, ),
+                                              provided=base.IContainerExtender)
+
+
+class InterfaceIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        interfaceindex._building.clear()
+        interfaceindex._missed.clear()
+
+    @run_in_reactor
+    @clean_db
+    def test_computes_backed_by_index(self):
+        oms_root = db.get_root()['oms_root']
+        machines = oms_root['machines']
+        compute = Compute(u'tux-for-test', u'active')
+        machines.add(compute)
+
+        with mock.patch.object(Machines, 'listcontent') as listcontent:
+            eq_(sorted(oms_root['computes'].listnames()), sorted([compute.__name__, 'by-name']))
+            assert not listcontent.called
+
+        del machines[compute.__name__]
+        handle(compute, ModelDeletedEvent(machines))
+        eq_(list(oms_root['computes'].listnames()), ['by-name'])
+        transaction.abort()
+
+    @run_in_reactor
+    @clean_db
+    def test_index_built_in_own_transaction(self):
+        oms_root = db.get_root()['oms_root']
+        compute = Compute(u'tux-for-test', u'active')
+
+        with mock.patch.object(interfaceindex, 'reactor') as reactor:
+            oms_root['machines'].add(compute)
+            transaction.commit()
+            eq_(interfaceindex.get_interface_index(), None)
+
+            eq_(sorted(oms_root['computes'].listnames()), sorted([compute.__name__, 'by-name']))
+            transaction.abort()
+            eq_(interfaceindex.get_interface_index(), None)
+
+            run_scheduled(reactor)
+
+        index = interfaceindex.get_interface_index()
+        eq_(list(index.oids[ICompute.__identifier__]), [compute._p_oid])
+
+        other = Compute(u'penguin', u'active')
+        oms_root['machines'].add(other)
+        eq_(list(index.oids[ICompute.__identifier__]), [compute._p_oid])
+        transaction.commit()
+        eq_(sorted(index.oids[ICompute.__identifier__]), sorted([compute._p_oid, other._p_oid]))
+
+    @run_in_reactor
+    @clean_db
+    def test_models_committed_during_build_are_indexed(self):
+        oms_root = db.get_root()['oms_root']
+        compute = Compute(u'tux-for-test', u'active')
+
+        with mock.patch.object(interfaceindex, 'reactor') as reactor:
+            oms_root['machines'].add(compute)
+            transaction.commit()
+
+            # built from a snapshot taken before the compute was committed
+            with mock.patch.object(interfaceindex, 'scan', return_value=[]):
+                run_scheduled(reactor)
+
+        index = interfaceindex.get_interface_index()
+        eq_(list(index.oids[ICompute.__identifier__]), [compute._p_oid])
+        eq_(interfaceindex._missed, {})
+
+    @run_in_reactor
+    @clean_db
+    def test_items_cached_per_transaction(self):
+        oms_root = db.get_root()['oms_root']
+        computes = oms_root['computes']
+        with mock.patch.object(interfaceindex, 'reactor') as reactor:
+            oms_root['machines'].add(Compute(u'tux-for-test', u'active'))
+            transaction.commit()
+            run_scheduled(reactor)
+
+        with mock.patch.object(interfaceindex.InterfaceIndex, 'objects', return_value=[]) as objects:
+            list(computes.listnames())
+            computes['nonexisting']
+            eq_(objects.call_count, 1)
+
+            oms_root['machines'].add(Compute(u'penguin', u'active'))
+            list(computes.listnames())
+            eq_(objects.call_count, 2)
+        transaction.abort()
+
+
+def run_scheduled(reactor):
+    for args, kwargs in reactor.callFromThread.call_args_list:
+        args[0](*args[1:])
+
+
+class ByNameTestCase(unittest.TestCase):
+
+    @run_in_reactor
+    @clean_db
+    def test_by_name_index(self):
+        machines = db.get_root()['oms_root']['machines']
+        compute = Compute(u'tux-for-test', u'active')
+        machines.add(compute)
+        transaction.commit()
+        by_name = ByNameContainer(machines)
+
+        eq_(list(by_name.listnames()), ['tux-for-test'])
+        assert by_name._index() is not None
+        eq_(follow_symlinks(by_name['tux-for-test']), compute)
+
+        other = Compute(u'penguin', u'active')
+        machines.add(other)
+        eq_(sorted(by_name.listnames()), ['penguin', 'tux-for-test'])
+
+        compute.hostname = u'tux'
+        handle(compute, ModelModifiedEvent({'hostname': u'tux-for-test'}, {'hostname': u'tux'}))
+        eq_(sorted(by_name.listnames()), ['penguin', 'tux'])
+        eq_(follow_symlinks(by_name['tux']), compute)
+        eq_(by_name['tux-for-test'], None)
+
+        del machines[other.__name__]
+        handle(other, ModelDeletedEvent(machines))
+        eq_(list(by_name.listnames()), ['tux'])
+
+        transaction.commit()
+        # committed updates are applied to the index without rebuilding it
+        with mock.patch.object(ByNameContainer, '_build_index') as build_index:
+            assert by_name._index() is not None
+            assert not build_index.called
+        eq_(list(by_name.listnames()), ['tux'])
+
+    @run_in_reactor
+    @clean_db
+    def test_by_name_index_aborted(self):
+        machines = db.get_root()['oms_root']['machines']
+        machines.add(Compute(u'tux-for-test', u'active'))
+        transaction.commit()
+        by_name = ByNameContainer(machines)
+        eq_(list(by_name.listnames()), ['tux-for-test'])
+
+        machines.add(Compute(u'penguin', u'active'))
+        eq_(sorted(by_name.listnames()), ['penguin', 'tux-for-test'])
+        transaction.abort()
+
+        eq_(list(by_name.listnames()), ['tux-for-test'])
+        eq_(by_name['penguin'], None)
+
+    @run_in_reactor
+    @clean_db
+    def test_by_name_index_sees_other_connections(self):
+        machines = db.get_root()['oms_root']['machines']
+        compute = Compute(u'tux-for-test', u'active')
+        machines.add(compute)
+        transaction.commit()
+        by_name = ByNameContainer(machines)
+        eq_(list(by_name.listnames()), ['tux-for-test'])
+
+        tm = transaction.TransactionManager()
+        conn = db.get_db().open(tm)
+        other_machines = conn.root()['oms_root']['machines']
+        # renamed without any event
+        other_machines[compute.__name__].hostname = u'tux'
+        other_machines._add(Compute(u'penguin', u'active'))
+        tm.commit()
+        conn.close()
+        transaction.begin()
+
+        eq_(follow_symlinks(by_name['tux']), compute)
+        eq_(by_name['tux-for-test'], None)
+        eq_(sorted(by_name.listnames()), ['penguin', 'tux'])
+
+    @run_in_reactor
+    @clean_db
+    def test_by_name_listing_resolves_index_once(self):
+        machines = db.get_root()['oms_root']['machines']
+        computes = [Compute(u'tux%s' % i, u'active') for i in range(3)]
+        for compute in computes:
+            machines.add(compute)
+        transaction.commit()
+        by_name = ByNameContainer(machines)
+        eq_(len(by_name.listnames()), 3)
+
+        with mock.patch.object(byname, 'children_serial', wraps=base.children_serial) as serial:
+            with mock.patch.object(ByNameContainer, '_build_index') as build_index:
+                eq_(sorted(follow_symlinks(i) for i in by_name.listcontent()), sorted(computes))
+                eq_(serial.call_count, 1)
+
+                # a plain miss doesn't rebuild the index
+                eq_(by_name['nonexisting'], None)
+                assert not build_index.called
+
+        tm = transaction.TransactionManager()
+        conn = db.get_db().open(tm)
+        # renamed by another process, without any event
+        conn.root()['oms_root']['machines'][computes[0].__name__].hostname = u'penguin'
+        tm.commit()
+        conn.close()
+        transaction.begin()
+
+        # the stale entry is noticed while listing
+        eq_(sorted(by_name.content().keys()), [u'penguin', u'tux1', u'tux2'])
+        eq_(follow_symlinks(by_name['penguin']), computes[0])
+        eq_(by_name['tux0'], None)
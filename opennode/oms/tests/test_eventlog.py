@@ -0,0 +1,49 @@
+import logging
+import unittest
+
+from nose.tools import eq_
+
+from opennode.oms.model.model.eventlog import UserEventLog
+
+
+def make_record(username, msg):
+    record = logging.LogRecord('test', logging.INFO, __file__, 0, msg, (), None)
+    record.username = username
+    record.asctime = '2013-01-01 00:00:00,000'
+    return record
+
+
+class UserEventLogTestCase(unittest.TestCase):
+
+    def test_eviction(self):
+        eventlog = UserEventLog('alice', sizelimit=3)
+        for i in range(5):
+            eventlog.add_event(make_record('alice', 'event %s' % i))
+        eventlog.add_event(make_record('bob', 'not mine'))
+
+        eq_(sorted(eventlog.listnames(), key=int), ['3', '4', '5'])
+        eq_(eventlog['5'].message, 'event 4')
+        eq_(eventlog['1'], None)
+        eq_(eventlog['nonexisting'], None)
+
+        for i in range(10):
+            eventlog.add_event(make_record('alice', 'event %s' % (i + 5)))
+        eq_(sorted(eventlog.listnames(), key=int), ['13', '14', '15'])
+
+    def test_query(self):
+        eventlog = UserEventLog('alice', sizelimit=0)
+        for i in range(10):
+            record = make_record('alice', 'event %s' % i)
+            record.asctime = '2013-01-01 00:00:%02d,000' % i
+            if i % 3 == 0:
+                record.levelno, record.levelname = logging.ERROR, 'ERROR'
+            eventlog.add_event(record)
+
+        messages = lambda events: [e.message for e in events]
+
+        eq_(messages(eventlog.query(limit=3)), ['event 9', 'event 8', 'event 7'])
+        eq_(messages(eventlog.query(limit=2, before=8)), ['event 6', 'event 5'])
+        eq_(messages(eventlog.query(level='error')), ['event 9', 'event 6', 'event 3', 'event 0'])
+        eq_(messages(eventlog.query(text='EVENT 1')), ['event 1'])
+        eq_(messages(eventlog.query(since='2013-01-01 00:00:07,000', until='2013-01-01 00:00:08,000')),
+            ['event 8', 'event 7'])
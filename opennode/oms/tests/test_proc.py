@@ -0,0 +1,137 @@
+import time
+import unittest
+
+from nose.tools import eq_
+from twisted.internet import defer
+
+from opennode.oms.config import get_config
+from opennode.oms.model.model.proc import Proc, CompletedTask, DaemonProcess, DaemonTask, TaskOutput
+from opennode.oms.model.schema import model_to_dict
+from opennode.oms.tests.util import run_in_reactor
+
+
+class ProcTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.proc = Proc()
+        self.proc.dead_tasks.clear()
+        self.orig_limits = (self.proc.max_dead_tasks, self.proc.max_dead_task_age)
+
+    def tearDown(self):
+        self.proc.max_dead_tasks, self.proc.max_dead_task_age = self.orig_limits
+        self.proc.dead_tasks.clear()
+
+    @run_in_reactor
+    def test_completed_task_summary(self):
+        d = defer.Deferred()
+        pid = Proc.register(d, None, 'ls -l', write_buffer=['foo\n', 'bar\n'])
+        d.callback(None)
+
+        completed = self.proc.dead_tasks[pid]
+        assert isinstance(completed, CompletedTask)
+        eq_(completed.cmdline, 'ls -l')
+        eq_(completed.status, u'done')
+        eq_(completed.output_size, 8)
+        assert not hasattr(completed, 'write_buffer')
+
+        d = defer.Deferred()
+        pid = Proc.register(d, None, 'false')
+        d.errback(Exception('boom'))
+        d.addErrback(lambda f: None)
+        eq_(self.proc.dead_tasks[pid].status, u'failed: boom')
+
+    @run_in_reactor
+    def test_dead_tasks_are_capped(self):
+        self.proc.max_dead_tasks = 3
+
+        pids = []
+        for i in range(5):
+            d = defer.Deferred()
+            pids.append(Proc.register(d, None, 'cmd %s' % i))
+            d.callback(None)
+
+        eq_(self.proc.dead_tasks.keys(), pids[2:])
+
+        self.proc.max_dead_task_age = 60
+        self.proc.dead_tasks[pids[2]].completed = time.time() - 120
+        eq_(sorted(self.proc.content()['completed'].listnames()), sorted(pids[3:]))
+
+    @run_in_reactor
+    def test_task_output_is_bounded(self):
+        output = TaskOutput(max_size=6)
+        for data in ('ab', 'cd', 'ef', 'gh'):
+            output.append(data)
+
+        eq_(list(output), ['cd', 'ef', 'gh'])
+        eq_(output.read(2), [(3, 'ef'), (4, 'gh')])
+        eq_(output.total_size, 8)
+        assert output.truncated(0)
+        assert not output.truncated(1)
+
+        res = []
+        output.wait(4).addCallback(res.append)
+        output.append('ij')
+        eq_(res, [[(5, 'ij')]])
+
+        output.wait(5).addCallback(res.append)
+        output.close()
+        eq_(res[-1], [])
+
+        # a single chunk larger than the whole output is cut
+        output = TaskOutput(max_size=6)
+        output.append('ab')
+        output.append('abcdefgh')
+        eq_(output.read(), [(2, 'cdefgh')])
+        eq_((output.size, output.total_size), (6, 10))
+
+
+class FlakyDaemonProcess(DaemonProcess):
+    __name__ = 'flaky'
+
+    interval = 10
+    jitter = 0
+    max_backoff = 30
+
+    def __init__(self):
+        super(FlakyDaemonProcess, self).__init__()
+        self.fail = True
+
+    def execute(self):
+        if self.fail:
+            raise Exception('flaky')
+
+
+class DaemonSchedulerTestCase(unittest.TestCase):
+
+    @run_in_reactor
+    def test_jitter(self):
+        class JitteryDaemonProcess(FlakyDaemonProcess):
+            jitter = None
+
+        daemon = JitteryDaemonProcess()
+        eq_(daemon.jitter, get_config().getfloat('daemons', 'jitter'))
+
+        delays = set(daemon.next_delay() for i in range(10))
+        assert len(delays) > 1
+        assert all(10 <= delay <= 10 * (1 + daemon.jitter) for delay in delays)
+
+    @run_in_reactor
+    def test_stats_and_backoff(self):
+        daemon = FlakyDaemonProcess()
+
+        for i in range(3):
+            daemon.run_once()
+        eq_((daemon.runs, daemon.failures), (3, 3))
+        eq_(daemon.next_delay(), 30)
+
+        daemon.fail = False
+        daemon.run_once()
+        eq_((daemon.runs, daemon.failures), (4, 3))
+        eq_(daemon.next_delay(), 10)
+
+        task = DaemonTask('42', Proc(), daemon, None, 'flaky', '1')
+        daemon.next_run = time.time() + 5
+        data = model_to_dict(task)
+        eq_(data['runs'], 4)
+        eq_(data['failures'], 3)
+        assert 0 <= data['next_run'] <= 5
@@ -0,0 +1,254 @@
+import unittest
+
+import mock
+import transaction
+from ZODB.POSException import POSKeyError
+from nose.tools import eq_
+from zope import schema
+from zope.authentication.interfaces import IAuthentication
+from zope.component import getUtility
+from zope.interface import Interface, implements
+
+from opennode.oms.endpoint.httprest.view import SearchView
+from opennode.oms.model.model.base import Model
+from opennode.oms.model.model.filtrable import QueryPlan
+from opennode.oms.model.model.search import (SearchContainer, SearchResult, ITagged, ReindexAction,
+                                             index_field, indexed_fields)
+from opennode.oms.model.model.symlink import follow_symlinks
+from opennode.oms.security.interaction import new_interaction
+from opennode.oms.tests.test_compute import Compute, ICompute
+from opennode.oms.tests.util import run_in_reactor, clean_db
+from opennode.oms.zodb import db
+
+
+class Tagged(object):
+    implements(ITagged)
+
+    def __init__(self, *tags):
+        self.tags = set(tags)
+
+
+class IStateful(Interface):
+    state = schema.TextLine(title=u"State")
+
+
+class Stateful(Model):
+    implements(IStateful)
+
+    def __init__(self, state):
+        self.state = state
+
+
+class TagFacetsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.search = SearchContainer()
+        index = self.search.catalog['tags']
+        index.index_doc(1, Tagged(u'type:compute', u'label:a', u'label:b'))
+        index.index_doc(2, Tagged(u'type:compute', u'label:a'))
+        index.index_doc(3, Tagged(u'type:network', u'label:b'))
+
+    def test_facets(self):
+        eq_(self.search.tag_facets([]), {u'type:compute': 2, u'type:network': 1,
+                                         u'label:a': 2, u'label:b': 2})
+        eq_(dict(self.search.tag_facets([u'label:a'])), {u'type:compute': 2, u'label:b': 1})
+        eq_(dict(self.search.tag_facets([u'label:a', u'label:b'])), {u'type:compute': 1})
+        eq_(dict(self.search.tag_facets([u'label:a', u'type:network'])), {})
+        eq_(self.search.tag_facets([u'nonexisting']), {})
+
+    def test_counts_follow_reindexing(self):
+        index = self.search.catalog['tags']
+        index.index_doc(2, Tagged(u'type:compute', u'label:c'))
+        index.unindex_doc(3)
+        index.index_doc(1, Tagged())
+
+        with mock.patch.object(index, '_fwd_index') as fwd_index:
+            eq_(self.search.tag_facets([]), {u'type:compute': 1, u'label:c': 1})
+            assert not fwd_index.items.called
+
+    def test_by_tag_navigation(self):
+        by_tag = self.search.tag_container
+        eq_(sorted(by_tag.listnames()), [u'label:a', u'label:b', u'type:compute', u'type:network'])
+
+        tag = by_tag[u'label:b']
+        eq_(tag.count, 2)
+        eq_(sorted(tag.listnames()), [u'items', u'label:a', u'type:compute', u'type:network'])
+        eq_(tag[u'type:compute'].tag_path, [u'label:b', u'type:compute'])
+        eq_(sorted(tag[u'type:compute'].listnames()), [u'items', u'label:a'])
+
+
+class SearchTestCase(unittest.TestCase):
+
+    @run_in_reactor
+    @clean_db
+    def test_paginated_search(self):
+        machines = db.get_root()['oms_root']['machines']
+        computes = [Compute(u'tux%s' % i, u'active') for i in range(5)]
+        for compute in computes:
+            machines.add(compute)
+        transaction.commit()
+
+        search = SearchContainer()
+        for compute in computes:
+            search.index_object(compute)
+
+        eq_(search.count_goog(u'nonexisting'), 0)
+        eq_(search.count(tags=[u'type:compute']), 5)
+
+        ids = search.query(tags=[u'type:compute'])
+        eq_(len(ids), 5)
+        eq_(search.query(tags=[u'type:compute'], limit=2, offset=1), ids[1:3])
+        eq_(sorted(search.objects(ids)), sorted(computes))
+
+        # objects are loaded only for the requested page
+        eq_(search.query(ranked=True, limit=2, __all=u'tux3'), [search.ids.getId(computes[3])])
+        eq_(len(search.search_goog(u'tux*', limit=3, ranked=True)), 3)
+
+        res = SearchResult(search, u'tux*', limit=2, offset=3)
+        page = search.objects(search.query(__all=u'tux*')[3:])
+        eq_(sorted(follow_symlinks(i) for i in res.listcontent()), sorted(page))
+
+    @run_in_reactor
+    @clean_db
+    def test_ranked_rest_search(self):
+        machines = db.get_root()['oms_root']['machines']
+        computes = [Compute(name, u'active') for name in (u'tux', u'tux_penguin', u'tux_tux_tux', u'tux_tux')]
+        for compute in computes:
+            machines.add(compute)
+        transaction.commit()
+
+        search = db.get_root()['oms_root']['search']
+        for compute in computes:
+            search.index_object(compute)
+
+        request = mock.Mock()
+        request.args = {'q': ['tux'], 'rank': ['1']}
+        request.interaction = new_interaction(getUtility(IAuthentication).getPrincipal('root'))
+        res = SearchView(search).render_GET(request)
+
+        ranked = [follow_symlinks(obj).hostname for obj in search.search_goog(u'tux', ranked=True)]
+        eq_([i['hostname'] for i in res], ranked)
+        eq_(ranked[0], u'tux_tux_tux')
+
+    @run_in_reactor
+    @clean_db
+    def test_reindex_keeps_ids(self):
+        machines = db.get_root()['oms_root']['machines']
+        computes = [Compute(u'tux%s' % i, u'active') for i in range(3)]
+        for compute in computes:
+            machines.add(compute)
+        transaction.commit()
+
+        search = db.get_root()['oms_root']['search']
+        for compute in computes:
+            search.index_object(compute)
+        ids = [search.query_id(compute) for compute in computes]
+        del machines[computes[2].__name__]
+        transaction.commit()
+
+        search.start_rebuild()
+        eq_(search.count(tags=[u'type:compute']), 3)
+        search.index_object(computes[0])
+        eq_(search.count(tags=[u'type:compute']), 3)
+        transaction.commit()
+
+        cmd = mock.Mock()
+        ReindexAction(None).execute(cmd, None)
+        transaction.abort()
+
+        search = db.get_root()['oms_root']['search']
+        eq_(search.shadow_catalog, None)
+        eq_(search.count(tags=[u'type:compute']), 2)
+        eq_([search.query_id(compute) for compute in computes], ids[:2] + [None])
+
+        search.unindex_object(computes[1])
+        eq_(search.count(tags=[u'type:compute']), 1)
+        eq_(search.query_id(computes[1]), None)
+
+    @run_in_reactor
+    @clean_db
+    def test_rebuild_releases_unloadable_ids(self):
+        machines = db.get_root()['oms_root']['machines']
+        computes = [Compute(u'tux%s' % i, u'active') for i in range(2)]
+        for compute in computes:
+            machines.add(compute)
+        transaction.commit()
+
+        search = db.get_root()['oms_root']['search']
+        for compute in computes:
+            search.index_object(compute)
+        stale_id = search.query_id(computes[1])
+        del machines[computes[1].__name__]
+        transaction.commit()
+
+        search.start_rebuild()
+        search.index_object(computes[0])
+
+        # the deleted object could have been packed away
+        with mock.patch.object(search.ids, 'getObject', side_effect=POSKeyError):
+            eq_(search.finish_rebuild(), 1)
+        assert stale_id not in search.ids.refs
+        eq_(len(search.ids.ids), 1)
+        eq_(search.count(tags=[u'type:compute']), 1)
+        transaction.abort()
+
+
+class FieldIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.orig_fields = dict((name, list(interfaces)) for name, interfaces in indexed_fields.items())
+        index_field(ICompute, 'state')
+        index_field(ICompute, 'memory')
+
+    def tearDown(self):
+        indexed_fields.clear()
+        indexed_fields.update(self.orig_fields)
+
+    @run_in_reactor
+    @clean_db
+    def test_query_plan(self):
+        machines = db.get_root()['oms_root']['machines']
+        computes = [Compute(u'tux%s' % i, state, memory=memory)
+                    for i, (state, memory) in enumerate([(u'active', 1024), (u'inactive', 2048),
+                                                         (u'active', 4096)])]
+        for compute in computes:
+            machines.add(compute)
+        transaction.commit()
+
+        search = SearchContainer()
+        for compute in computes:
+            search.index_object(compute)
+
+        def matching(query):
+            plan = QueryPlan(query, search)
+            return [i for i, compute in enumerate(computes) if plan.match(compute)]
+
+        plan = QueryPlan(u'state:inactive memory:..3000 tux', search)
+        eq_(plan.remaining, u'tux')
+        eq_(len(plan.ids), 1)
+
+        eq_(matching(u'memory:1000..3000'), [0, 1])
+        eq_(matching(u'memory:2048..'), [1, 2])
+        eq_(matching(u'memory:4096'), [2])
+        eq_(matching(u'state:act memory:..2048'), [0, 1])
+        eq_(matching(u'state:inactive hostname:tux2'), [])
+
+        # indexed objects with a same-named field of another interface are scanned
+        other = Stateful(u'inactive')
+        db.get_root()._p_jar.add(other)
+        search.index_object(other)
+        eq_(QueryPlan(u'state:inactive', search).match(other), True)
+        eq_(QueryPlan(u'state:inactive memory:..3000', search).match(other), False)
+
+        # objects not indexed yet are scanned
+        other = Compute(u'penguin', u'active', memory=2048)
+        eq_(QueryPlan(u'memory:2000..3000', search).match(other), True)
+        eq_(QueryPlan(u'memory:3000..', search).match(other), False)
+
+        # indexes added to an existing catalog are used only after a rebuild
+        del indexed_fields['memory']
+        search.clear()
+        index_field(ICompute, 'memory')
+        search.index_object(computes[0])
+        eq_(search.field_indexes('memory'), None)
+        eq_(QueryPlan(u'memory:1024', search).ids, None)
@@ -1,4 +1,5 @@
 import datetime
+import json
 import unittest
 import mock
 import transaction
@@ -6,6 +7,7 @@ import zope.schema
 from grokcore.component.testing import grok
 from martian.testing import FakeModule
 from nose.tools import eq_, assert_raises
+from twisted.internet import defer
 from zope import schema
 from zope.interface import implements, Interface
 from zope.authentication.interfaces import IAuthentication
@@ -17,8 +19,11 @@ from opennode.oms.endpoint.ssh.cmd.commands import CreateObjCmd, MoveCmd
 from opennode.oms.endpoint.ssh.cmd.directives import command
 from opennode.oms.endpoint.ssh.cmd.registry import commands
 from opennode.oms.endpoint.ssh.protocol import OmsShellProtocol, CommandLineSyntaxError
+from opennode.oms.endpoint.ssh.session import BatchScriptRunner
+from opennode.oms.endpoint.ssh.terminal import CTRL_C
 from opennode.oms.model.model import creatable_models
 from opennode.oms.model.model.base import Model, Container
+from opennode.oms.model.model.proc import Proc
 from opennode.oms.tests.util import run_in_reactor, clean_db, assert_mock, no_more_calls, skip, current_call
 from opennode.oms.tests.util import whatever
 from opennode.oms.tests.test_compute import Compute
@@ -77,6 +82,138 @@ class SshTestCase(unittest.TestCase):
             t.write('No such command: non-existent-command\n')
         assert not self.terminal.method_calls[1][1][0].startswith('Command returned an unhandled error')
 
+    @run_in_reactor
+    def test_command_resolution_cache(self):
+        transaction.commit()
+        self._cmd('cd /machines')
+        resolve = mock.Mock(wraps=self.oms_ssh._resolve_command_class)
+
+        with mock.patch.object(self.oms_ssh, '_resolve_command_class', resolve):
+            ls = self.oms_ssh.get_command_class('ls')
+            eq_(self.oms_ssh.get_command_class('ls'), ls)
+            eq_(resolve.call_count, 1)
+
+            # the current directory could now contain an 'ls' object
+            db.get_root()['oms_root']['machines'].add(self.make_compute())
+            transaction.commit()
+            eq_(self.oms_ssh.get_command_class('ls'), ls)
+            eq_(resolve.call_count, 2)
+
+            # 'cd' itself is resolved from /machines
+            self._cmd('cd /')
+            eq_(self.oms_ssh.get_command_class('ls'), ls)
+            eq_(resolve.call_count, 4)
+
+    @run_in_reactor
+    def test_command_resolution_sees_other_connections(self):
+        db.get_root()['oms_root']['machines'].add(self.make_compute())
+        transaction.commit()
+        self._cmd('cd /machines')
+        resolve = mock.Mock(wraps=self.oms_ssh._resolve_command_class)
+
+        with mock.patch.object(self.oms_ssh, '_resolve_command_class', resolve):
+            ls = self.oms_ssh.get_command_class('ls')
+
+            tm = transaction.TransactionManager()
+            conn = db.get_db().open(tm)
+            try:
+                # without events, whose handlers would use this thread's connection
+                conn.root()['oms_root']['machines']._add(self.make_compute())
+                tm.commit()
+            finally:
+                conn.close()
+
+            transaction.begin()
+            eq_(self.oms_ssh.get_command_class('ls'), ls)
+            eq_(resolve.call_count, 2)
+
+    @run_in_reactor
+    def test_threaded_output_is_coalesced(self):
+        cmd = Cmd(self.oms_ssh)
+        cmd.write_buffer = []
+
+        with mock.patch('opennode.oms.endpoint.ssh.cmd.base.isInIOThread', return_value=False):
+            with mock.patch('opennode.oms.endpoint.ssh.cmd.base.reactor') as reactor:
+                cmd.write('foo\n')
+                cmd.write('bar\n')
+                eq_(reactor.callFromThread.call_count, 1)
+        assert not self.terminal.method_calls
+
+        # writes from the reactor thread don't overtake buffered ones
+        cmd.write('baz\n')
+        with assert_mock(self.terminal) as t:
+            t.write('foo\nbar\n')
+            t.write('baz\n')
+            no_more_calls(t)
+        eq_(cmd.write_buffer, ['foo\n', 'bar\n', 'baz\n'])
+
+    @run_in_reactor
+    def test_tail_follow(self):
+        d = defer.Deferred()
+        pid = Proc.register(d, None, 'some cmd', write_buffer=['one\ntwo\n', 'three\n'])
+        output = Proc()[pid].output
+
+        self._cmd('tail -n 2 /proc/%s' % pid)
+        with assert_mock(self.terminal) as t:
+            t.write('two\nthree\n')
+
+        self.terminal.reset_mock()
+        self._cmd('tail -n 0 -f %s' % pid)
+        output.append('four\n')
+        d.callback(None)
+        with assert_mock(self.terminal) as t:
+            t.write('four\n')
+            t.write('user@oms:/# ')
+            no_more_calls(t)
+
+        d = defer.Deferred()
+        pid = Proc.register(d, None, 'some cmd')
+        self._cmd('tail -f %s' % pid)
+        Proc()[pid].output.append('three\n')
+        Proc()[pid].output.append('four\n')
+        self.oms_ssh.keystrokeReceived(CTRL_C, None)
+        assert not Proc()[pid].output.waiters
+
+        self.terminal.reset_mock()
+        Proc()[pid].output.append('five\n')
+        assert not self.terminal.write.called
+        d.callback(None)
+
+    @run_in_reactor
+    def test_batch_script(self):
+        proto = mock.Mock()
+        runner = BatchScriptRunner(proto, self.oms_ssh.principal)
+
+        runner.dataReceived('cd /computes\n# comment\n\npw')
+        runner.dataReceived('d\nnonexistent-command\ncd /nonexisting\n')
+        assert not proto.processEnded.called
+
+        runner.dataReceived('ls "\npwd')
+        runner.eofReceived()
+
+        results = [json.loads(args[0]) for name, args, kw in proto.method_calls if name == 'write']
+        eq_([(r['line'], r['command'], r['output']) for r in results],
+            [(1, 'cd /computes', ''),
+             (4, 'pwd', '/computes\n'),
+             (5, 'nonexistent-command', 'No such command: nonexistent-command\n'),
+             (6, 'cd /nonexisting', 'No such object: /nonexisting\n'),
+             (7, 'ls "', 'Syntax error: No closing quotation\n'),
+             (8, 'pwd', '/computes\n')])
+        eq_([r['status'] for r in results], ['ok', 'ok', 'error', 'error', 'error', 'ok'])
+        eq_(proto.processEnded.call_args[0][0].value.exitCode, 1)
+
+    @run_in_reactor
+    def test_batch_script_exit_status(self):
+        proto = mock.Mock()
+        runner = BatchScriptRunner(proto, self.oms_ssh.principal)
+
+        runner.dataReceived('cd /computes\npwd\n')
+        runner.eofReceived()
+
+        eq_([json.loads(args[0])['status'] for name, args, kw in proto.method_calls if name == 'write'],
+            ['ok', 'ok'])
+        eq_(proto.processEnded.call_args[0][0].value.exitCode, 0)
+
     @run_in_reactor
     def test_pwd(self):
         self._cmd('pwd')
@@ -166,6 +303,28 @@ class SshTestCase(unittest.TestCase):
             skip(t, 1)
             no_more_calls(t)
 
+    @run_in_reactor
+    def test_ls_recursive(self):
+        machines = db.get_root()['oms_root']['machines']
+        cid = machines.add(self.make_compute())
+        transaction.commit()
+
+        def headers():
+            return [call[1][0] for call in self.terminal.method_calls
+                    if call[0] == 'write' and call[1][0].startswith('\n/')]
+
+        self.terminal.reset_mock()
+        self._cmd('ls -R /machines')
+        eq_(headers(), ['\n/machines/%s:\n' % cid, '\n/machines/%s/actions:\n' % cid])
+
+        self.terminal.reset_mock()
+        self._cmd('ls -R --max-depth 1 /machines')
+        eq_(headers(), ['\n/machines/%s:\n' % cid])
+
+        self.terminal.reset_mock()
+        self._cmd('ls -R --max-depth 0 /machines')
+        eq_(headers(), [])
+
     @run_in_reactor
     def test_cat_folders(self):
         for folder in self.tlds:
@@ -338,6 +497,36 @@ class SshTestCase(unittest.TestCase):
         with assert_mock(self.terminal) as t:
             t.write('Host name:             TUX-FOR-TEST\n')
 
+    @run_in_reactor
+    def test_modify_computes_in_parallel(self):
+        computes = db.get_root()['oms_root']['computes']
+        cids = [computes.add(self.make_compute()) for i in range(3)]
+        transaction.commit()
+
+        proc = db.get_root()['oms_root']['proc']
+        proc.dead_tasks.clear()
+
+        self._cmd('set /computes/0000_* -j 2 hostname=TUX-FOR-TEST -v')
+        eq_(sorted(args[0] for name, args, kw in self.terminal.method_calls if name == 'write')[:3],
+            sorted('/computes/%s: Setting hostname=TUX-FOR-TEST\n' % cid for cid in cids))
+
+        transaction.begin()
+        eq_([computes[cid].target.hostname for cid in cids], [u'TUX-FOR-TEST'] * 3)
+
+        tasks = proc.dead_tasks.values()
+        parent = [task for task in tasks if task.cmdline.startswith('set /computes/0000_*')][0]
+        children = [task for task in tasks if task.ptid == parent.__name__]
+        eq_(sorted(task.cmdline for task in children),
+            sorted('set /computes/%s' % cid for cid in cids))
+
+        self.terminal.reset_mock()
+        self._cmd('rm /computes/nonexistent /computes/%s -j 2' % cids[0])
+        with assert_mock(self.terminal) as t:
+            t.write('/computes/nonexistent: No such object: /computes/nonexistent\n')
+
+        transaction.begin()
+        eq_(sorted(computes.listnames()), sorted(cids[1:]) + ['by-name'])
+
     @run_in_reactor
     def test_modify_compute_errors(self):
         computes = db.get_root()['oms_root']['computes']
@@ -0,0 +1,86 @@
+import time
+import unittest
+
+import mock
+import transaction
+from nose.tools import eq_
+from zope.component import handle
+
+from opennode.oms.endpoint.httprest.view import StreamView
+from opennode.oms.model.model.events import ModelDeletedEvent, ModelModifiedEvent
+from opennode.oms.model.model.stream import TransientStream
+from opennode.oms.tests.test_compute import Compute
+from opennode.oms.tests.util import run_in_reactor, clean_db
+from opennode.oms.zodb import db
+
+
+class StreamTestCase(unittest.TestCase):
+
+    @run_in_reactor
+    @clean_db
+    def setUp(self):
+        machines = db.get_root()['oms_root']['machines']
+        self.compute = Compute(u'tux-for-test', u'active')
+        machines.add(self.compute)
+        transaction.commit()
+
+        self.path = '/machines/%s' % self.compute.__name__
+        self.view = StreamView(db.get_root()['oms_root']['stream'])
+
+    def _events(self, paths, after=0):
+        res = []
+        self.view.render_events(paths, after, 100).addCallback(res.append)
+        return res[0][1]
+
+    def _modify(self, old, new):
+        handle(self.compute, ModelModifiedEvent({'hostname': old}, {'hostname': new}))
+
+    @run_in_reactor
+    def test_transient_stream_read_without_traversal(self):
+        self._modify(u'tux-for-test', u'tux')
+        events = self._events([self.path])
+        eq_(events[0][-1][1]['value'], u'tux')
+
+        self._modify(u'tux', u'penguin')
+        with mock.patch.object(StreamView, 'traverse_events') as traverse_events:
+            events = self._events([self.path + '/'])
+            assert not traverse_events.called
+        eq_([e['value'] for ts, e in events[0]], [u'tux', u'penguin'])
+
+    @run_in_reactor
+    def test_deleted_model(self):
+        self._events([self.path])
+
+        machines = db.get_root()['oms_root']['machines']
+        del machines[self.compute.__name__]
+        handle(self.compute, ModelDeletedEvent(machines))
+
+        with mock.patch.object(StreamView, 'traverse_events') as traverse_events:
+            events = self._events([self.path])
+            assert not traverse_events.called
+        eq_(events[0][-1][1]['event'], 'delete')
+
+        events = self._events(['/machines/nonexisting'])
+        eq_(events[0][-1][1], dict(event='delete', name='nonexisting', url='/machines/nonexisting'))
+
+    @run_in_reactor
+    def test_deleted_paths_expire(self):
+        self._events([self.path])
+        assert self.path in StreamView.transient_paths
+
+        machines = db.get_root()['oms_root']['machines']
+        del machines[self.compute.__name__]
+        handle(self.compute, ModelDeletedEvent(machines))
+        transaction.commit()
+        assert TransientStream.is_deleted(self.path)
+
+        # paths not traversed for longer than tombstones live are traversed again
+        later = time.time() + TransientStream.TOMBSTONE_TTL + 1
+        with mock.patch('time.time', return_value=later):
+            events = self._events([self.path])
+            eq_(events[0][-1][1]['event'], 'delete')
+            assert self.path not in StreamView.transient_paths
+
+            TransientStream.add_tombstone('/machines/other')
+        assert self.path not in TransientStream.tombstones
+        assert TransientStream.is_deleted('/machines/other')
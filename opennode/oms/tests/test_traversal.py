@@ -0,0 +1,107 @@
+import unittest
+
+import transaction
+from nose.tools import eq_
+from zope.component import handle
+
+from opennode.oms.model.model.events import ModelDeletedEvent
+from opennode.oms.model.traversal import traverse_path, canonical_path, path_cache
+from opennode.oms.tests.test_compute import Compute
+from opennode.oms.tests.util import run_in_reactor, clean_db
+from opennode.oms.zodb import db
+
+
+class PathCacheTestCase(unittest.TestCase):
+
+    @run_in_reactor
+    @clean_db
+    def test_path_cache(self):
+        oms_root = db.get_root()['oms_root']
+        machines = oms_root['machines']
+        compute = Compute(u'tux-for-test', u'active')
+        machines.add(compute)
+        transaction.commit()
+
+        path = '/machines/%s' % compute.__name__
+        eq_(canonical_path(compute), path)
+
+        hits = path_cache.hits
+        eq_(canonical_path(compute), path)
+        eq_(path_cache.hits, hits + 1)
+
+        objs, unresolved = traverse_path(oms_root, path)
+        eq_((objs, unresolved), ([machines, compute], []))
+        eq_(traverse_path(oms_root, path + '/'), ([machines, compute], []))
+        eq_(path_cache.hits, hits + 2)
+
+        old_name = compute.__name__
+        machines.rename(old_name, 'renamed')
+        eq_(canonical_path(compute), '/machines/renamed')
+        eq_(traverse_path(oms_root, path), ([machines], [old_name]))
+
+        del machines['renamed']
+        handle(compute, ModelDeletedEvent(machines))
+        eq_(traverse_path(oms_root, '/machines/renamed')[1], ['renamed'])
+
+    @run_in_reactor
+    @clean_db
+    def test_path_cache_validates_hits(self):
+        oms_root = db.get_root()['oms_root']
+        machines = oms_root['machines']
+        compute = Compute(u'tux-for-test', u'active')
+        machines.add(compute)
+        transaction.commit()
+
+        path_cache.clear()
+        misses = path_cache.misses
+        eq_(canonical_path(compute), '/machines/%s' % compute.__name__)
+        eq_(path_cache.misses, misses + 1)
+
+        path = '/machines/%s' % compute.__name__
+        eq_(traverse_path(oms_root, path), ([machines, compute], []))
+        eq_(traverse_path(oms_root, path), ([machines, compute], []))
+
+        # deleted without any event
+        del machines._items[compute.__name__]
+        eq_(traverse_path(oms_root, path), ([machines], [compute.__name__]))
+        transaction.abort()
+
+        eq_(traverse_path(oms_root, path)[1], [])
+
+        tm = transaction.TransactionManager()
+        conn = db.get_db().open(tm)
+        del conn.root()['oms_root']['machines']._items[compute.__name__]
+        tm.commit()
+        conn.close()
+        transaction.begin()
+
+        eq_(traverse_path(oms_root, path), ([machines], [compute.__name__]))
+
+    @run_in_reactor
+    @clean_db
+    def test_path_cache_validates_paths(self):
+        oms_root = db.get_root()['oms_root']
+        machines = oms_root['machines']
+        compute = Compute(u'tux-for-test', u'active')
+        machines.add(compute)
+        transaction.commit()
+
+        path_cache.clear()
+        eq_(canonical_path(compute), '/machines/%s' % compute.__name__)
+        hits = path_cache.hits
+        eq_(canonical_path(compute), '/machines/%s' % compute.__name__)
+        eq_(path_cache.hits, hits + 1)
+
+        # renamed by another process, without any event in this one
+        tm = transaction.TransactionManager()
+        conn = db.get_db().open(tm)
+        other = conn.root()['oms_root']['machines']
+        other._items['renamed'] = other._items[compute.__name__]
+        del other._items[compute.__name__]
+        other._items['renamed'].__name__ = 'renamed'
+        tm.commit()
+        conn.close()
+        transaction.begin()
+
+        eq_(canonical_path(compute), '/machines/renamed')
+        eq_(path_cache.hits, hits + 1)
@@ -0,0 +1,254 @@
+import json
+import struct
+import time
+import unittest
+
+import mock
+from nose.tools import eq_
+from twisted.test.proto_helpers import StringTransport
+from zope.authentication.interfaces import IAuthentication
+from zope.component import getUtility
+
+from opennode.oms.endpoint.ssh.protocol import OmsShellProtocol
+from opennode.oms.endpoint.webterm.root import OmsShellTerminalProtocol, TerminalSession, TerminalServerMixin
+from opennode.oms.endpoint.webterm.root import SSHClientTerminalProtocol, WebSocketTerminalSession
+from opennode.oms.endpoint.webterm.root import WebTerminalReaperDaemonProcess
+from opennode.oms.endpoint.webterm.ssh import SSHConnectionPool, ShellChannel
+from opennode.oms.endpoint.webterm.websocket import upgrade
+from opennode.oms.model.model.proc import Proc
+from opennode.oms.tests.util import run_in_reactor, clean_db
+
+
+class FakeTerminalProtocol(object):
+
+    def connection_made(self, terminal, size):
+        self.terminal = terminal
+        self.closed = False
+
+    def connection_lost(self):
+        self.closed = True
+
+    def handle_key(self, key):
+        self.terminal.transport.write('echo: %s' % key)
+
+    def terminalSize(self, width, height):
+        self.size = (width, height)
+
+
+class WebTerminalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = mock.patch('opennode.oms.endpoint.webterm.root.reactor').start()
+        self.protocol = FakeTerminalProtocol()
+        self.session = TerminalSession(self.protocol, (80, 25))
+
+    def tearDown(self):
+        mock.patch.stopall()
+        TerminalServerMixin.sessions.pop(self.session.id, None)
+
+    def _poll(self):
+        request = mock.Mock()
+        self.session.enqueue(request)
+        return json.loads(request.write.call_args[0][0])['data']
+
+    def test_writes_are_coalesced(self):
+        self.protocol.terminal.transport.write('foo')
+        self.protocol.terminal.transport.write(u'b\xe4r')
+        eq_(self.reactor.callLater.call_count, 1)
+
+        eq_(self._poll(), u'foob\xe4r')
+        eq_(self.session.buffered, 0)
+
+    def test_chunks_dont_split_characters(self):
+        self.session.chunk_size = 3
+        self.session.write(u'ab\xe4\xe4')
+
+        eq_(self._poll(), u'ab')
+        eq_(self._poll(), u'\xe4')
+        eq_(self._poll(), u'\xe4')
+
+    def test_buffer_is_capped(self):
+        with mock.patch.object(TerminalSession, 'max_buffer_size', 5):
+            self.session.write('abc')
+            self.session.write('defg')
+            eq_(self.session.buffered, 5)
+            eq_(self._poll(), 'cdefg')
+
+    def test_idle_sessions_are_reaped(self):
+        TerminalServerMixin.sessions[self.session.id] = self.session
+        self.session.write('foo')
+
+        WebTerminalReaperDaemonProcess().execute()
+        assert self.session.id in TerminalServerMixin.sessions
+
+        self.session.timestamp = time.time() - 3600
+        WebTerminalReaperDaemonProcess().execute()
+        assert self.session.id not in TerminalServerMixin.sessions
+        assert self.protocol.closed
+        eq_(self.session.buffered, 0)
+
+
+def client_frame(opcode, payload, fin=True):
+    mask = '\x01\x02\x03\x04'
+    masked = ''.join(chr(ord(c) ^ ord(mask[i % 4])) for i, c in enumerate(payload))
+    return struct.pack('!BB', (0x80 if fin else 0) | opcode, 0x80 | len(payload)) + mask + masked
+
+
+class WebSocketTerminalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = mock.patch('opennode.oms.endpoint.webterm.root.reactor').start()
+        self.transport = StringTransport()
+
+        headers = {'upgrade': 'websocket', 'connection': 'keep-alive, Upgrade',
+                   'sec-websocket-version': '13', 'sec-websocket-key': 'dGhlIHNhbXBsZSBub25jZQ=='}
+        request = mock.Mock()
+        request.getHeader = headers.get
+        request.channel.transport = self.transport
+
+        self.protocol = FakeTerminalProtocol()
+        self.session = WebSocketTerminalSession(self.protocol, (80, 25))
+        upgrade(request, self.session)
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def test_terminal_over_websocket(self):
+        handshake = self.transport.value()
+        assert handshake.startswith('HTTP/1.1 101 Switching Protocols\r\n')
+        assert 'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n' in handshake
+        eq_(self.transport.protocol, self.session)
+        self.transport.clear()
+
+        # a fragmented binary message, delivered in pieces
+        data = client_frame(0x2, 'l', fin=False) + client_frame(0x0, 's')
+        self.session.dataReceived(data[:3])
+        self.session.dataReceived(data[3:])
+        eq_(self.reactor.callLater.call_count, 1)
+
+        self.session.flush()
+        eq_(self.transport.value(), '\x82\x08echo: ls')
+        self.transport.clear()
+
+        self.session.dataReceived(client_frame(0x1, json.dumps({'resize': [100, 40]})))
+        eq_(self.protocol.size, (100, 40))
+
+        self.session.dataReceived(client_frame(0x9, 'ping'))
+        eq_(self.transport.value(), '\x8a\x04ping')
+        self.transport.clear()
+
+        self.session.dataReceived(client_frame(0x8, struct.pack('!H', 1000)))
+        eq_(self.transport.value(), '\x88\x02' + struct.pack('!H', 1000))
+        assert self.transport.disconnecting
+
+        self.session.connectionLost(None)
+        assert self.protocol.closed
+
+
+class OmsShellWebSocketTestCase(unittest.TestCase):
+
+    @run_in_reactor
+    @clean_db
+    def setUp(self):
+        self.transport = StringTransport()
+
+        headers = {'upgrade': 'websocket', 'connection': 'Upgrade',
+                   'sec-websocket-version': '13', 'sec-websocket-key': 'dGhlIHNhbXBsZSBub25jZQ=='}
+        request = mock.Mock()
+        request.getHeader = headers.get
+        request.channel.transport = self.transport
+
+        self.protocol = OmsShellTerminalProtocol()
+        self.protocol.logged_in(getUtility(IAuthentication).getPrincipal('user'))
+        self.session = WebSocketTerminalSession(self.protocol, (80, 25))
+        upgrade(request, self.session)
+
+    @run_in_reactor
+    def test_quit_closes_shell_once(self):
+        shell = self.protocol.shell
+        assert shell.tid in Proc().tasks
+
+        with mock.patch.object(OmsShellProtocol, 'save_history') as save_history:
+            # `quit` closes the web connection, which reports back that it was lost
+            with mock.patch.object(self.transport, 'loseConnection',
+                                   side_effect=lambda: self.session.connectionLost(None)):
+                shell.close_connection()
+
+            self.session.connectionLost(None)
+            eq_(save_history.call_count, 1)
+        assert shell.tid not in Proc().tasks
+
+
+class SSHConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = mock.patch('opennode.oms.endpoint.webterm.ssh.reactor').start()
+        self.creator = mock.patch('opennode.oms.endpoint.webterm.ssh.protocol.ClientCreator').start()
+        self.pool = SSHConnectionPool()
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def _open(self, host='host1'):
+        channel = ShellChannel(StringTransport(), mock.Mock(), (80, 25))
+        self.pool.open_channel('root', host, 22, channel)
+        return channel
+
+    def test_channels_share_connections(self):
+        with mock.patch.object(SSHConnectionPool, 'max_channels', 2):
+            channels = [self._open() for i in range(3)]
+
+        eq_(self.creator.call_count, 2)
+        conns = self.pool.connections[('root', 'host1', 22)]
+        eq_([len(conn.pending) for conn in conns], [2, 1])
+        assert channels[0].conn is channels[1].conn
+
+    def test_connections_per_host_are_capped(self):
+        with mock.patch.object(SSHConnectionPool, 'max_connections', 1):
+            self._open()
+            self.pool.connections[('root', 'host1', 22)][0].shared = False
+            channel = self._open()
+
+        eq_(self.creator.call_count, 1)
+        assert channel.terminal_transport.value().startswith('Too many ssh connections')
+        assert channel.terminal_transport.disconnecting
+
+    def test_idle_connections_are_closed(self):
+        channel = self._open()
+        conn = channel.conn
+        conn.transport = mock.Mock()
+
+        conn.pending.remove(channel)
+        conn.channel_done(channel)
+        eq_(self.reactor.callLater.call_args[0], (300, conn.transport.loseConnection))
+
+        self._open()
+        assert self.reactor.callLater.return_value.cancel.called
+
+        conn.connection_lost()
+        assert ('root', 'host1', 22) not in self.pool.connections
+
+    def test_consoles_closed_before_authentication(self):
+        channels = [self._open() for i in range(3)]
+        conn = channels[0].conn
+
+        with mock.patch('opennode.oms.endpoint.webterm.root.ssh_connect_interactive_shell',
+                        return_value=channels[0]):
+            terminal = SSHClientTerminalProtocol('root', 'host1')
+            terminal.connection_made(mock.Mock(), (80, 25))
+            terminal.connection_lost()
+        eq_(conn.pending, channels[1:])
+
+        # a console closed while its channel is being moved is dead as well
+        channels[1].terminal_closed = True
+        conn.transport = mock.Mock()
+        with mock.patch.object(conn, 'openChannel', side_effect=lambda channel: conn.channels.update({0: channel})) as open_channel:
+            conn.serviceStarted()
+        eq_(open_channel.call_args_list, [mock.call(channels[2])])
+        assert not self.reactor.callLater.called
+
+        channels[2].terminal_lost()
+        with mock.patch.object(channels[2], 'loseConnection') as lose_connection:
+            channels[2].channelOpen('')
+        assert lose_connection.called
+        assert not channels[2].set_channel.called
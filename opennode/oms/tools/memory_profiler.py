@@ -35,25 +35,24 @@ class MemoryProfilerDaemonProcess(DaemonProcess):
         self.summary_tracker = tracker.SummaryTracker()
          
 
-    @defer.inlineCallbacks
     def run(self):
         if self.enabled and self.track:
-            yield self.collect_and_dump()
+            self.collect_and_dump()
 
-        while True:
-            try:
-                if self.enabled and not self.paused:
-                    if self.track:
-                        yield self.track_changes()
-                    else:
-                        yield self.collect_and_dump()
-                        if self.verbose:
-                            yield self.collect_and_dump_garbage()
-                            yield self.collect_and_dump_root()
-            except Exception:
-                log.err(system=self.__name__)
-
-            yield async_sleep(self.interval)
+        return super(MemoryProfilerDaemonProcess, self).run()
+
+    @defer.inlineCallbacks
+    def execute(self):
+        if not self.enabled:
+            return
+
+        if self.track:
+            yield self.track_changes()
+        else:
+            yield self.collect_and_dump()
+            if self.verbose:
+                yield self.collect_and_dump_garbage()
+                yield self.collect_and_dump_root()
 
     def collect_and_dump_garbage(self):
         logger.info('Uncollectable garbage list follows')
@@ -1,12 +1,11 @@
 import time
 
-from twisted.internet import defer
 from zope.component import provideSubscriptionAdapter
 from zope.interface import implements
 
 from opennode.oms.config import get_config
 from opennode.oms.model.model.proc import IProcess, Proc, DaemonProcess
-from opennode.oms.util import subscription_factory, async_sleep
+from opennode.oms.util import subscription_factory
 from opennode.oms.zodb import db
 
 
@@ -21,18 +20,8 @@ class PackDaemonProcess(DaemonProcess):
         config = get_config()
         self.interval = config.getint('db', 'pack_interval')
 
-    @defer.inlineCallbacks
-    def run(self):
-        while True:
-            try:
-                if not self.paused:
-                    yield self.pack()
-            except Exception:
-                import traceback
-                traceback.print_exc()
-                pass
-
-            yield async_sleep(self.interval)
+    def execute(self):
+        return self.pack()
 
     @db.ro_transact
     def pack(self):